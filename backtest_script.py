@@ -2,7 +2,11 @@
 import pandas as pd
 import numpy as np
 import os
-from tqdm import tqdm
+
+def tqdm(*args, **kwargs):
+    # Import trễ để import module / `cli.py --help` không phải nạp tqdm
+    from tqdm import tqdm as _tqdm
+    return _tqdm(*args, **kwargs)
 
 # ==============================================================================
 # BƯỚC 1: CẤU HÌNH CHIẾN LƯỢC (ĐÃ CẬP NHẬT)
@@ -16,12 +20,24 @@ class StrategyConfig:
     # Entry/Exit Signals
     ATR_WINDOW = 42 # CANNOT CHANGE AFTER LOADING
     ATR_MULTIPLIER = 10
+    # Khi chạy kèm dữ liệu trong phiên (xem intraday.py): 'touch' = bán ngay khi low của nến chạm stop,
+    # 'bar_close' = nến đóng cửa dưới stop thì bán ở giá mở cửa nến kế tiếp
+    # Lệnh bán khi chạm stop trong phiên khớp theo cùng MAX_PARTICIPATION_RATE / PRICE_IMPACT_COEF với lệnh
+    # mở cửa (giá cơ sở = giá stop, xem stop_fills); phần chưa khớp được xét lại cuối ngày
+    INTRADAY_STOP_MODE = 'touch'
 
     # Position Sizing & Risk Management
     VOLATILITY_WINDOW = 42 # CANNOT CHANGE AFTER LOADING
     TARGET_VOLATILITY = 0.30
     MIN_ASSUMED_HOLDINGS = 30
     MAX_LEVERAGE = 1.0
+    # 'inverse_vol': trọng số TARGET_VOLATILITY / vol từng mã (mặc định)
+    # 'portfolio_vol': như trên rồi thu nhỏ để volatility danh mục (hiệp phương sai EWMA, xem risk.py)
+    # không vượt PORTFOLIO_TARGET_VOLATILITY
+    SIZING_MODE = 'inverse_vol'
+    PORTFOLIO_TARGET_VOLATILITY = 0.20
+    COVARIANCE_DECAY = 0.94 # λ của EWMA (RiskMetrics)
+    RISK_PRIOR_CORRELATION = 0.3 # tương quan khởi tạo giữa mã mới và các mã đã theo dõi
 
     # --- NÂNG CẤP: Turnover Control ---
     USE_TURNOVER_CONTROL = True # Bật/tắt cơ chế kiểm soát
@@ -32,58 +48,513 @@ class StrategyConfig:
     COMMISSION_RATE = 0.0015
     SELL_TAX_RATE = 0.001
     SLIPPAGE_RATE = 0.0005
+
+    # Execution / Liquidity (xem fill_orders)
+    # Giá trị khớp tối đa mỗi phiên của một lệnh = tỷ lệ này * avg_vnd_volume; None = khớp toàn bộ
+    MAX_PARTICIPATION_RATE = None
+    # Tác động giá: giá khớp = open * (1 ± hệ số * sqrt(giá trị khớp / avg_vnd_volume)); 0 = tắt
+    PRICE_IMPACT_COEF = 0.0
+    # Lệnh mua mới chưa khớp được cổ phiếu nào được giữ tiếp tối đa số phiên này (xem decide_trades)
+    MAX_CARRY_DAYS = 5
     
     # Initial Capital
     INITIAL_CAPITAL = 100_000_000
 
+    # Data Cleaning (xem clean_price_data)
+    # Biến động close/prev_close vượt ±ngưỡng này (biên độ sàn tối đa 15%) bị coi là nghi tách/gộp cổ phiếu
+    SPLIT_JUMP_THRESHOLD = 0.4 # CANNOT CHANGE AFTER LOADING
+    # Mặc định chỉ gắn cờ (báo cáo chất lượng dữ liệu); True = điều chỉnh ngược các bước nhảy giống tách/gộp:
+    # tỷ lệ giá gần số nguyên (sai lệch tương đối <= SPLIT_RATIO_TOLERANCE, ~biên độ giá trong ngày) hoặc
+    # khối lượng SPLIT_VOLUME_WINDOW phiên sau / trước bước nhảy đổi đúng theo tỷ lệ đó (±SPLIT_VOLUME_TOLERANCE)
+    ADJUST_SUSPECTED_SPLITS = False # CANNOT CHANGE AFTER LOADING
+    SPLIT_RATIO_TOLERANCE = 0.07 # CANNOT CHANGE AFTER LOADING
+    SPLIT_VOLUME_WINDOW = 20 # CANNOT CHANGE AFTER LOADING
+    SPLIT_VOLUME_TOLERANCE = 0.5 # CANNOT CHANGE AFTER LOADING
+
+def config_to_dict(config):
+    """Toàn bộ tham số (chữ in hoa) của config, gồm cả giá trị mặc định của class."""
+    return {k: getattr(config, k) for k in dir(config) if k.isupper()}
+
+def load_config(path=None, overrides=None):
+    """
+    Tạo StrategyConfig từ file và/hoặc các giá trị ghi đè.
+
+    Args:
+        path: file .json ({"REBALANCE_THRESHOLD": 0.003, ...}) hoặc file .py định nghĩa
+              class StrategyConfig (vd best_conf.py)
+        overrides: dict {tên tham số: giá trị}, áp dụng sau file
+    """
+    config = StrategyConfig()
+    values = {}
+    if path:
+        if path.endswith('.py'):
+            import runpy
+            conf_class = runpy.run_path(path)['StrategyConfig']
+            values = config_to_dict(conf_class)
+        else:
+            import json
+            with open(path, encoding='utf-8') as f:
+                values = json.load(f)
+    values.update(overrides or {})
+    for key, value in values.items():
+        if not hasattr(StrategyConfig, key):
+            raise ValueError(f"Tham số không tồn tại trong StrategyConfig: {key}")
+        setattr(config, key, value)
+    return config
+
 # ==============================================================================
 # BƯỚC 2: CHUẨN BỊ VÀ XỬ LÝ DỮ LIỆU (Không đổi)
 # ==============================================================================
-def calculate_indicators(df, config):
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+
+def _split_like(close, volume, jumps, config):
+    # Với mỗi bước nhảy (vị trí trong close), có giống tách/gộp cổ phiếu không: tỷ lệ giá gần số nguyên
+    # hoặc khối lượng (trung vị SPLIT_VOLUME_WINDOW phiên sau / trước) đổi ngược chiều giá đúng tỷ lệ đó
+    window = config.SPLIT_VOLUME_WINDOW
+    result = np.zeros(len(jumps), dtype=bool)
+    for k, t in enumerate(jumps):
+        ratio = close[t - 1] / close[t] # tách 1:2 → 2, gộp 2:1 → 0.5
+        factor = max(ratio, 1 / ratio)
+        if abs(factor - round(factor)) <= config.SPLIT_RATIO_TOLERANCE * factor:
+            result[k] = True
+            continue
+        before, after = np.median(volume[max(0, t - window):t]), np.median(volume[t:t + window])
+        if before > 0 and after > 0:
+            result[k] = abs(np.log(after / before) - np.log(ratio)) <= np.log1p(config.SPLIT_VOLUME_TOLERANCE)
+    return result
+
+def clean_price_data(df, config, split_dates=None, adjust_dates=None):
+    """
+    Kiểm tra và sửa dữ liệu giá thô của MỘT mã (vector hóa), trước calculate_indicators:
+        1. Ngày trùng lặp: giữ dòng cuối cùng.
+        2. Giá <= 0 hoặc NaN: close lấy giá hợp lệ gần nhất trước đó (ffill, đầu chuỗi thì bfill);
+           open/high/low lấy close. Khối lượng âm / NaN → 0.
+        3. OHLC mâu thuẫn: high = max(open, high, low, close), low = min(...).
+        4. Nghi tách/gộp cổ phiếu chưa điều chỉnh: |close/prev_close - 1| vượt SPLIT_JUMP_THRESHOLD
+           (theo log, đối xứng hai chiều) → chỉ gắn cờ. Nếu ADJUST_SUSPECTED_SPLITS, các bước nhảy
+           giống tách/gộp (xem _split_like; giá sập thật thường không thỏa) được điều chỉnh ngược
+           toàn bộ giá (và khối lượng) trước bước nhảy theo đúng tỷ lệ nhảy.
+
+    split_dates: list nhận thêm ngày của các bước nhảy đã được điều chỉnh (nếu truyền vào)
+    adjust_dates: điều chỉnh đúng các ngày này thay vì tự xét (đọc một khoảng ngày: giữ nguyên quyết định
+                  của lần đọc toàn bộ lịch sử, xem _prepare_ticker_file)
+
+    Returns:
+        (df đã sửa, dict số dòng bị gắn cờ theo từng loại lỗi)
+    """
+    df = df.sort_values('time', kind='stable')
+    duplicated = df['time'].duplicated(keep='last').to_numpy()
+    df = df[~duplicated].reset_index(drop=True)
+
+    prices = df[PRICE_COLUMNS].to_numpy(dtype=np.float64, copy=True)
+    invalid = ~(prices > 0)
+    if invalid[:, 3].all():
+        raise ValueError("Không có giá đóng cửa hợp lệ nào.")
+    close = pd.Series(np.where(invalid[:, 3], np.nan, prices[:, 3])).ffill().bfill().to_numpy()
+    prices[:, 3] = close
+    prices[:, :3] = np.where(invalid[:, :3], close[:, None], prices[:, :3])
+
+    high, low = prices.max(axis=1), prices.min(axis=1)
+    inconsistent = (prices[:, 1] != high) | (prices[:, 2] != low)
+    prices[:, 1], prices[:, 2] = high, low
+
+    volume = df['volume'].to_numpy(dtype=np.float64, copy=True)
+    invalid_volume = ~(volume >= 0)
+    volume[invalid_volume] = 0
+
+    log_jump = np.abs(np.diff(np.log(close), prepend=np.log(close[:1])))
+    suspected_split = log_jump > np.log1p(config.SPLIT_JUMP_THRESHOLD)
+    adjusted = np.zeros(len(df), dtype=bool)
+    if adjust_dates is not None:
+        adjusted = df['time'].isin(pd.DatetimeIndex(adjust_dates)).to_numpy().copy()
+        adjusted[0] = False
+    elif config.ADJUST_SUSPECTED_SPLITS and suspected_split.any():
+        jumps = np.flatnonzero(suspected_split)
+        adjusted[jumps[_split_like(close, volume, jumps, config)]] = True
+    if split_dates is not None:
+        split_dates.extend(df['time'].to_numpy()[adjusted])
+    if adjusted.any():
+        # Hệ số của mỗi dòng = tích các tỷ lệ nhảy xảy ra SAU dòng đó
+        jump_ratio = np.where(adjusted, close / np.roll(close, 1), 1.0)
+        factor = np.append(np.cumprod(jump_ratio[::-1])[::-1][1:], 1.0)
+        prices *= factor[:, None]
+        volume /= factor
+
+    df[PRICE_COLUMNS] = prices
+    df['volume'] = volume
+    report = {
+        'rows': len(df),
+        'duplicate_dates': int(duplicated.sum()),
+        'invalid_prices': int(invalid.any(axis=1).sum()),
+        'ohlc_inconsistent': int(inconsistent.sum()),
+        'invalid_volume': int(invalid_volume.sum()),
+        'suspected_splits': int(suspected_split.sum()),
+        'adjusted_splits': int(adjusted.sum()),
+    }
+    return df, report
+
+def aggregate_daily(bars):
+    """Gộp nến trong phiên (time, open, high, low, close, volume) đã sắp xếp theo time thành nến ngày."""
+    days = bars['time'].dt.normalize().to_numpy()
+    first = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    last = np.r_[first[1:], len(days)] - 1
+    return pd.DataFrame({
+        'time': days[first],
+        'open': bars['open'].to_numpy()[first],
+        'high': np.maximum.reduceat(bars['high'].to_numpy(), first),
+        'low': np.minimum.reduceat(bars['low'].to_numpy(), first),
+        'close': bars['close'].to_numpy()[last],
+        'volume': np.add.reduceat(bars['volume'].to_numpy(), first),
+    })
+
+def calculate_indicators(df, config, ath_seed=None):
+    # Giả định df đã qua clean_price_data: giá > 0, không trùng ngày, nến ngày (nến trong phiên đã được
+    # aggregate_daily gộp lại nên volatility luôn năm hóa theo 252 phiên và các cửa sổ *_WINDOW tính theo phiên)
+    # ath_seed: đỉnh của phần lịch sử trước df khi chỉ đọc một khoảng ngày (xem load_and_prepare_data)
     df = df.sort_values('time').reset_index(drop=True)
     df['ath'] = df['close'].cummax()
-    df['prev_close'] = df['close'].shift(1)
-    df['prev_close_safe'] = df['prev_close'].fillna(df['close'])
-    df.loc[df['prev_close_safe'] == 0, 'prev_close_safe'] = df['close']
+    if ath_seed is not None:
+        df['ath'] = np.maximum(df['ath'], ath_seed)
+    prev_close = df['close'].shift(1).fillna(df['close'])
     tr1 = df['high'] - df['low']
-    tr2 = abs(df['high'] - df['prev_close_safe'])
-    tr3 = abs(df['low'] - df['prev_close_safe'])
+    tr2 = abs(df['high'] - prev_close)
+    tr3 = abs(df['low'] - prev_close)
     tr = pd.concat([tr1, tr2, tr3], axis=1).max(axis=1)
     df['atr'] = tr.ewm(span=config.ATR_WINDOW, adjust=False).mean()
-    ratio = df['close'] / df['prev_close_safe']
-    ratio[ratio <= 0] = 1 
-    df['daily_return'] = np.log(ratio)
-    df['volatility'] = df['daily_return'].rolling(window=config.VOLATILITY_WINDOW).std() * np.sqrt(252)
-    df['vnd_volume'] = df['volume'] * df['close']
+    daily_return = np.log(df['close'] / prev_close)
+    df['volatility'] = daily_return.rolling(window=config.VOLATILITY_WINDOW).std() * np.sqrt(252)
+    vnd_volume = df['volume'] * df['close']
     df['avg_volume'] = df['volume'].rolling(window=config.AVG_VOLUME_WINDOW).mean()
-    df['avg_vnd_volume'] = df['vnd_volume'].rolling(window=config.AVG_VOLUME_WINDOW).mean()
-    return df.drop(columns=['prev_close', 'daily_return', 'vnd_volume', 'prev_close_safe'])
-
-def load_and_prepare_data(data_path, config):
+    df['avg_vnd_volume'] = vnd_volume.rolling(window=config.AVG_VOLUME_WINDOW).mean()
+    return df
+
+# Các cột run_backtest thực sự đọc sau khi đã tính chỉ báo (chế độ compact chỉ giữ các cột này)
+ENGINE_COLUMNS = ['open', 'close', 'ath', 'atr', 'volatility', 'avg_volume', 'avg_vnd_volume']
+
+def compact_frame(df):
+    """
+    Thu gọn DataFrame đã tính chỉ báo: chỉ giữ ENGINE_COLUMNS và ép về float32.
+
+    Giới hạn sai số (float32 có 24 bit mantissa → sai số tương đối <= 2^-24 ≈ 6e-8):
+        - Giá (VND, < 1e7): sai số tuyệt đối < 0.6 VND, nhỏ hơn nhiều so với bước giá 10-100 VND.
+        - close >= ath giữ nguyên kết quả vì ath = cummax(close) được làm tròn cùng một cách.
+        - atr, volatility, avg_volume, avg_vnd_volume: sai số tương đối <= 6e-8; bộ lọc MIN_AVG_VOLUME chỉ đổi
+          kết quả khi giá trị nằm sát ngưỡng trong phạm vi đó.
+        - Stop-loss ath * (1 - atr/close) ** ATR_MULTIPLIER: sai số tương đối ~1e-6 do đầu vào.
+        - Khối lượng int(weight * nav / close) có thể lệch 1 cổ phiếu khi sát biên làm tròn.
+    Mọi phép tính của engine vẫn bằng float Python (float64) vì giá / chỉ báo được lấy qua to_dict().
+    """
+    return df[['time', 'ticker'] + ENGINE_COLUMNS].astype({col: np.float32 for col in ENGINE_COLUMNS})
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Linux: KB
+
+RAW_COLUMNS = ['time', 'open', 'high', 'low', 'close', 'volume']
+
+# --- Đọc một khoảng ngày (predicate pushdown) ---
+# File CSV mỗi mã đã sắp xếp theo time (download_all_histories) nên có thể tìm nhị phân vị trí byte
+# của ngày bắt đầu / kết thúc và chỉ parse phần đó, cộng thêm warmup_bars() dòng trước from_date.
+# ATH không tính lại được từ phần đã đọc nên được seed từ file mốc trong ATH_CHECKPOINT_DIR (thư mục
+# cache, không ghi vào thư mục dữ liệu gốc): mỗi thư mục dữ liệu + bộ tham số tách/gộp một file, mỗi mã
+# trong file kèm chữ ký (kích thước, mtime) của CSV nên CSV thay đổi thì mã đó được đọc lại toàn bộ.
+ATH_CHECKPOINT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tf_algo', 'ath')
+
+def warmup_bars(config, tolerance=1e-10):
+    """
+    Số nến cần đọc trước from_date để chỉ báo trùng với khi đọc toàn bộ lịch sử:
+    volatility / avg_volume là cửa sổ rolling (đủ cửa sổ + 1 nến cho return là khớp tuyệt đối),
+    ATR là EWM (adjust=False) với trọng số phần lịch sử bị cắt (1 - alpha)^k → đọc tới khi < tolerance
+    (ATR_WINDOW = 42 → ~490 nến, sai số tương đối ~1e-10).
+    """
+    alpha = 2 / (config.ATR_WINDOW + 1)
+    atr_bars = int(np.ceil(np.log(tolerance) / np.log(1 - alpha)))
+    return max(atr_bars, config.VOLATILITY_WINDOW + 1, config.AVG_VOLUME_WINDOW)
+
+def _line_time(line, col):
+    return pd.Timestamp(line.split(b',')[col].strip().strip(b'"').decode())
+
+def _line_at(f, pos, header_end):
+    # Dòng đầy đủ đầu tiên bắt đầu tại hoặc sau vị trí pos: (vị trí bắt đầu, nội dung)
+    if pos <= header_end:
+        f.seek(header_end)
+    else:
+        f.seek(pos - 1)
+        f.readline()
+    start = f.tell()
+    return start, f.readline()
+
+def _find_row(f, target, col, header_end, size, after=False):
+    # Vị trí byte của dòng đầu tiên có time >= target (after=True: time > target); size nếu không có
+    lo, hi = header_end, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start, line = _line_at(f, mid, header_end)
+        if not line.strip() or (_line_time(line, col) > target if after else _line_time(line, col) >= target):
+            hi = mid
+        else:
+            lo = start + len(line)
+    return _line_at(f, lo, header_end)[0]
+
+def _rows_before(f, pos, n, header_end, block=1 << 16):
+    # Vị trí bắt đầu của dòng thứ n trước vị trí pos (pos là đầu một dòng), đọc ngược theo khối
+    need = n + 1 # '\n' ngay trước pos kết thúc dòng liền trước
+    end = pos
+    while end > header_end and n > 0:
+        begin = max(header_end, end - block)
+        f.seek(begin)
+        chunk = f.read(end - begin)
+        k = len(chunk)
+        while True:
+            k = chunk.rfind(b'\n', 0, k)
+            if k < 0:
+                break
+            need -= 1
+            if need == 0:
+                return begin + k + 1
+        end = begin
+    return header_end if n > 0 else pos
+
+def _row_byte_range(filepath, from_date=None, end_date=None, warmup=0):
+    """(dòng tiêu đề, byte bắt đầu, byte kết thúc) của các dòng trong [from_date, end_date] + `warmup` dòng trước đó."""
+    with open(filepath, 'rb') as f:
+        header = f.readline()
+        header_end = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        col = [c.strip().strip('"').lower() for c in header.decode('utf-8-sig').split(',')].index('time')
+        first = _find_row(f, pd.Timestamp(from_date), col, header_end, size) if from_date else header_end
+        stop = _find_row(f, pd.Timestamp(end_date), col, header_end, size, after=True) if end_date else size
+        if first >= stop: # không có dòng nào trong khoảng → không cần đọc cả phần warm-up
+            return header, stop, stop
+        start = _rows_before(f, first, warmup, header_end)
+    return header, start, stop
+
+def read_price_file(filepath, ticker, config, quality_report=None, byte_range=None, split_dates=None, adjust_dates=None):
+    """
+    Đọc 1 file CSV giá thô của một mã (nến ngày hoặc trong phiên), đổi sang VND và làm sạch.
+    byte_range: (tiêu đề, byte bắt đầu, byte kết thúc) từ _row_byte_range → chỉ parse các dòng đó.
+    Trả về None nếu khoảng đó không có dòng nào.
+    """
+    source = filepath
+    if byte_range is not None:
+        header, start, stop = byte_range
+        if start >= stop:
+            return None
+        import io
+        with open(filepath, 'rb') as f:
+            f.seek(start)
+            source = io.BytesIO(header + f.read(stop - start))
+    df = pd.read_csv(source, usecols=lambda c: c.lower() in RAW_COLUMNS)
+    df.columns = df.columns.str.lower()
+    df = df[RAW_COLUMNS]
+    df['time'] = pd.to_datetime(df['time'])
+    for col in PRICE_COLUMNS:
+        df[col] = df[col] * 1000.0
+    df, report = clean_price_data(df, config, split_dates, adjust_dates)
+    if quality_report is not None:
+        quality_report.append({'ticker': ticker, **report})
+    return df
+
+def _file_signature(filepath):
+    st = os.stat(filepath)
+    return [st.st_size, st.st_mtime_ns]
+
+def _checkpoint_entry(filepath, df, split_dates):
+    # Mốc ATH của một mã từ toàn bộ lịch sử đã làm sạch: các dòng lập đỉnh mới (time, ath)
+    # + các ngày tách/gộp đã điều chỉnh (điều chỉnh ngược làm đổi giá mọi dòng trước đó)
+    close = df['close'].to_numpy()
+    records = np.flatnonzero(close > np.r_[-np.inf, np.maximum.accumulate(close)[:-1]])
+    return {
+        'file': _file_signature(filepath),
+        'records': [[str(t), float(a)] for t, a in zip(df['time'].to_numpy()[records].astype('datetime64[s]'), close[records])],
+        'splits': [str(pd.Timestamp(t)) for t in sorted(split_dates)],
+    }
+
+def _ath_checkpoint_path(data_path, key, checkpoint_dir=None):
+    # Tên file = băm (đường dẫn thật của thư mục dữ liệu, tham số tách/gộp)
+    import hashlib
+    import json
+    digest = hashlib.sha256(json.dumps([os.path.realpath(data_path), key]).encode()).hexdigest()[:16]
+    return os.path.join(checkpoint_dir or ATH_CHECKPOINT_DIR, f'{digest}.json')
+
+def _load_ath_checkpoint(data_path, config, checkpoint_dir=None):
+    key = [config.SPLIT_JUMP_THRESHOLD, config.ADJUST_SUSPECTED_SPLITS, config.SPLIT_RATIO_TOLERANCE,
+           config.SPLIT_VOLUME_WINDOW, config.SPLIT_VOLUME_TOLERANCE]
+    path = _ath_checkpoint_path(data_path, key, checkpoint_dir)
+    try:
+        import json
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('key') == key:
+            return dict(checkpoint, path=path)
+    except (OSError, ValueError):
+        pass
+    return {'key': key, 'tickers': {}, 'path': path}
+
+def _save_ath_checkpoint(checkpoint):
+    import json
+    import tempfile
+    path = checkpoint.pop('path')
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Không ghi được file mốc ATH: {e}")
+
+def _prepare_ticker_file(filepath, ticker, config, categories=None, quality_report=None, interval='1D',
+                         from_date=None, end_date=None, checkpoint=None):
+    # Đọc 1 file CSV của một mã, làm sạch và tính chỉ báo.
+    # categories: danh sách mã dùng chung → cột ticker dạng categorical (chế độ compact)
+    # quality_report: list nhận thêm một dòng báo cáo chất lượng dữ liệu của mã này
+    # interval: khung nến của file; nến trong phiên được gộp thành nến ngày trước khi tính chỉ báo
+    # from_date / end_date: chỉ trả về các dòng trong khoảng này. Với nến ngày và mốc ATH còn hợp lệ trong
+    #     checkpoint, chỉ đọc khoảng đó + warmup_bars(); ngược lại đọc toàn bộ (và cập nhật checkpoint).
+    entry = None
+    if checkpoint is not None and interval == '1D':
+        entry = checkpoint['tickers'].get(ticker)
+        if entry is not None and (entry['file'] != _file_signature(filepath) or
+                                  (end_date and entry['splits'] and pd.Timestamp(entry['splits'][-1]) > pd.Timestamp(end_date))):
+            entry = None
+
+    ath_seed = None
+    if entry is not None:
+        byte_range = _row_byte_range(filepath, from_date, end_date, warmup_bars(config))
+        # Điều chỉnh đúng các ngày tách/gộp mà lần đọc toàn bộ đã quyết định (cửa sổ khối lượng
+        # quanh bước nhảy có thể bị cắt ở đầu khoảng đọc)
+        df = read_price_file(filepath, ticker, config, quality_report, byte_range=byte_range, adjust_dates=entry['splits'])
+        if df is None:
+            return None
+        first_time = str(df['time'].iloc[0].to_datetime64().astype('datetime64[s]'))
+        before = [a for t, a in entry['records'] if t < first_time]
+        ath_seed = before[-1] if before else None
+    else:
+        split_dates = []
+        df = read_price_file(filepath, ticker, config, quality_report, split_dates=split_dates)
+        if checkpoint is not None and interval == '1D':
+            checkpoint['tickers'][ticker] = _checkpoint_entry(filepath, df, split_dates)
+            checkpoint['dirty'] = True
+
+    if interval != '1D':
+        df = aggregate_daily(df)
+    if categories is not None:
+        # Cùng một danh sách categories cho mọi mã → concat vẫn giữ kiểu categorical
+        code = categories.index(ticker)
+        df['ticker'] = pd.Categorical.from_codes(np.full(len(df), code), categories=categories)
+    else:
+        df['ticker'] = ticker
+    df = calculate_indicators(df, config, ath_seed=ath_seed)
+    if from_date or end_date:
+        in_range = np.ones(len(df), dtype=bool)
+        if from_date:
+            in_range &= (df['time'] >= pd.Timestamp(from_date)).to_numpy()
+        if end_date:
+            in_range &= (df['time'] <= pd.Timestamp(end_date)).to_numpy()
+        df = df[in_range].reset_index(drop=True)
+        if df.empty:
+            return None
+    return df
+
+def _write_quality_report(quality_report, path=None):
+    # In tổng số dòng bị sửa theo từng loại lỗi; ghi chi tiết theo mã ra CSV nếu có path
+    report = pd.DataFrame(quality_report)
+    if report.empty:
+        return report
+    issues = report.drop(columns=['ticker', 'rows']).sum()
+    flagged = report[report.drop(columns=['ticker', 'rows']).sum(axis=1) > 0]
+    print(f"Kiểm tra dữ liệu: {len(flagged)}/{len(report)} mã có lỗi đã được sửa "
+          f"({', '.join(f'{name}={count}' for name, count in issues.items())}).")
+    if path:
+        report.to_csv(path, index=False)
+        print(f"Đã ghi báo cáo chất lượng dữ liệu: {path}")
+    return report
+
+def load_and_prepare_data(data_path, config, compact=False, quality_report_path=None, interval='1D', from_date=None, end_date=None,
+                          checkpoint_dir=None):
+    # compact=True: mã CP dạng categorical (mã số nguyên), float32, chỉ giữ ENGINE_COLUMNS.
+    # Xem compact_frame() cho giới hạn sai số.
+    # quality_report_path: file CSV báo cáo chất lượng dữ liệu theo mã (xem clean_price_data)
+    # interval: khung nến của các file CSV ('1D', '1H', '1m'...); nến trong phiên được gộp thành nến ngày,
+    #           dùng intraday.write_bars để giữ nến gốc cho việc xét stop-loss trong phiên
+    # from_date / end_date: chỉ nạp khoảng ngày này (chỉ báo giống khi nạp toàn bộ, xem _prepare_ticker_file).
+    #           Lần đầu đọc toàn bộ để tạo file mốc ATH trong checkpoint_dir (mặc định ATH_CHECKPOINT_DIR).
     all_files = [f for f in os.listdir(data_path) if f.endswith('.csv')]
+    all_tickers = sorted(f.split('.')[0] for f in all_files)
     all_data = []
+    quality_report = []
+    checkpoint = _load_ath_checkpoint(data_path, config, checkpoint_dir) if (from_date or end_date) and interval == '1D' else None
     print("Bắt đầu đọc và xử lý dữ liệu...")
     for filename in tqdm(all_files, desc="Đang xử lý các mã CP"):
         ticker = filename.split('.')[0]
         filepath = os.path.join(data_path, filename)
         try:
-            df = pd.read_csv(filepath)
-            df.columns = df.columns.str.lower()
-            df = df[['time', 'open', 'high', 'low', 'close', 'volume']]
-            df['time'] = pd.to_datetime(df['time'])
-            df['ticker'] = ticker
-            price_cols = ['open', 'high', 'low', 'close']
-            for col in price_cols:
-                df[col] = df[col] * 1000.0
-            df_with_indicators = calculate_indicators(df, config)
+            df_with_indicators = _prepare_ticker_file(filepath, ticker, config, categories=all_tickers if compact else None,
+                                                      quality_report=quality_report, interval=interval,
+                                                      from_date=from_date, end_date=end_date, checkpoint=checkpoint)
+            if df_with_indicators is None:
+                continue
+            if compact:
+                df_with_indicators = compact_frame(df_with_indicators)
             all_data.append(df_with_indicators)
         except Exception as e:
             print(f"Lỗi khi xử lý file {filename}: {e}")
+    if checkpoint is not None and checkpoint.pop('dirty', False):
+        _save_ath_checkpoint(checkpoint)
     full_df = pd.concat(all_data, ignore_index=True)
+    del all_data
     full_df = full_df.sort_values(by=['time', 'ticker']).reset_index(drop=True)
     print(f"\nXử lý dữ liệu hoàn tất. Tổng cộng {full_df['ticker'].nunique()} mã cổ phiếu.")
     print(f"Dữ liệu từ {full_df['time'].min().date()} đến {full_df['time'].max().date()}.")
-    return full_df.set_index(['time', 'ticker'])
+    _write_quality_report(quality_report, quality_report_path)
+    full_df = full_df.set_index(['time', 'ticker'])
+    peak_rss = _peak_rss_mb()
+    if peak_rss is not None:
+        print(f"Dung lượng dữ liệu: {full_df.memory_usage(deep=True).sum() / 2**20:,.1f} MB | RAM đỉnh của tiến trình: {peak_rss:,.1f} MB")
+    return full_df
+
+def prepare_store(data_path, folder, config, columns=ENGINE_COLUMNS, dtype=np.float64, quality_report_path=None, interval='1D'):
+    """
+    Chuẩn bị dữ liệu thẳng vào kho panel memory-mapped (xem data_store.py) cho run_backtest_streaming.
+    Xử lý từng mã một nên RAM không phụ thuộc độ dài lịch sử hay số mã.
+    Lượt 1 chỉ đọc cột time để lấy danh sách ngày, lượt 2 tính chỉ báo và ghi từng mã.
+    Chỉ mục sự kiện breakout (xem events.py) được lưu kèm trong thư mục kho.
+    """
+    from data_store import PanelStore, PanelStoreWriter
+
+    all_files = sorted(f for f in os.listdir(data_path) if f.endswith('.csv'))
+    all_dates = set()
+    file_tickers = []
+    for filename in tqdm(all_files, desc="Đang quét ngày giao dịch"):
+        try:
+            times = pd.to_datetime(pd.read_csv(os.path.join(data_path, filename), usecols=lambda c: c.lower() == 'time').iloc[:, 0])
+            all_dates.update(times.dt.normalize() if interval != '1D' else times)
+            file_tickers.append((filename, filename.split('.')[0]))
+        except Exception as e:
+            print(f"Lỗi khi xử lý file {filename}: {e}")
+
+    dates = pd.DatetimeIndex(sorted(all_dates))
+    writer = PanelStoreWriter(folder, dates, sorted(t for _, t in file_tickers), columns, dtype=dtype)
+    quality_report = []
+    for filename, ticker in tqdm(file_tickers, desc="Đang xử lý các mã CP"):
+        try:
+            writer.write_ticker(ticker, _prepare_ticker_file(os.path.join(data_path, filename), ticker, config,
+                                                             quality_report=quality_report, interval=interval))
+        except Exception as e:
+            print(f"Lỗi khi xử lý file {filename}: {e}")
+    writer.close()
+    _write_quality_report(quality_report, quality_report_path)
+    store = PanelStore(folder)
+    if {'close', 'ath', 'volatility'} <= set(columns):
+        from events import BreakoutEvents
+        events = BreakoutEvents.for_store(store)
+        print(f"Chỉ mục breakout: {len(events):,} sự kiện trên {len(events.dates):,} ngày.")
+    print(f"Đã ghi kho {folder}: {len(dates)} ngày × {len(file_tickers)} mã.")
+    return store
 
 # ==============================================================================
 # BƯỚC 3: CLASS QUẢN LÝ DANH MỤC (CẬP NHẬT)
@@ -95,6 +566,8 @@ class Portfolio:
         self.holdings = {}  # { 'FPT': {'quantity': 100, 'entry_price': 120000}, ... }
         self.stop_losses = {} # { 'FPT': 112100, ... }
         self.history = []
+        self.trades = [] # Sổ lệnh đã khớp: { 'date', 'ticker', 'quantity' (+mua / -bán), 'price', 'fee' }
+        self.current_date = None # Ngày giao dịch hiện tại (vòng lặp backtest cập nhật)
 
     def get_stock_value(self, current_prices):
         stock_value = 0
@@ -112,12 +585,17 @@ class Portfolio:
         exposure = (stock_val / nav) if nav > 0 else 0
         self.history.append({'date': date, 'nav': nav, 'cash': self.cash, 'exposure': exposure, 'holdings_count': len(self.holdings)})
 
-    def execute_buy(self, ticker, price, quantity, sl_data=None):
-        cost = price * quantity * (1 + self.config.COMMISSION_RATE + self.config.SLIPPAGE_RATE)
+    def execute_buy(self, ticker, price, quantity, sl_data=None, fee=None):
+        # fee: phí của lệnh do nơi khác tính (vd phần phí được phân bổ sau khi bù trừ lệnh giữa các sleeve, xem sleeves.py)
+        if fee is None:
+            cost = price * quantity * (1 + self.config.COMMISSION_RATE + self.config.SLIPPAGE_RATE)
+        else:
+            cost = price * quantity + fee
         if self.cash < cost:
             print(f"  > [WARNING] Không đủ tiền mặt để mua {quantity} {ticker}.")
             return False
         self.cash -= cost
+        self.trades.append({'date': self.current_date, 'ticker': ticker, 'quantity': quantity, 'price': price, 'fee': cost - price * quantity})
         if ticker in self.holdings:
             # Mua thêm (tái cân bằng)
             total_quantity = self.holdings[ticker]['quantity'] + quantity
@@ -130,19 +608,19 @@ class Portfolio:
             self.holdings[ticker] = {'quantity': quantity, 'entry_price': price}
             print(f"  > MUA MỚI {quantity} {ticker} @ {price:,.0f} VND")
             if sl_data:
-                sl_ath, sl_atr, sl_close = sl_data['ath'], sl_data['atr'], sl_data['close']
-                if sl_close > 0 and pd.notna(sl_atr):
-                    discount_factor = (1 - sl_atr / sl_close) ** self.config.ATR_MULTIPLIER
-                    self.stop_losses[ticker] = sl_ath * discount_factor
-                else:
-                    self.stop_losses[ticker] = price * 0.93
-                    print(f"  > [WARNING] Dữ liệu ATR/Close không hợp lệ cho {ticker}. Đặt SL mặc định.")
+                # Dữ liệu đã qua clean_price_data: close > 0 và atr luôn xác định
+                discount_factor = (1 - sl_data['atr'] / sl_data['close']) ** self.config.ATR_MULTIPLIER
+                self.stop_losses[ticker] = sl_data['ath'] * discount_factor
         return True
 
-    def execute_sell(self, ticker, price, quantity):
+    def execute_sell(self, ticker, price, quantity, fee=None):
         if ticker in self.holdings and self.holdings[ticker]['quantity'] >= quantity:
-            revenue = price * quantity * (1 - self.config.COMMISSION_RATE - self.config.SELL_TAX_RATE - self.config.SLIPPAGE_RATE)
+            if fee is None:
+                revenue = price * quantity * (1 - self.config.COMMISSION_RATE - self.config.SELL_TAX_RATE - self.config.SLIPPAGE_RATE)
+            else:
+                revenue = price * quantity - fee
             self.cash += revenue
+            self.trades.append({'date': self.current_date, 'ticker': ticker, 'quantity': -quantity, 'price': price, 'fee': price * quantity - revenue})
             self.holdings[ticker]['quantity'] -= quantity
             
             action = "BÁN HẾT" if self.holdings[ticker]['quantity'] == 0 else "BÁN BỚT"
@@ -157,6 +635,9 @@ class Portfolio:
 # ==============================================================================
 # BƯỚC 4: LOGIC CHÍNH CỦA BACKTEST (PHIÊN BẢN SỬA LỖI)
 # ==============================================================================
+# Tăng mỗi khi logic mô phỏng thay đổi kết quả → vô hiệu hóa cache kết quả cũ (xem result_cache.py)
+ENGINE_VERSION = 5
+
 def run_backtest_(data, config, from_date=None):
     portfolio = Portfolio(config)
     all_dates = data.index.get_level_values('time').unique().sort_values()
@@ -348,227 +829,487 @@ def run_backtest_(data, config, from_date=None):
 
     return pd.DataFrame(portfolio.history).set_index('date')
 
-def run_backtest(data, config, from_date=None, end_date=None, log_file="backtest_log.txt"):
-    portfolio = Portfolio(config)
-    all_dates = data.index.get_level_values('time').unique().sort_values()
+def _select_dates(all_dates, from_date, end_date, log):
+    # Trả về None nếu không còn ngày nào trong khoảng
+    if from_date:
+        try:
+            if from_date:
+                start_date = pd.to_datetime(from_date)
+                all_dates = all_dates[all_dates >= start_date]
 
-    with open(log_file, "w", encoding="utf-8") as log:
+            if end_date:
+                end_date = pd.to_datetime(end_date)
+                all_dates = all_dates[all_dates <= end_date]
 
-        if from_date:
-            try:
-                if from_date:
-                    start_date = pd.to_datetime(from_date)
-                    all_dates = all_dates[all_dates >= start_date]
-
-                if end_date:
-                    end_date = pd.to_datetime(end_date)
-                    all_dates = all_dates[all_dates <= end_date]
-
-                if len(all_dates) == 0:
-                    log.write(f"Không có dữ liệu nào trong khoảng từ {from_date} đến {end_date}. Dừng backtest.\n")
-                    return pd.DataFrame()
-
-                log.write(f"Backtest sẽ chạy từ ngày: {all_dates[0].date()} đến {all_dates[-1].date()}\n")
-
-            except Exception as e:
-                log.write(f"Lỗi định dạng ngày. Vui lòng dùng 'YYYY-MM-DD'. Lỗi: {e}\n")
-                log.write("Backtest sẽ chạy trên toàn bộ dữ liệu.\n")
-
-        # --- THAY ĐỔI 1: Tách biệt trade_list và sl_data_list ---
-        trade_list = {}
-        sl_data_list = {}
-
-        log.write("\nBắt đầu quá trình backtest...\n")
-        for i in tqdm(range(len(all_dates)), desc="Đang mô phỏng giao dịch"):
-            today = all_dates[i]
-
-            try:
-                daily_open_prices = data.loc[today, 'open'].to_dict()
-            except KeyError:
-                df_temp = data.loc[today]
-                if isinstance(df_temp, pd.Series):
-                    daily_open_prices = {df_temp.name: df_temp['open']}
-                else:
-                    daily_open_prices = df_temp['open'].to_dict()
-
-            sorted_trades = sorted(trade_list.items(), key=lambda item: item[1]) 
-
-            for ticker, quantity_delta in sorted_trades:
-                if ticker in daily_open_prices:
-                    price = daily_open_prices[ticker]
-                    if quantity_delta < 0:
-                        portfolio.execute_sell(ticker, price, abs(quantity_delta))
-                    elif quantity_delta > 0:
-                        sl_data_for_buy = sl_data_list.get(ticker)
-                        portfolio.execute_buy(ticker, price, quantity_delta, sl_data=sl_data_for_buy)
-                else:
-                    log.write(f"[WARNING] Mã {ticker} (quyết định mua | bán): không tìm thấy trong thông tin giá của ngày hiện tại.\n")
-
-            try:
-                daily_close_prices = data.loc[today, 'close'].to_dict()
-            except KeyError:
-                df_temp = data.loc[today]
-                if isinstance(df_temp, pd.Series):
-                    daily_close_prices = {df_temp.name: df_temp['close']}
-                else:
-                    daily_close_prices = df_temp['close'].to_dict()
+            if len(all_dates) == 0:
+                log.write(f"Không có dữ liệu nào trong khoảng từ {from_date} đến {end_date}. Dừng backtest.\n")
+                return None
 
-            portfolio.record_nav(today, daily_close_prices)
-            nav_eod = portfolio.get_total_value(daily_close_prices)
+            log.write(f"Backtest sẽ chạy từ ngày: {all_dates[0].date()} đến {all_dates[-1].date()}\n")
 
-            if i % 100 == 0:
-                log.write(f"\n--- Ngày: {today.date()} ---\n")
-                log.write(f"NAV: {nav_eod:,.0f} VND | Tiền mặt: {portfolio.cash:,.0f} VND | CP: {len(portfolio.holdings)}\n")
+        except Exception as e:
+            log.write(f"Lỗi định dạng ngày. Vui lòng dùng 'YYYY-MM-DD'. Lỗi: {e}\n")
+            log.write("Backtest sẽ chạy trên toàn bộ dữ liệu.\n")
+    return all_dates
+
+def lookup_rows(daily_data_today, tickers, columns):
+    """
+    Tra các cột của `tickers` trong ngày bằng dict vị trí (thay cho isin / reindex / lọc bool của pandas,
+    vốn tốn chi phí cố định đáng kể mỗi lần gọi trên DataFrame nhỏ của chế độ events).
+
+    Returns:
+        (found, values): found[k] = tickers[k] có dòng hôm nay; values[cột] = mảng float64 căn theo `tickers`
+                         (NaN nếu mã không có dòng)
+    """
+    position = {t: k for k, t in enumerate(daily_data_today.index.tolist())}
+    rows = np.fromiter((position.get(t, -1) for t in tickers), dtype=np.int64, count=len(tickers))
+    found = rows >= 0
+    # Cả ngày thành một mảng float64 (mọi cột dữ liệu đều là số): rẻ hơn nhiều so với lấy từng cột
+    names = daily_data_today.columns.tolist()
+    block = daily_data_today.to_numpy(dtype=np.float64)[rows[found]]
+    values = {}
+    for col in columns:
+        values[col] = np.full(len(rows), np.nan)
+        values[col][found] = block[:, names.index(col)]
+    return found, values
+
+def _as_dicts(tickers, found, values, columns):
+    # {mã: giá trị} (float Python, như Series.to_dict) của từng cột, chỉ gồm mã có dòng hôm nay
+    present = [t for t, f in zip(tickers, found.tolist()) if f]
+    return tuple(dict(zip(present, values[col][found].tolist())) for col in columns)
+
+def _eligible(tickers, values, today, config, universe=None):
+    # Mask bước lọc giá / thanh khoản / volatility (hoặc bitmap Universe) cho `tickers` (values: như lookup_rows)
+    if universe is not None:
+        return universe.mask(today, tickers)
+    return (
+        (values['close'] > config.MIN_PRICE_THRESHOLD) &
+        (values['avg_volume'] > config.MIN_AVG_VOLUME) &
+        (values['volatility'] > 0)
+    )
+
+def decide_trades(portfolio, daily_data_today, today, nav_eod, config, log, universe=None, events=None, risk=None, margins=None, pending=None):
+    """
+    (Cuối ngày) Ra quyết định cho ngày mai: bước A-H.
+    Cập nhật trailing stop-loss trong portfolio.stop_losses.
+    events: BreakoutEvents (xem events.py). Nếu có, chỉ lọc tín hiệu trên các mã có sự kiện
+            breakout hôm nay thay vì cả DataFrame của ngày.
+    risk: EwmaCovariance (xem risk.py) khi SIZING_MODE == 'portfolio_vol'.
+    margins: dict nhận các đại lượng quyết định so với ngưỡng (xem replay.py): 'n_holdings',
+             'total_weight' (trước khi chặn MAX_LEVERAGE), 'rebalance' (giá trị lệnh tái cân bằng của mã đang nắm giữ)
+    pending: {mã: dữ liệu stop-loss} của lệnh mua mới hôm trước chưa khớp được cổ phiếu nào (giới hạn thanh khoản).
+             Mã được giữ tiếp như một tín hiệu (định cỡ lại cùng các mã mục tiêu, tính cả vào tổng trọng số và
+             MAX_LEVERAGE) nếu tín hiệu còn hiệu lực (mã vẫn qua bộ lọc hôm nay, close chưa thủng stop-loss tính
+             từ ngày tín hiệu) và chưa giữ quá MAX_CARRY_DAYS phiên; ngược lại bị hủy.
+
+    Returns:
+        (trade_list, sl_data_list): {mã: số lượng +mua/-bán}, {mã: {'ath', 'atr', 'close'}} cho lệnh mua mới
+    """
+    trade_list = {}
+    sl_data_list = {}
+
+    # Đọc một lần thành dict các dòng cần dùng (mã ứng viên + mã đang nắm giữ + lệnh mua chờ) thay vì lọc
+    # DataFrame / tra .loc từng mã: chi phí mỗi ngày theo số mã hoạt động, không theo cả vũ trụ
+    candidates = daily_data_today.index.tolist() if events is None else events.on(today)
+    pending = {t: sl for t, sl in (pending or {}).items() if t not in portfolio.holdings}
+    rows = candidates + list(portfolio.holdings) + list(pending)
+    found, values = lookup_rows(daily_data_today, rows, ('close', 'ath', 'atr', 'volatility', 'avg_volume'))
+    eligible = found & _eligible(rows, values, today, config, universe)
+    close, ath, atr, volatility = _as_dicts(rows, found, values, ('close', 'ath', 'atr', 'volatility'))
+
+    n = len(candidates)
+    signal = eligible[:n] & (values['close'][:n] >= values['ath'][:n])
+    new_signals = [t for t, s in zip(candidates, signal.tolist()) if s and t not in portfolio.holdings]
+
+    carried = {}
+    pending = {t: sl for t, sl in pending.items() if t not in new_signals}
+    still_eligible = {t for t, e in zip(rows[n + len(portfolio.holdings):], eligible[n + len(portfolio.holdings):].tolist()) if e}
+    for ticker, sl_data in pending.items():
+        stop = sl_data['ath'] * (1 - sl_data['atr'] / sl_data['close']) ** config.ATR_MULTIPLIER
+        if (ticker in still_eligible and sl_data.get('carried', 0) < config.MAX_CARRY_DAYS
+                and close[ticker] >= stop):
+            carried[ticker] = dict(sl_data, carried=sl_data.get('carried', 0) + 1)
+        else:
+            log.write(f"[INFO] Hủy lệnh mua chưa khớp {ticker}: tín hiệu hết hiệu lực hoặc đã giữ quá {config.MAX_CARRY_DAYS} phiên.\n")
+    signals = new_signals + sorted(carried)
+
+    sell_due_to_sl = set()
+    for ticker, position in list(portfolio.holdings.items()):
+        if ticker in close:
+            if close[ticker] < portfolio.stop_losses.get(ticker, float('inf')):
+                sell_due_to_sl.add(ticker)
+        else:
+            log.write(f"[WARNING] Mã {ticker} (holding): không tìm thấy trong thông tin giá của ngày hiện tại.\n")
+
+    current_holdings_to_keep = [t for t in portfolio.holdings.keys() if t not in sell_due_to_sl]
+    target_portfolio_tickers = sorted(list(set(current_holdings_to_keep + signals)))
+
+    if not target_portfolio_tickers:
+        for ticker, pos in portfolio.holdings.items():
+            trade_list[ticker] = -pos['quantity']
+        return trade_list, sl_data_list
+
+    n_holdings = len(target_portfolio_tickers)
+    if margins is not None:
+        margins['n_holdings'] = n_holdings
+    target_weights = {}
+    total_weight = 0
+    for ticker in target_portfolio_tickers:
+        if ticker in volatility:
+            vol = volatility[ticker]
+            if vol > 0: # NaN (chưa đủ VOLATILITY_WINDOW phiên) cũng không thỏa
+                weight = (config.TARGET_VOLATILITY / vol) * (1 / max(config.MIN_ASSUMED_HOLDINGS, n_holdings))
+                target_weights[ticker] = weight
+                total_weight += weight
+            else:
+                log.write(f"[INFO] Mã {ticker} có volatility trong n ngày không hợp lệ.\n")
+        else:
+            if ticker not in signals:
+                log.write(f"[WARNING] Mã {ticker} (tín hiệu mua): không tìm thấy trong thông tin giá của ngày hiện tại.\n")
+
+    if risk is not None and target_weights:
+        scale = risk.scale_weights(target_weights, volatility, close, config.PORTFOLIO_TARGET_VOLATILITY)
+        target_weights = {t: w * scale for t, w in target_weights.items()}
+        total_weight *= scale
+
+    if margins is not None:
+        margins['total_weight'] = total_weight
+    if total_weight > config.MAX_LEVERAGE:
+        correction_factor = config.MAX_LEVERAGE / total_weight
+        target_weights = {t: w * correction_factor for t, w in target_weights.items()}
+
+    for ticker in set(list(portfolio.holdings.keys()) + target_portfolio_tickers):
+        current_quantity = portfolio.holdings.get(ticker, {}).get('quantity', 0)
+        target_weight = target_weights.get(ticker, 0)
+        estimated_price = close.get(ticker, 0) # 0: mã không giao dịch hôm nay
+
+        target_quantity = 0
+        if estimated_price > 0:
+            target_quantity = int((target_weight * nav_eod) / estimated_price)
+
+        quantity_delta = target_quantity - current_quantity
+
+        if config.USE_TURNOVER_CONTROL:
+            trade_value = abs(quantity_delta) * estimated_price if estimated_price > 0 else 0
+            if ticker in portfolio.holdings:
+                if margins is not None and quantity_delta != 0:
+                    margins['rebalance'].append(trade_value)
+                weight_change_threshold = config.REBALANCE_THRESHOLD * nav_eod
+                if trade_value < weight_change_threshold:
+                    # log.write(f"[INFO] Bỏ qua tái cân bằng mã {ticker}: {trade_value} < {weight_change_threshold}.\n")
+                    continue
 
-            if nav_eod <= 0:
-                log.write("NAV âm! Dừng backtest.\n")
-                break
+        if quantity_delta != 0:
+            trade_list[ticker] = quantity_delta
+            if ticker in carried and quantity_delta > 0:
+                sl_data_list[ticker] = carried[ticker]
+            elif ticker in new_signals and quantity_delta > 0:
+                sl_data_list[ticker] = {'ath': ath[ticker], 'atr': atr[ticker], 'close': close[ticker]}
 
-            trade_list.clear()
-            sl_data_list.clear()
-            
-            daily_data_today = data.loc[today]
+    for ticker in current_holdings_to_keep:
+        if ticker not in close:
+            continue
+        new_sl_candidate = ath[ticker] * ((1 - atr[ticker] / close[ticker]) ** config.ATR_MULTIPLIER)
+        if new_sl_candidate > portfolio.stop_losses.get(ticker, 0):
+            portfolio.stop_losses[ticker] = new_sl_candidate
+
+
+    return trade_list, sl_data_list
+
+def _limit_fills(quantity, base, present, avg_value, config, used=0):
+    # MAX_PARTICIPATION_RATE / PRICE_IMPACT_COEF trên giá cơ sở `base` (giá mở cửa, giá stop trong phiên);
+    # used: số cổ phiếu mỗi lệnh đã khớp trước đó trong cùng phiên, trừ vào hạn mức của phiên
+    filled, prices = quantity, base
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if config.MAX_PARTICIPATION_RATE is not None:
+            cap = np.where(present, np.floor(config.MAX_PARTICIPATION_RATE * avg_value / base), 0).astype(np.int64)
+            filled = np.sign(quantity) * np.minimum(np.abs(quantity), np.maximum(cap - used, 0))
+        if config.PRICE_IMPACT_COEF:
+            participation = np.where(avg_value > 0, np.abs(filled) * base / avg_value, 0.0)
+            prices = base * (1 + np.sign(filled) * config.PRICE_IMPACT_COEF * np.sqrt(participation))
+    return filled, prices
+
+def fill_orders(trade_list, daily_data_today, config):
+    """
+    (Đầu ngày) Tính phần khớp của các lệnh chờ tại giá mở cửa, vector hóa trên toàn bộ lệnh.
+        - MAX_PARTICIPATION_RATE: mỗi lệnh khớp tối đa MAX_PARTICIPATION_RATE * avg_vnd_volume (VND)
+          trong một phiên, phần còn lại trả về để chuyển sang phiên sau.
+        - PRICE_IMPACT_COEF: giá khớp = open * (1 ± hệ số * sqrt(giá trị khớp / avg_vnd_volume)),
+          mua cao hơn / bán thấp hơn giá mở cửa.
+    Mặc định (None, 0) mọi lệnh khớp toàn bộ đúng giá mở cửa như trước.
+
+    Returns:
+        (fills, remainders, missing):
+            [(mã, số lượng khớp +mua/-bán, giá khớp)] theo thứ tự bán trước mua sau,
+            {mã: số lượng chưa khớp}, [mã không có giá hôm nay]
+    """
+    orders = sorted(trade_list.items(), key=lambda item: item[1])
+    tickers = [ticker for ticker, _ in orders]
+    quantity = np.array([q for _, q in orders], dtype=np.int64)
+    limited = config.MAX_PARTICIPATION_RATE is not None or config.PRICE_IMPACT_COEF
+    _, values = lookup_rows(daily_data_today, tickers, ('open', 'avg_vnd_volume') if limited else ('open',))
+    opens = values['open']
+    present = ~np.isnan(opens)
+    filled = quantity
+    prices = opens
+
+    if limited:
+        # avg_vnd_volume NaN (chưa đủ AVG_VOLUME_WINDOW phiên) → coi như không có thanh khoản
+        filled, prices = _limit_fills(quantity, opens, present, np.nan_to_num(values['avg_vnd_volume']), config)
+
+    executable = present & (filled != 0)
+    fills = list(zip([tickers[k] for k in np.flatnonzero(executable)], filled[executable].tolist(), prices[executable].tolist()))
+    unfilled = present & (filled != quantity)
+    remainders = dict(zip([tickers[k] for k in np.flatnonzero(unfilled)], (quantity - filled)[unfilled].tolist()))
+    missing = [tickers[k] for k in np.flatnonzero(~present)]
+    return fills, remainders, missing
+
+def stop_fills(exits, portfolio, daily_data_today, config, session_fills=()):
+    """
+    (Trong phiên) Phần khớp của lệnh bán toàn bộ các mã chạm stop-loss `exits` [(mã, giá stop)] (xem
+    IntradayBars.stop_exits), theo cùng mô hình thanh khoản với fill_orders: giá cơ sở là giá stop thay cho
+    giá mở cửa, hạn mức MAX_PARTICIPATION_RATE của phiên đã trừ phần mã đó khớp lúc mở cửa (session_fills).
+    Phần chưa khớp vẫn nằm trong danh mục và được xét lại cuối ngày như mọi mã nắm giữ.
+
+    Returns:
+        [(mã, số lượng khớp (âm), giá khớp)] theo thứ tự của `exits`
+    """
+    tickers = [ticker for ticker, _ in exits]
+    quantity = -np.array([portfolio.holdings[t]['quantity'] for t in tickers], dtype=np.int64)
+    prices = np.array([price for _, price in exits], dtype=np.float64)
+    filled = quantity
+    if config.MAX_PARTICIPATION_RATE is not None or config.PRICE_IMPACT_COEF:
+        found, values = lookup_rows(daily_data_today, tickers, ('avg_vnd_volume',))
+        used = {}
+        for ticker, q, _ in session_fills:
+            used[ticker] = used.get(ticker, 0) + abs(q)
+        used = np.array([used.get(t, 0) for t in tickers], dtype=np.int64)
+        filled, prices = _limit_fills(quantity, prices, found, np.nan_to_num(values['avg_vnd_volume']), config, used)
+    return [(t, q, p) for t, q, p in zip(tickers, filled.tolist(), prices.tolist()) if q != 0]
+
+def initial_state(config):
+    """
+    Trạng thái mô phỏng đầu ngày: danh mục, lệnh chờ khớp (trade_list + dữ liệu stop-loss của lệnh mua mới)
+    và hiệp phương sai EWMA khi SIZING_MODE == 'portfolio_vol'.
+    """
+    risk = None
+    if config.SIZING_MODE == 'portfolio_vol':
+        from risk import EwmaCovariance
+        risk = EwmaCovariance(config)
+    elif config.SIZING_MODE != 'inverse_vol':
+        raise ValueError(f"SIZING_MODE không hợp lệ: {config.SIZING_MODE}")
+    # --- THAY ĐỔI 1: Tách biệt trade_list và sl_data_list ---
+    return {'portfolio': Portfolio(config), 'trade_list': {}, 'sl_data_list': {}, 'risk': risk}
+
+def apply_fills(portfolio, fills, sl_data_list, fees=None):
+    """Thực hiện các lệnh đã khớp [(mã, số lượng +mua/-bán, giá)] theo thứ tự; fees: {mã: phí} ghi đè phí mặc định."""
+    fees = fees or {}
+    for ticker, quantity_delta, price in fills:
+        if quantity_delta < 0:
+            portfolio.execute_sell(ticker, price, -quantity_delta, fee=fees.get(ticker))
+        else:
+            portfolio.execute_buy(ticker, price, quantity_delta, sl_data=sl_data_list.get(ticker), fee=fees.get(ticker))
+
+def day_tickers(states, events, today):
+    """
+    Chế độ events: các mã cần đọc dữ liệu trong ngày — lệnh chờ khớp, mã đang nắm giữ, mã được hiệp phương sai
+    theo dõi và mã có sự kiện breakout. Mọi bước của ngày (khớp lệnh, NAV, stop-loss, quyết định) chỉ dùng các mã này.
+    """
+    tickers = set(events.on(today))
+    for state in states:
+        tickers.update(state['trade_list'])
+        tickers.update(state['portfolio'].holdings)
+        if state['risk'] is not None:
+            tickers.update(state['risk'].tickers)
+    return tickers
+
+def held_prices(daily_data_today, holdings):
+    """Giá đóng cửa hôm nay của các mã trong `holdings` (định giá NAV chỉ trên mã đang nắm giữ)."""
+    tickers = list(holdings)
+    found, values = lookup_rows(daily_data_today, tickers, ('close',))
+    return _as_dicts(tickers, found, values, ('close',))[0]
+
+def sparse_days(source, all_dates):
+    """
+    Chế độ events: sinh (today, read) với read(tickers) trả về DataFrame của ngày chỉ gồm các mã `tickers`
+    (simulate_day gọi với day_tickers), nên chi phí mỗi ngày theo số mã hoạt động thay vì cả vũ trụ.
+    source: DataFrame (time, ticker) của load_and_prepare_data hoặc PanelStore (xem data_store.py).
+    """
+    import functools
+    from data_store import FrameIndex
+
+    index = FrameIndex(source) if isinstance(source, pd.DataFrame) else source
+    positions = index.dates.get_indexer(all_dates)
+    return ((today, functools.partial(index.day_rows, k)) for today, k in zip(all_dates, positions))
+
+def simulate_day(i, today, daily_data_today, state, config, log, universe=None, intraday=None, events=None, margins=None):
+    """
+    Một ngày mô phỏng: khớp lệnh chờ, xét stop-loss trong phiên, ghi NAV rồi ra quyết định cho ngày mai.
+    Cập nhật `state` (xem initial_state) tại chỗ. Trả về False nếu NAV <= 0 (dừng backtest).
+    margins: dict nhận các đại lượng quyết định của ngày (xem decide_trades)
+    """
+    portfolio = state['portfolio']
+    portfolio.current_date = today
+    if callable(daily_data_today): # chế độ events (xem sparse_days)
+        daily_data_today = daily_data_today(day_tickers([state], events, today))
+    fills, remainders, missing = fill_orders(state['trade_list'], daily_data_today, config)
+    for ticker in missing:
+        log.write(f"[WARNING] Mã {ticker} (quyết định mua | bán): không tìm thấy trong thông tin giá của ngày hiện tại.\n")
+    apply_fills(portfolio, fills, state['sl_data_list'])
+
+    if intraday is not None:
+        exits = intraday.stop_exits(today, portfolio.stop_losses, config.INTRADAY_STOP_MODE)
+        for ticker, quantity, price in stop_fills(exits, portfolio, daily_data_today, config, fills):
+            portfolio.execute_sell(ticker, price, -quantity)
+
+    return end_of_day(i, today, daily_data_today, state, remainders, config, log, universe=universe, events=events, margins=margins)
+
+def end_of_day(i, today, daily_data_today, state, remainders, config, log, universe=None, events=None, margins=None):
+    """
+    Phần cuối ngày của simulate_day (sau khi khớp lệnh): ghi NAV, cập nhật hiệp phương sai, ra quyết định
+    cho ngày mai và giữ lại lệnh mua mới chưa khớp (`remainders` của fill_orders).
+    Trả về False nếu NAV <= 0.
+    """
+    portfolio = state['portfolio']
+    sl_data_list, risk = state['sl_data_list'], state['risk']
+    daily_close_prices = held_prices(daily_data_today, portfolio.holdings)
+
+    portfolio.record_nav(today, daily_close_prices)
+    nav_eod = portfolio.get_total_value(daily_close_prices)
+
+    if i % 100 == 0:
+        log.write(f"\n--- Ngày: {today.date()} ---\n")
+        log.write(f"NAV: {nav_eod:,.0f} VND | Tiền mặt: {portfolio.cash:,.0f} VND | CP: {len(portfolio.holdings)}\n")
+
+    if nav_eod <= 0:
+        log.write("NAV âm! Dừng backtest.\n")
+        return False
+
+    if risk is not None:
+        risk.update(held_prices(daily_data_today, risk.tickers))
+    if margins is not None:
+        margins.update(nav_eod=nav_eod, rebalance=[])
+    # Phần chưa khớp do giới hạn thanh khoản: mã đang nắm giữ được decide_trades xét lại từ đầu,
+    # lệnh mua mới chưa khớp được cổ phiếu nào được xét giữ tiếp (kèm dữ liệu stop-loss ngày tín hiệu)
+    pending = {ticker: sl_data_list[ticker] for ticker, quantity_delta in remainders.items()
+               if quantity_delta > 0 and ticker not in portfolio.holdings and ticker in sl_data_list}
+    trade_list, sl_data_list = decide_trades(portfolio, daily_data_today, today, nav_eod, config, log, universe=universe,
+                                             events=events, risk=risk, margins=margins, pending=pending)
+    state['trade_list'], state['sl_data_list'] = trade_list, sl_data_list
+    return True
+
+def simulate_days(days, n_days, config, log, universe=None, on_day=None, intraday=None, events=None, state=None, start=0, on_state=None):
+    """
+    Vòng lặp mô phỏng dùng chung cho mọi nguồn dữ liệu.
+
+    Args:
+        days: iterable các cặp (today, daily_data_today) theo thứ tự ngày,
+              daily_data_today là DataFrame của ngày đó với index là mã CP
+              (chế độ events: hàm đọc theo danh sách mã, xem sparse_days)
+        n_days: số ngày (cho tqdm)
+        universe: Universe (xem universe.py) đã tính sẵn bitmap thành phần + bộ lọc giá/thanh khoản.
+                  Nếu có, bước lọc eligible chỉ còn tra một dòng bitmap thay vì lọc lại theo config.
+        on_day: hàm on_day(today, portfolio, trade_list) gọi sau khi ra quyết định mỗi ngày
+                (ghi trạng thái để so sánh engine, theo dõi tiến độ...)
+        intraday: IntradayBars (xem intraday.py). Nếu có, stop-loss được xét trên từng nến trong phiên
+                  theo INTRADAY_STOP_MODE và bán ngay trong ngày; tái cân bằng vẫn theo ngày.
+        events: BreakoutEvents (xem events.py) tính từ cùng dữ liệu: mỗi ngày chỉ đọc và xét
+                mã đang nắm giữ / có lệnh chờ + mã có sự kiện breakout trong ngày (xem day_tickers).
+        state, start: tiếp tục từ trạng thái đầu ngày `state` (xem initial_state), ngày đầu tiên của `days`
+                      là ngày thứ `start` của lần chạy (xem replay.py)
+        on_state: hàm on_state(today, state, margins) gọi sau mỗi ngày với trạng thái đầu ngày mai
+                  và các đại lượng quyết định của decide_trades
+
+    Returns:
+        Portfolio sau ngày cuối cùng.
+    """
+    state = state or initial_state(config)
+
+    log.write("\nBắt đầu quá trình backtest...\n")
+    for i, (today, daily_data_today) in enumerate(tqdm(days, total=n_days, desc="Đang mô phỏng giao dịch"), start=start):
+        margins = {} if on_state is not None else None
+        if not simulate_day(i, today, daily_data_today, state, config, log, universe=universe, intraday=intraday,
+                            events=events, margins=margins):
+            break
+        if on_day is not None:
+            on_day(today, state['portfolio'], state['trade_list'])
+        if on_state is not None:
+            on_state(today, state, margins)
 
-            sell_due_to_sl = set()
-            for ticker, position in list(portfolio.holdings.items()):
-                if ticker in daily_data_today.index:
-                    if daily_data_today.loc[ticker, 'close'] < portfolio.stop_losses.get(ticker, float('inf')):
-                        sell_due_to_sl.add(ticker)
-                else:
-                    log.write(f"[WARNING] Mã {ticker} (holding): không tìm thấy trong thông tin giá của ngày hiện tại.\n")
-
-            eligible = daily_data_today[
-                (daily_data_today['close'] > config.MIN_PRICE_THRESHOLD) &
-                (daily_data_today['avg_volume'] > config.MIN_AVG_VOLUME) &
-                (daily_data_today['volatility'] > 0)
-            ]
-            new_signals = eligible[
-                (eligible['close'] >= eligible['ath']) &
-                (~eligible.index.isin(portfolio.holdings.keys()))
-            ].index.tolist()
-
-            current_holdings_to_keep = [t for t in portfolio.holdings.keys() if t not in sell_due_to_sl]
-            target_portfolio_tickers = sorted(list(set(current_holdings_to_keep + new_signals)))
-
-            if not target_portfolio_tickers:
-                for ticker, pos in portfolio.holdings.items():
-                    trade_list[ticker] = -pos['quantity']
-                continue
+    return state['portfolio']
 
-            n_holdings = len(target_portfolio_tickers)
-            target_weights = {}
-            total_weight = 0
-            for ticker in target_portfolio_tickers:
-                if ticker in daily_data_today.index:
-                    vol = daily_data_today.loc[ticker, 'volatility']
-                    if pd.notna(vol) and vol > 0:
-                        weight = (config.TARGET_VOLATILITY / vol) * (1 / max(config.MIN_ASSUMED_HOLDINGS, n_holdings))
-                        target_weights[ticker] = weight
-                        total_weight += weight
-                    else:
-                        log.write(f"[INFO] Mã {ticker} có volatility trong n ngày không hợp lệ.\n")
-                else:
-                    if ticker not in new_signals:
-                        log.write(f"[WARNING] Mã {ticker} (tín hiệu mua): không tìm thấy trong thông tin giá của ngày hiện tại.\n")
-
-            if total_weight > config.MAX_LEVERAGE:
-                correction_factor = config.MAX_LEVERAGE / total_weight
-                target_weights = {t: w * correction_factor for t, w in target_weights.items()}
-
-            for ticker in set(list(portfolio.holdings.keys()) + target_portfolio_tickers):
-                current_quantity = portfolio.holdings.get(ticker, {}).get('quantity', 0)
-                target_weight = target_weights.get(ticker, 0)
-
-                if isinstance(daily_data_today, pd.Series):
-                    if ticker == daily_data_today.name:
-                        estimated_price = daily_data_today['close']
-                    else:
-                        estimated_price = 0
-                else:
-                    estimated_price = daily_data_today.loc[ticker, 'close'] if ticker in daily_data_today.index else 0
-
-                target_quantity = 0
-                if estimated_price > 0:
-                    target_quantity = int((target_weight * nav_eod) / estimated_price)
-
-                quantity_delta = target_quantity - current_quantity
-
-                if config.USE_TURNOVER_CONTROL:
-                    trade_value = abs(quantity_delta) * estimated_price if estimated_price > 0 else 0
-                    if ticker in portfolio.holdings:
-                        weight_change_threshold = config.REBALANCE_THRESHOLD * nav_eod
-                        if trade_value < weight_change_threshold:
-                            # log.write(f"[INFO] Bỏ qua tái cân bằng mã {ticker}: {trade_value} < {weight_change_threshold}.\n")
-                            continue
-
-                if quantity_delta != 0:
-                    trade_list[ticker] = quantity_delta
-                    if ticker in new_signals and quantity_delta > 0:
-                        if isinstance(daily_data_today, pd.Series) and ticker == daily_data_today.name:
-                            sl_data_list[ticker] = daily_data_today[['ath', 'atr', 'close']].to_dict()
-                        elif isinstance(daily_data_today, pd.DataFrame):
-                            sl_data_list[ticker] = daily_data_today.loc[ticker, ['ath', 'atr', 'close']].to_dict()
-
-            for ticker in current_holdings_to_keep:
-                if isinstance(daily_data_today, pd.Series) and ticker == daily_data_today.name:
-                    data_row = daily_data_today
-                elif isinstance(daily_data_today, pd.DataFrame) and ticker in daily_data_today.index:
-                    data_row = daily_data_today.loc[ticker]
-                else:
-                    continue
+def run_backtest(data, config, from_date=None, end_date=None, log_file="backtest_log.txt", universe=None, return_portfolio=False, on_day=None, intraday=None, events=None):
+    # return_portfolio=True: trả về (lịch sử NAV, Portfolio) để lấy thêm sổ lệnh portfolio.trades
+    all_dates = data.index.get_level_values('time').unique().sort_values()
 
-                if data_row['close'] > 0 and pd.notna(data_row['atr']):
-                    new_sl_candidate = data_row['ath'] * ((1 - data_row['atr'] / data_row['close']) ** config.ATR_MULTIPLIER)
-                    if new_sl_candidate > portfolio.stop_losses.get(ticker, 0):
-                        portfolio.stop_losses[ticker] = new_sl_candidate
+    with open(log_file, "w", encoding="utf-8") as log:
+        all_dates = _select_dates(all_dates, from_date, end_date, log)
+        if all_dates is None:
+            return (pd.DataFrame(), None) if return_portfolio else pd.DataFrame()
 
-    return pd.DataFrame(portfolio.history).set_index('date')
+        days = sparse_days(data, all_dates) if events is not None else ((today, data.loc[today]) for today in all_dates)
+        portfolio = simulate_days(days, len(all_dates), config, log, universe=universe, on_day=on_day, intraday=intraday, events=events)
 
-#%%
-# ==============================================================================
-# BƯỚC 5: CHẠY CHƯƠNG TRÌNH (Không đổi)
-# ==============================================================================
-DATA_PATH = '/mnt/c/Users/HOME/Downloads/TF-algo-trading/processed_stock_history_backup'
-config = StrategyConfig()
+    results = pd.DataFrame(portfolio.history).set_index('date')
+    return (results, portfolio) if return_portfolio else results
 
-full_data = load_and_prepare_data(DATA_PATH, config)
+def run_backtest_streaming(store, config, from_date=None, end_date=None, log_file="backtest_log.txt", universe=None, chunk_days=250, return_portfolio=False, on_day=None, intraday=None, events=None):
+    """
+    Backtest đọc dữ liệu theo từng khối ngày từ PanelStore (xem data_store.py) đã memory-map.
+    Chỉ khối hiện tại + trạng thái danh mục nằm trong RAM; kết quả giống hệt run_backtest.
+    """
+    with open(log_file, "w", encoding="utf-8") as log:
+        all_dates = _select_dates(store.dates, from_date, end_date, log)
+        if all_dates is None:
+            return (pd.DataFrame(), None) if return_portfolio else pd.DataFrame()
 
-#%%
-config = StrategyConfig()
-config.USE_TURNOVER_CONTROL = True
-config.REBALANCE_THRESHOLD = 0.003
-config.MIN_ASSUMED_HOLDINGS = 20
-# config.MAX_LEVERAGE = 2
-# config.MIN_AVG_VOLUME = 50_000
-from_date=None
-end_date=None
-# from_date="2016-01-01"
-# end_date="2025-03-31"
-results = run_backtest(full_data, config, log_file='/mnt/c/Users/HOME/Downloads/TF-algo-trading/backtest.log', from_date=from_date, end_date=end_date)
+        if events is not None:
+            days = sparse_days(store, all_dates)
+        else:
+            days = store.iter_days(all_dates[0], all_dates[-1], chunk_days=chunk_days)
+        portfolio = simulate_days(days, len(all_dates), config, log, universe=universe, on_day=on_day, intraday=intraday, events=events)
 
-#%%
-print("\n--- KẾT QUẢ BACKTEST ---")
-print(results.tail())
-
-final_nav = results['nav'].iloc[-1]
-initial_nav = config.INITIAL_CAPITAL
-years = (results.index.max() - results.index.min()).days / 365.25
-cagr = ((final_nav / initial_nav) ** (1 / years)) - 1 if years > 0 and initial_nav > 0 else 0
-max_drawdown = (1 - results['nav'] / results['nav'].cummax()).max()
-avg_exposure = results['exposure'].mean()
-avg_holdings = results['holdings_count'].mean()
-
-print(f"\n--- THỐNG KÊ HIỆU SUẤT ---")
-print(f"Vốn ban đầu:      {initial_nav:,.0f} VND")
-print(f"NAV cuối kỳ:       {final_nav:,.0f} VND")
-print(f"Thời gian:         {years:.2f} năm")
-print(f"CAGR:              {cagr:.2%}")
-print(f"Max Drawdown:      {max_drawdown:.2%}")
-print(f"Exposure TB:       {avg_exposure:.2%}")
-print(f"Số lượng CP TB:    {avg_holdings:.1f}")
-
-try:
-    import matplotlib.pyplot as plt
+    results = pd.DataFrame(portfolio.history).set_index('date')
+    return (results, portfolio) if return_portfolio else results
+
+# ==============================================================================
+# BƯỚC 5: THỐNG KÊ & BIỂU ĐỒ
+# ==============================================================================
+def compute_metrics(results, initial_capital):
+    final_nav = results['nav'].iloc[-1]
+    years = (results.index.max() - results.index.min()).days / 365.25
+    cagr = ((final_nav / initial_capital) ** (1 / years)) - 1 if years > 0 and initial_capital > 0 else 0
+    max_drawdown = (1 - results['nav'] / results['nav'].cummax()).max()
+    return {
+        'initial_nav': initial_capital,
+        'final_nav': final_nav,
+        'years': years,
+        'cagr': cagr,
+        'max_drawdown': max_drawdown,
+        'avg_exposure': results['exposure'].mean(),
+        'avg_holdings': results['holdings_count'].mean(),
+    }
+
+def print_metrics(metrics):
+    print(f"\n--- THỐNG KÊ HIỆU SUẤT ---")
+    print(f"Vốn ban đầu:      {metrics['initial_nav']:,.0f} VND")
+    print(f"NAV cuối kỳ:       {metrics['final_nav']:,.0f} VND")
+    print(f"Thời gian:         {metrics['years']:.2f} năm")
+    print(f"CAGR:              {metrics['cagr']:.2%}")
+    print(f"Max Drawdown:      {metrics['max_drawdown']:.2%}")
+    print(f"Exposure TB:       {metrics['avg_exposure']:.2%}")
+    print(f"Số lượng CP TB:    {metrics['avg_holdings']:.1f}")
+
+def plot_results(results, output_path=None):
+    # output_path: lưu ra file ảnh thay vì plt.show() (dùng khi chạy batch)
+    try:
+        import matplotlib
+        if output_path:
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("\nVui lòng cài đặt matplotlib (`pip install matplotlib`) để vẽ biểu đồ.")
+        return
     fig, ax1 = plt.subplots(figsize=(15, 8))
     ax1.plot(results.index, results['nav'], color='blue', label='NAV')
     ax1.set_xlabel('Thời gian')
@@ -576,15 +1317,50 @@ try:
     ax1.tick_params(axis='y', labelcolor='blue')
     ax1.set_yscale('log')
     ax1.set_title('Hiệu suất Chiến lược Trend Following (có Rebalancing)')
-    
+
     ax2 = ax1.twinx()
     ax2.plot(results.index, results['exposure'] * 100, color='red', alpha=0.5, linestyle='--', label='Exposure (%)')
     ax2.set_ylabel('Mức độ tiếp xúc (%)', color='red')
     ax2.tick_params(axis='y', labelcolor='red')
     ax2.axhline(100, color='grey', linestyle=':', linewidth=1)
-    
+
     fig.tight_layout()
-    plt.show()
-except ImportError:
-    print("\nVui lòng cài đặt matplotlib (`pip install matplotlib`) để vẽ biểu đồ.")
+    if output_path:
+        fig.savefig(output_path)
+        plt.close(fig)
+    else:
+        plt.show()
+
+#%%
+# ==============================================================================
+# BƯỚC 6: CHẠY CHƯƠNG TRÌNH (chạy theo cell; import module không chạy phần này)
+# Chạy batch: xem `python cli.py --help`
+# ==============================================================================
+if __name__ == "__main__":
+    DATA_PATH = '/mnt/c/Users/HOME/Downloads/TF-algo-trading/processed_stock_history_backup'
+    config = StrategyConfig()
+
+    full_data = load_and_prepare_data(DATA_PATH, config)
+
+#%%
+if __name__ == "__main__":
+    config = StrategyConfig()
+    config.USE_TURNOVER_CONTROL = True
+    config.REBALANCE_THRESHOLD = 0.003
+    config.MIN_ASSUMED_HOLDINGS = 20
+    # config.MAX_LEVERAGE = 2
+    # config.MIN_AVG_VOLUME = 50_000
+    from_date=None
+    end_date=None
+    # from_date="2016-01-01"
+    # end_date="2025-03-31"
+    results = run_backtest(full_data, config, log_file='/mnt/c/Users/HOME/Downloads/TF-algo-trading/backtest.log', from_date=from_date, end_date=end_date)
+
+#%%
+if __name__ == "__main__":
+    print("\n--- KẾT QUẢ BACKTEST ---")
+    print(results.tail())
+
+    print_metrics(compute_metrics(results, config.INITIAL_CAPITAL))
+    plot_results(results)
 # %%
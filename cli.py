@@ -0,0 +1,520 @@
+import argparse
+import itertools
+import json
+import sys
+
+# ==============================================================================
+# ĐIỂM VÀO DÒNG LỆNH: download | prepare | serve | backtest | sweep | sleeves | optimize | queue | report
+# ==============================================================================
+# Chỉ import thư viện chuẩn ở đầu file; pandas / tqdm / matplotlib / vnstock được
+# import trong từng lệnh để `python cli.py --help` chạy tức thì.
+#
+# Vd:
+#   python cli.py prepare --data processed_stock_history --out store
+#   python cli.py serve --data processed_stock_history --name vn      (máy chủ dữ liệu dùng chung, xem shared_store.py)
+#   python cli.py backtest --store store --config best_conf.py --set MAX_LEVERAGE=2 --from 2016-01-01 --out nav.csv
+#   python cli.py sweep --store store --grid grid.json --out sweep.csv
+#   python cli.py sleeves --store store --sleeves sleeves.json --rebalance-days 63 --out sleeves.csv
+#   python cli.py report nav.csv --plot nav.png
+
+
+def _parse_overrides(items):
+    # "KEY=VALUE" → {KEY: VALUE}; VALUE đọc theo JSON (số, true/false...), không được thì giữ chuỗi
+    overrides = {}
+    for item in items or []:
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise SystemExit(f"--set cần dạng KEY=VALUE, nhận được: {item}")
+        try:
+            overrides[key.strip()] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key.strip()] = value
+    return overrides
+
+
+def _config_from_args(args, extra=None):
+    from backtest_script import load_config
+    overrides = _parse_overrides(args.set)
+    overrides.update(extra or {})
+    return load_config(args.config, overrides)
+
+
+def _make_runner(args, config, progress=None, replay=False):
+    """
+    Trả về hàm run(config, from_date, end_date, log_file) theo nguồn dữ liệu đã chọn.
+    progress: ProgressReporter (xem progress.py) nhận on_day của mỗi lần chạy.
+    replay: chạy lại từ lần chạy tham chiếu của `config` (xem replay.py) thay vì chạy đầy đủ
+    """
+    import backtest_script as bs
+
+    universe = None
+    if getattr(args, 'universe', None):
+        from universe import Universe
+        universe = Universe.load(args.universe)
+
+    intraday = None
+    if getattr(args, 'bars', None):
+        from intraday import IntradayBars
+        intraday = IntradayBars(args.bars)
+
+    from events import BreakoutEvents
+    if args.store:
+        from data_store import PanelStore
+        source = PanelStore(args.store)
+        events = BreakoutEvents.for_store(source)
+        run_backtest = bs.run_backtest_streaming
+        all_dates = source.dates
+    elif getattr(args, 'shared', None):
+        from shared_store import SharedStore
+        shared = SharedStore(args.shared, root=args.shared_root)
+        print(f"Dùng dữ liệu dùng chung {args.shared}/{shared.version}")
+        source, events = shared.store, shared.events
+        run_backtest = bs.run_backtest_streaming
+        all_dates = source.dates
+    else:
+        # Chỉ nạp khoảng ngày của lần chạy (cùng quy ước với _select_dates: --to chỉ có hiệu lực khi có --from)
+        source = bs.load_and_prepare_data(args.data, config, compact=args.compact, interval=args.interval,
+                                          from_date=args.from_date, end_date=args.end_date if args.from_date else None,
+                                          checkpoint_dir=args.ath_checkpoint_dir)
+        events = BreakoutEvents.from_frame(source)
+        run_backtest = bs.run_backtest
+        all_dates = source.index.get_level_values('time').unique()
+
+    cache = None
+    if getattr(args, 'cache', None):
+        from result_cache import ResultCache
+        cache = ResultCache(args.cache, max_bytes=int(args.cache_max_mb * 2**20))
+    if progress is not None:
+        progress.cache = cache
+
+    def run(cfg, from_date, end_date, log_file):
+        on_day = None
+        if progress is not None:
+            # Số ngày (ước lượng, để tính ETA): end_date chỉ có hiệu lực khi có from_date như _select_dates
+            n_days = len(all_dates)
+            if from_date:
+                n_days = ((all_dates >= from_date) & ((all_dates <= end_date) if end_date else True)).sum()
+            progress.begin_run(int(n_days))
+            on_day = progress.on_day
+        if cache is not None:
+            return cache.run_backtest(source, cfg, from_date=from_date, end_date=end_date, log_file=log_file, universe=universe,
+                                      intraday=intraday, events=events, on_day=on_day)['nav']
+        return run_backtest(source, cfg, from_date=from_date, end_date=end_date, log_file=log_file, universe=universe,
+                            intraday=intraday, events=events, on_day=on_day)
+
+    if replay:
+        # Một lần chạy tham chiếu với cấu hình gốc; mỗi cấu hình sau chỉ mô phỏng từ ngày quyết định khác đầu tiên
+        # (xem replay.py). Khoảng ngày luôn là của lần chạy tham chiếu, không dùng cache kết quả.
+        from replay import ReferenceRun
+        reference = ReferenceRun.record(source, config, from_date=args.from_date, end_date=args.end_date, log_file=args.log,
+                                        universe=universe, intraday=intraday, events=events)
+
+        def run_replay(cfg, from_date, end_date, log_file):
+            on_day = None
+            if progress is not None:
+                progress.begin_run(len(reference.dates))
+                on_day = progress.on_day
+            return reference.replay(source, cfg, log_file=log_file, on_day=on_day)
+
+        return run_replay
+    return run
+
+
+def _make_progress(args, total_configs=None, job='backtest'):
+    if not (args.progress or args.metrics_file or args.metrics_port is not None):
+        return None
+    from progress import ProgressReporter
+    return ProgressReporter(json_path=args.progress, prom_path=args.metrics_file, port=args.metrics_port,
+                            interval=args.progress_interval, total_configs=total_configs, job=job)
+
+
+def cmd_download(args):
+    from download_stocks import download_all_histories
+    download_all_histories(
+        symbols=args.symbols or [],
+        start_date=args.start,
+        end_date=args.end,
+        source=args.source,
+        folder=args.folder,
+        interval=args.interval,
+        sleep_time=args.sleep,
+    )
+
+
+def cmd_prepare(args):
+    import numpy as np
+    from backtest_script import prepare_store
+    config = _config_from_args(args)
+    prepare_store(args.data, args.out, config, dtype=np.dtype(args.dtype), quality_report_path=args.quality_report,
+                  interval=args.interval)
+    if args.bars:
+        from intraday import write_bars
+        write_bars(args.data, args.bars, config, interval=args.interval)
+
+
+def cmd_serve(args):
+    import numpy as np
+    from shared_store import serve
+    config = _config_from_args(args)
+    serve(args.data, config, name=args.name, root=args.root, interval=args.interval, dtype=np.dtype(args.dtype),
+          poll=args.poll, once=args.once)
+
+
+def cmd_backtest(args):
+    from backtest_script import compute_metrics, print_metrics
+    config = _config_from_args(args)
+    progress = _make_progress(args, total_configs=1)
+    run = _make_runner(args, config, progress)
+    results = run(config, args.from_date, args.end_date, args.log)
+    if progress is not None:
+        progress.config_done()
+        progress.close()
+    if results.empty:
+        print("Không có kết quả backtest.")
+        return 1
+    if args.out:
+        results.to_csv(args.out)
+        print(f"Đã lưu NAV vào {args.out}")
+    print_metrics(compute_metrics(results, config.INITIAL_CAPITAL))
+
+
+def cmd_sweep(args):
+    import pandas as pd
+    from backtest_script import compute_metrics
+
+    with open(args.grid, encoding='utf-8') as f:
+        grid = json.load(f)
+    keys = list(grid)
+    combos = list(itertools.product(*(grid[k] for k in keys)))
+    print(f"Tổng số cấu hình: {len(combos)}")
+
+    base_config = _config_from_args(args)
+    if args.replay:
+        from replay import MARGIN_KEYS
+        slow = [k for k in keys if k not in MARGIN_KEYS]
+        if slow:
+            print(f"[INFO] --replay: {slow} ngoài MARGIN_KEYS → mô phỏng lại từng ngày, tốn gần như chạy đầy đủ.")
+    progress = _make_progress(args, total_configs=len(combos), job='sweep')
+    run = _make_runner(args, base_config, progress, replay=args.replay)
+    rows = []
+    for values in combos:
+        params = dict(zip(keys, values))
+        config = _config_from_args(args, params)
+        results = run(config, args.from_date, args.end_date, args.log)
+        row = dict(params)
+        if not results.empty:
+            row.update(compute_metrics(results, config.INITIAL_CAPITAL))
+        rows.append(row)
+        if progress is not None:
+            progress.config_done()
+        print(f"{params} → {row.get('cagr', float('nan')):.2%} CAGR")
+    if progress is not None:
+        progress.close()
+
+    table = pd.DataFrame(rows)
+    table.to_csv(args.out, index=False)
+    print(f"Đã lưu kết quả sweep vào {args.out}")
+
+
+def cmd_sleeves(args):
+    import pandas as pd
+    import backtest_script as bs
+    from events import BreakoutEvents
+    from sleeves import Sleeve, run_sleeves
+
+    with open(args.sleeves, encoding='utf-8') as f:
+        specs = json.load(f)
+    sleeves = []
+    for spec in specs:
+        universe = None
+        if spec.get('universe'):
+            from universe import Universe
+            universe = Universe.load(spec['universe'])
+        sleeves.append(Sleeve(spec['name'], _config_from_args(args, spec.get('set')), spec.get('weight', 1.0), universe=universe))
+
+    if args.store:
+        from data_store import PanelStore
+        source = PanelStore(args.store)
+        events = BreakoutEvents.for_store(source)
+    elif args.shared:
+        from shared_store import SharedStore
+        shared = SharedStore(args.shared, root=args.shared_root)
+        source, events = shared.store, shared.events
+    else:
+        source = bs.load_and_prepare_data(args.data, sleeves[0].config, compact=args.compact,
+                                          from_date=args.from_date, end_date=args.end_date if args.from_date else None,
+                                          checkpoint_dir=args.ath_checkpoint_dir)
+        events = BreakoutEvents.from_frame(source)
+
+    combined, per_sleeve = run_sleeves(source, sleeves, from_date=args.from_date, end_date=args.end_date, log_file=args.log,
+                                       rebalance_days=args.rebalance_days, events=events)
+    if combined.empty:
+        print("Không có kết quả backtest.")
+        return 1
+    capital = sleeves[0].config.INITIAL_CAPITAL
+    total_weight = sum(sleeve.weight for sleeve in sleeves)
+    for sleeve in sleeves:
+        # Với --rebalance-days, NAV từng sleeve gồm cả tiền chuyển qua lại giữa các sleeve
+        print(f"\n--- Sleeve {sleeve.name} ---")
+        bs.print_metrics(bs.compute_metrics(per_sleeve[sleeve.name], capital * sleeve.weight / total_weight))
+    print("\n--- Gộp ---")
+    bs.print_metrics(bs.compute_metrics(combined, capital))
+    print(f"Phí giao dịch: {combined['fees'].sum():,.0f} VND (không bù trừ: {combined['fees_unnetted'].sum():,.0f} VND)")
+    if args.out:
+        table = combined.join(pd.DataFrame({f'nav_{name}': results['nav'] for name, results in per_sleeve.items()}))
+        table.to_csv(args.out)
+        print(f"Đã lưu NAV vào {args.out}")
+
+
+def cmd_optimize(args):
+    import backtest_script as bs
+    from optimizer import Optimizer
+
+    config = _config_from_args(args)
+    space = None
+    if args.space:
+        with open(args.space, encoding='utf-8') as f:
+            space = {k: tuple(v) if isinstance(v, list) and len(v) == 3 and v[2] in ('float', 'int', 'log') else v
+                     for k, v in json.load(f).items()}
+    cache = None
+    if args.cache:
+        from result_cache import ResultCache
+        cache = ResultCache(args.cache)
+    full_data = bs.load_and_prepare_data(args.data, config, compact=args.compact)
+    opt = Optimizer(full_data, config, space=space, from_date=args.from_date, end_date=args.end_date,
+                    objective=args.objective, eta=args.eta, min_fraction=args.min_fraction,
+                    fidelity=args.fidelity, budget=args.budget, proposer=args.proposer,
+                    seed=args.seed, cache=cache, drawdown_stop=args.drawdown_stop)
+    table = opt.run(n_brackets=args.brackets)
+    table.to_csv(args.out, index=False)
+    print(f"Đã lưu {len(table)} lần đánh giá vào {args.out}")
+    print(f"Cấu hình tốt nhất: {opt.best_params()}")
+
+
+def _queue_worker(args):
+    import backtest_script as bs
+    import work_queue as wq
+
+    config = _config_from_args(args)
+    if args.store:
+        from data_store import PanelStore
+        source = PanelStore(args.store)
+    elif args.shared:
+        from shared_store import SharedStore
+        source = SharedStore(args.shared, root=args.shared_root).store
+    else:
+        source = bs.load_and_prepare_data(args.data, config, compact=args.compact)
+    cache = None
+    if args.cache:
+        from result_cache import ResultCache
+        cache = ResultCache(args.cache)
+    done = wq.run_worker(args.queue, source, config, lease_timeout=args.lease, poll_interval=args.poll,
+                         exit_when_empty=not args.forever, cache=cache)
+    print(f"[{wq.worker_name()}] Đã chạy xong {done} task.")
+
+
+def cmd_queue(args):
+    import work_queue as wq
+
+    if args.action == 'submit':
+        with open(args.grid, encoding='utf-8') as f:
+            grid = json.load(f)
+        keys = list(grid)
+        param_sets = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+        n = wq.submit_tasks(args.queue, param_sets, args.from_date, args.end_date)
+        print(f"Đã nộp {n} task mới ({len(param_sets) - n} task đã có).")
+    elif args.action == 'work':
+        if args.processes <= 1:
+            _queue_worker(args)
+        else:
+            import multiprocessing
+            procs = [multiprocessing.Process(target=_queue_worker, args=(args,)) for _ in range(args.processes)]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+    elif args.action == 'status':
+        wq.init_queue(args.queue)
+        print(wq.queue_status(args.queue))
+    elif args.action == 'collect':
+        table = wq.collect_results(args.queue)
+        table.to_csv(args.out, index=False)
+        print(f"Đã gộp {len(table)} kết quả vào {args.out}")
+
+
+def cmd_report(args):
+    import pandas as pd
+    from backtest_script import compute_metrics, plot_results, print_metrics
+
+    results = pd.read_csv(args.results, index_col='date', parse_dates=['date'])
+    initial_capital = args.initial_capital
+    if initial_capital is None:
+        initial_capital = _config_from_args(args).INITIAL_CAPITAL
+    print(results.tail())
+    print_metrics(compute_metrics(results, initial_capital))
+    if args.plot or args.show:
+        plot_results(results, output_path=args.plot)
+
+
+def _add_config_args(parser):
+    parser.add_argument('--config', help="file .json hoặc .py (class StrategyConfig, vd best_conf.py)")
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE', help="ghi đè tham số, dùng nhiều lần được")
+
+
+def _add_source_args(parser):
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--store', help="kho panel tạo bởi lệnh prepare (đọc theo khối, RAM ổn định)")
+    source.add_argument('--data', help="thư mục CSV (nạp toàn bộ vào RAM)")
+    source.add_argument('--shared', metavar='NAME', help="dữ liệu dùng chung do lệnh serve phát hành (không copy)")
+    parser.add_argument('--shared-root', help="thư mục gốc của serve (mặc định /dev/shm/tf_algo)")
+    parser.add_argument('--compact', action='store_true', help="với --data: float32 + categorical ticker")
+    parser.add_argument('--interval', default='1D', help="với --data: khung nến của file CSV (1D, 1H, 1m...)")
+    parser.add_argument('--bars', help="kho nến trong phiên (prepare --bars): xét stop-loss trong phiên")
+    parser.add_argument('--universe', help="thư mục Universe đã lưu (xem universe.py)")
+    parser.add_argument('--from', dest='from_date', help="ngày bắt đầu YYYY-MM-DD")
+    parser.add_argument('--to', dest='end_date', help="ngày kết thúc YYYY-MM-DD")
+    parser.add_argument('--ath-checkpoint-dir', help="với --data --from: thư mục file mốc ATH (mặc định ~/.cache/tf_algo/ath)")
+    parser.add_argument('--log', default='backtest_log.txt', help="file log của backtest")
+    parser.add_argument('--cache', help="thư mục cache kết quả (xem result_cache.py)")
+    parser.add_argument('--cache-max-mb', type=float, default=2048, help="dung lượng tối đa của cache")
+    parser.add_argument('--progress', help="file JSON tiến độ, ghi đè định kỳ (xem progress.py)")
+    parser.add_argument('--metrics-file', help="file text định dạng Prometheus, ghi đè định kỳ")
+    parser.add_argument('--metrics-port', type=int, help="mở HTTP cục bộ /progress, /metrics trên cổng này")
+    parser.add_argument('--progress-interval', type=float, default=5.0, help="số giây giữa hai lần ghi tiến độ")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description="Backtest chiến lược Trend Following cổ phiếu Việt Nam.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('download', help="tải lịch sử giá từ vnstock")
+    p.add_argument('--symbols', nargs='*', help="danh sách mã; bỏ trống → tất cả mã")
+    p.add_argument('--start', default='2000-01-01')
+    p.add_argument('--end')
+    p.add_argument('--source', default='vci')
+    p.add_argument('--folder', default='stock_histories')
+    p.add_argument('--interval', default='1D')
+    p.add_argument('--sleep', type=float, default=1.0)
+    p.set_defaults(func=cmd_download)
+
+    p = sub.add_parser('prepare', help="tính chỉ báo và ghi kho panel memory-mapped")
+    p.add_argument('--data', required=True, help="thư mục CSV")
+    p.add_argument('--out', required=True, help="thư mục kho đầu ra")
+    p.add_argument('--dtype', default='float64', choices=['float64', 'float32'])
+    p.add_argument('--quality-report', help="file CSV báo cáo chất lượng dữ liệu theo mã")
+    p.add_argument('--interval', default='1D', help="khung nến của file CSV (1D, 1H, 1m...); nến trong phiên được gộp thành nến ngày")
+    p.add_argument('--bars', help="với nến trong phiên: thư mục ghi thêm kho nến gốc để xét stop-loss trong phiên")
+    _add_config_args(p)
+    p.set_defaults(func=cmd_prepare)
+
+    p = sub.add_parser('serve', help="máy chủ dữ liệu: tính chỉ báo một lần, phát hành vào bộ nhớ chia sẻ cho mọi tiến trình")
+    p.add_argument('--data', required=True, help="thư mục CSV")
+    p.add_argument('--name', default='default', help="tên dữ liệu để client attach (--shared NAME)")
+    p.add_argument('--root', help="thư mục gốc (mặc định /dev/shm/tf_algo)")
+    p.add_argument('--dtype', default='float64', choices=['float64', 'float32'])
+    p.add_argument('--interval', default='1D', help="khung nến của file CSV")
+    p.add_argument('--poll', type=float, default=60.0, help="số giây giữa hai lần kiểm tra CSV thay đổi")
+    p.add_argument('--once', action='store_true', help="phát hành (nếu dữ liệu đổi) rồi thoát")
+    _add_config_args(p)
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser('backtest', help="chạy một backtest")
+    _add_source_args(p)
+    _add_config_args(p)
+    p.add_argument('--out', help="file CSV lưu lịch sử NAV")
+    p.set_defaults(func=cmd_backtest)
+
+    p = sub.add_parser('sweep', help="chạy lưới tham số")
+    _add_source_args(p)
+    _add_config_args(p)
+    p.add_argument('--grid', required=True, help='file JSON {"THAM_SO": [giá trị, ...], ...}')
+    p.add_argument('--replay', action='store_true',
+                   help="chạy tham chiếu một lần với cấu hình gốc, mỗi tổ hợp chỉ mô phỏng từ ngày quyết định khác đầu tiên "
+                        "(xem replay.py). Chỉ nhanh khi lưới gồm REBALANCE_THRESHOLD / MAX_LEVERAGE / MIN_ASSUMED_HOLDINGS; "
+                        "tham số khác phải mô phỏng lại từng ngày, tốn gần như chạy đầy đủ")
+    p.add_argument('--out', default='sweep_results.csv')
+    p.set_defaults(func=cmd_sweep)
+
+    p = sub.add_parser('sleeves', help="nhiều sleeve trên một tài khoản, bù trừ lệnh giữa các sleeve (xem sleeves.py)")
+    source = p.add_mutually_exclusive_group(required=True)
+    source.add_argument('--store')
+    source.add_argument('--data')
+    source.add_argument('--shared', metavar='NAME')
+    p.add_argument('--shared-root')
+    p.add_argument('--compact', action='store_true')
+    p.add_argument('--sleeves', required=True,
+                   help='file JSON [{"name": "...", "weight": 0.5, "set": {"THAM_SO": giá trị}, "universe": "thư mục"}, ...]')
+    p.add_argument('--rebalance-days', type=int, help="số phiên giữa hai lần cân bằng vốn giữa các sleeve")
+    p.add_argument('--from', dest='from_date')
+    p.add_argument('--to', dest='end_date')
+    p.add_argument('--ath-checkpoint-dir')
+    p.add_argument('--log', default='backtest_log.txt')
+    p.add_argument('--out', help="file CSV lưu NAV gộp + NAV từng sleeve")
+    _add_config_args(p)
+    p.set_defaults(func=cmd_sleeves)
+
+    p = sub.add_parser('optimize', help="tối ưu tham số bằng successive halving / Hyperband")
+    p.add_argument('--data', required=True, help="thư mục CSV")
+    p.add_argument('--compact', action='store_true')
+    p.add_argument('--from', dest='from_date')
+    p.add_argument('--to', dest='end_date')
+    p.add_argument('--space', help='file JSON {"THAM_SO": [min, max, "float|int|log"] hoặc [giá trị, ...]}')
+    p.add_argument('--budget', type=float, help="ngân sách ticker-ngày")
+    p.add_argument('--brackets', type=int, help="số bracket Hyperband (mặc định: một vòng đầy đủ hoặc tới khi hết ngân sách)")
+    p.add_argument('--eta', type=int, default=3)
+    p.add_argument('--min-fraction', type=float, default=1 / 9)
+    p.add_argument('--fidelity', choices=['dates', 'tickers'], default='dates')
+    p.add_argument('--objective', choices=['calmar', 'cagr', 'sharpe'], default='calmar')
+    p.add_argument('--proposer', choices=['tpe', 'random'], default='tpe')
+    p.add_argument('--drawdown-stop', type=float, help="dừng sớm lần chạy có drawdown vượt ngưỡng")
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--cache', help="thư mục cache kết quả")
+    p.add_argument('--out', default='optimize_results.csv')
+    _add_config_args(p)
+    p.set_defaults(func=cmd_optimize)
+
+    p = sub.add_parser('queue', help="sweep nhiều máy qua thư mục dùng chung (xem work_queue.py)")
+    queue_sub = p.add_subparsers(dest='action', required=True)
+    q = queue_sub.add_parser('submit', help="nộp lưới tham số thành các task")
+    q.add_argument('--queue', required=True, help="thư mục hàng đợi dùng chung")
+    q.add_argument('--grid', required=True, help='file JSON {"THAM_SO": [giá trị, ...], ...}')
+    q.add_argument('--from', dest='from_date')
+    q.add_argument('--to', dest='end_date')
+    q = queue_sub.add_parser('work', help="chạy worker nhận và xử lý task")
+    q.add_argument('--queue', required=True)
+    source = q.add_mutually_exclusive_group(required=True)
+    source.add_argument('--store')
+    source.add_argument('--data')
+    source.add_argument('--shared', metavar='NAME')
+    q.add_argument('--shared-root')
+    q.add_argument('--compact', action='store_true')
+    q.add_argument('--processes', type=int, default=1, help="số tiến trình worker trên máy này")
+    q.add_argument('--lease', type=float, default=600, help="giây không có heartbeat thì task bị trả lại")
+    q.add_argument('--poll', type=float, default=5.0)
+    q.add_argument('--forever', action='store_true', help="không thoát khi hết task")
+    q.add_argument('--cache')
+    _add_config_args(q)
+    q = queue_sub.add_parser('status')
+    q.add_argument('--queue', required=True)
+    q = queue_sub.add_parser('collect', help="gộp kết quả thành một bảng")
+    q.add_argument('--queue', required=True)
+    q.add_argument('--out', default='queue_results.csv')
+    p.set_defaults(func=cmd_queue)
+
+    p = sub.add_parser('report', help="thống kê / vẽ biểu đồ từ file NAV")
+    p.add_argument('results', help="file CSV tạo bởi backtest --out")
+    p.add_argument('--initial-capital', type=float)
+    p.add_argument('--plot', help="lưu biểu đồ ra file ảnh")
+    p.add_argument('--show', action='store_true', help="hiện biểu đồ")
+    _add_config_args(p)
+    p.set_defaults(func=cmd_report)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
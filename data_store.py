@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# KHO DỮ LIỆU DẠNG PANEL (NGÀY × MÃ) MEMORY-MAPPED
+# ==============================================================================
+# Mỗi cột chỉ báo được lưu thành một file .npy (ngày × mã), ô không có dữ liệu là NaN,
+# kèm present.npy đánh dấu ô có dòng dữ liệu thật. Khi đọc, các file được memory-map
+# nên chỉ khối ngày đang xử lý nằm trong RAM.
+
+META_FILE = 'meta.json'
+PRESENT_FILE = 'present.npy'
+
+
+class PanelStoreWriter:
+    """
+    Ghi kho theo từng mã (không cần giữ toàn bộ dữ liệu trong RAM).
+
+    Vd:
+        writer = PanelStoreWriter(folder, dates, tickers, ['open', 'close', ...])
+        for ticker, df in ...: writer.write_ticker(ticker, df)   # df có cột 'time'
+        writer.close()
+    """
+
+    def __init__(self, folder, dates, tickers, columns, dtype=np.float64):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.dates = pd.DatetimeIndex(dates)
+        self.tickers = pd.Index(tickers)
+        self.columns = list(columns)
+        self.dtype = np.dtype(dtype)
+        shape = (len(self.dates), len(self.tickers))
+        self.present = np.lib.format.open_memmap(os.path.join(folder, PRESENT_FILE), mode='w+', dtype=bool, shape=shape)
+        self.arrays = {}
+        for col in self.columns:
+            arr = np.lib.format.open_memmap(os.path.join(folder, f'{col}.npy'), mode='w+', dtype=self.dtype, shape=shape)
+            arr[:] = np.nan
+            self.arrays[col] = arr
+
+    def write_ticker(self, ticker, df):
+        col = self.tickers.get_loc(ticker)
+        rows = self.dates.get_indexer(pd.DatetimeIndex(df['time']))
+        if (rows < 0).any():
+            raise ValueError(f"Mã {ticker} có ngày không nằm trong danh sách ngày của kho.")
+        self.present[rows, col] = True
+        for name in self.columns:
+            self.arrays[name][rows, col] = df[name].to_numpy(dtype=self.dtype)
+
+    def write_frame(self, data):
+        """Ghi toàn bộ DataFrame (time, ticker) đã có trong RAM."""
+        rows = self.dates.get_indexer(data.index.get_level_values('time'))
+        cols = self.tickers.get_indexer(data.index.get_level_values('ticker'))
+        self.present[rows, cols] = True
+        for name in self.columns:
+            self.arrays[name][rows, cols] = data[name].to_numpy(dtype=self.dtype)
+
+    def close(self):
+        digest = hashlib.sha256()
+        for arr in [self.present] + [self.arrays[c] for c in self.columns]:
+            arr.flush()
+            # Băm theo từng khối ngày để không phải nạp cả mảng
+            for start in range(0, len(arr), 1024):
+                digest.update(np.ascontiguousarray(arr[start:start + 1024]).tobytes())
+        meta = {
+            'dates': [d.strftime('%Y-%m-%d %H:%M:%S') for d in self.dates],
+            'tickers': [str(t) for t in self.tickers],
+            'columns': self.columns,
+            'dtype': self.dtype.name,
+            'fingerprint': digest.hexdigest(),
+        }
+        with open(os.path.join(self.folder, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        del self.present, self.arrays
+
+
+def write_store(data, folder, columns=None, dtype=np.float64):
+    """Ghi DataFrame (time, ticker) từ load_and_prepare_data thành kho panel."""
+    columns = list(columns) if columns is not None else list(data.columns)
+    dates = data.index.get_level_values('time').unique().sort_values()
+    tickers = data.index.get_level_values('ticker').unique().sort_values()
+    writer = PanelStoreWriter(folder, dates, tickers, columns, dtype=dtype)
+    writer.write_frame(data)
+    writer.close()
+    return PanelStore(folder)
+
+
+class PanelStore:
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.dates = pd.DatetimeIndex(pd.to_datetime(meta['dates']), name='time')
+        self.tickers = pd.Index(meta['tickers'], name='ticker')
+        self.columns = meta['columns']
+        self.fingerprint = meta['fingerprint']
+        self.present = np.load(os.path.join(folder, PRESENT_FILE), mmap_mode='r')
+        self.arrays = {col: np.load(os.path.join(folder, f'{col}.npy'), mmap_mode='r') for col in self.columns}
+        self._column_of = {t: k for k, t in enumerate(self.tickers)}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _date_range(self, from_date=None, end_date=None):
+        start = 0 if from_date is None else self.dates.searchsorted(pd.Timestamp(from_date), side='left')
+        stop = len(self.dates) if end_date is None else self.dates.searchsorted(pd.Timestamp(end_date), side='right')
+        return start, stop
+
+    def iter_chunks(self, from_date=None, end_date=None, chunk_days=250):
+        """Sinh (vị trí ngày đầu khối, present, {cột: mảng}) — mỗi khối được copy khỏi memmap."""
+        start, stop = self._date_range(from_date, end_date)
+        for a in range(start, stop, chunk_days):
+            b = min(a + chunk_days, stop)
+            present = np.array(self.present[a:b])
+            values = {col: np.array(arr[a:b]) for col, arr in self.arrays.items()}
+            yield a, present, values
+
+    def iter_days(self, from_date=None, end_date=None, chunk_days=250):
+        """Sinh (today, daily_data_today) giống data.loc[today] của run_backtest."""
+        for a, present, values in self.iter_chunks(from_date, end_date, chunk_days):
+            for r in range(len(present)):
+                cols = np.flatnonzero(present[r])
+                daily = pd.DataFrame({col: arr[r, cols] for col, arr in values.items()}, index=self.tickers[cols])
+                yield self.dates[a + r], daily
+
+    def day_rows(self, position, tickers):
+        """
+        Các dòng của `tickers` (mã có dữ liệu) trong ngày thứ `position`, giống daily_data_today của iter_days
+        nhưng chỉ đọc đúng các ô đó từ memmap (chế độ events, xem backtest_script.sparse_days).
+        """
+        cols = np.unique(np.fromiter((self._column_of[t] for t in tickers if t in self._column_of), dtype=np.int64))
+        cols = cols[self.present[position, cols]]
+        # Mọi cột cùng dtype của kho → dựng DataFrame từ một khối 2D (rẻ hơn dict cột trên vài chục dòng)
+        block = np.stack([arr[position, cols] for arr in self.arrays.values()], axis=1)
+        return pd.DataFrame(block, index=self.tickers[cols], columns=self.columns)
+
+    def to_frame(self, from_date=None, end_date=None):
+        """Dựng lại DataFrame (time, ticker) đầy đủ trong RAM (chỉ nên dùng cho khoảng ngắn)."""
+        start, stop = self._date_range(from_date, end_date)
+        present = np.array(self.present[start:stop])
+        rows, cols = np.nonzero(present)
+        index = pd.MultiIndex.from_arrays([self.dates[start + rows], self.tickers[cols]], names=['time', 'ticker'])
+        return pd.DataFrame({col: np.asarray(arr[start:stop])[rows, cols] for col, arr in self.arrays.items()}, index=index)
+
+
+class FrameIndex:
+    """
+    Vị trí dòng theo ngày của DataFrame (time, ticker) từ load_and_prepare_data, tính một lần, để đọc
+    các dòng của vài mã trong một ngày mà không cắt cả ngày (cùng giao diện dates / day_rows với PanelStore).
+    """
+
+    def __init__(self, data):
+        times = data.index.get_level_values('time')
+        level = data.index.names.index('ticker')
+        codes = data.index.codes[level]
+        self.tickers = data.index.levels[level]
+        time_ns = times.to_numpy().astype('datetime64[ns]').view(np.int64)
+        # Thứ tự (ngày, mã): trong mỗi ngày mã tăng dần như data.loc[today]. Chỉ giữ vị trí dòng và view cột của
+        # chính `data` (không copy dữ liệu); load_and_prepare_data đã sắp xếp sẵn thì không cần cả mảng thứ tự
+        order = np.lexsort((codes, time_ns))
+        self.order = None if np.array_equal(order, np.arange(len(order))) else order
+        if self.order is not None:
+            time_ns, codes = time_ns[order], np.asarray(codes)[order]
+        self.codes = np.asarray(codes)
+        day_ns, first = np.unique(time_ns, return_index=True)
+        self.dates = pd.DatetimeIndex(day_ns.view('datetime64[ns]'), name='time')
+        self.offsets = np.r_[first, len(time_ns)].astype(np.int64)
+        self.columns = data.columns
+        self.arrays = [data[col].to_numpy() for col in data.columns]
+        self._code_of = {t: k for k, t in enumerate(self.tickers)}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def day_rows(self, position, tickers):
+        """Các dòng của `tickers` (mã có dữ liệu) trong ngày thứ `position`, giống data.loc[today] thu hẹp."""
+        a, b = self.offsets[position], self.offsets[position + 1]
+        wanted = np.unique(np.fromiter((self._code_of[t] for t in tickers if t in self._code_of), dtype=np.int64))
+        day_codes = self.codes[a:b]
+        pos = np.minimum(np.searchsorted(day_codes, wanted), max(len(day_codes) - 1, 0))
+        rows = a + pos[day_codes[pos] == wanted] if len(day_codes) else np.zeros(0, dtype=np.int64)
+        index = self.tickers.take(self.codes[rows])
+        if self.order is not None:
+            rows = self.order[rows]
+        return pd.DataFrame(np.column_stack([arr[rows] for arr in self.arrays]), index=index, columns=self.columns)
@@ -1,7 +1,6 @@
 import os
 import time
 from datetime import datetime
-from vnstock import Listing, Quote
 
 def download_all_histories(
     symbols: list = [],
@@ -25,6 +24,9 @@ def download_all_histories(
         sleep_time: chờ giữa các request để tránh rate limit
     """
 
+    # Import trễ: vnstock nặng và chỉ cần khi thực sự tải dữ liệu
+    from vnstock import Listing, Quote
+
     if end_date is None:
         end_date = datetime.today().strftime("%Y-%m-%d")
 
@@ -0,0 +1,357 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import backtest_script as bs
+from backtest_script import Portfolio, StrategyConfig, calculate_indicators
+
+# ==============================================================================
+# KIỂM TRA TƯƠNG ĐƯƠNG GIỮA ENGINE THAM CHIẾU VÀ CÁC ENGINE TỐI ƯU
+# ==============================================================================
+# reference_backtest() là bản sao cố định của vòng lặp run_backtest gốc (data.loc mỗi ngày)
+# và KHÔNG được tối ưu hóa — nó là "đáp án" để so mọi engine khác. Mỗi engine được chạy
+# trên vũ trụ tổng hợp ngẫu nhiên + StrategyConfig ngẫu nhiên; trạng thái cuối mỗi ngày
+# (NAV, tiền mặt, số lượng nắm giữ, stop-loss, danh sách lệnh cho ngày mai) được so sánh
+# và báo cáo ngày đầu tiên lệch.
+#
+#   python equivalence.py --fast        # vài giây, dùng như một bài test thường
+#   python equivalence.py --cases 50    # nhiều vũ trụ / config hơn
+
+
+def make_synthetic_universe(n_tickers=30, n_days=400, seed=0, config=None):
+    """
+    DataFrame (time, ticker) giống load_and_prepare_data trên dữ liệu giả lập:
+    mã niêm yết / hủy niêm yết giữa kỳ, ngày thiếu dữ liệu, xu hướng khác nhau để có breakout.
+    """
+    config = config or StrategyConfig()
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2015-01-01', periods=n_days)
+    frames = []
+    for k in range(n_tickers):
+        start = rng.integers(0, n_days // 3)
+        end = n_days - rng.integers(0, n_days // 4)
+        keep = rng.random(end - start) > 0.03 # ~3% ngày không giao dịch
+        times = dates[start:end][keep]
+        n = len(times)
+        drift = rng.normal(0.0005, 0.001)
+        close = rng.uniform(8, 80) * np.exp(np.cumsum(rng.normal(drift, rng.uniform(0.01, 0.03), n)))
+        open_ = close * np.exp(rng.normal(0, 0.006, n))
+        high = np.maximum(open_, close) * (1 + rng.uniform(0, 0.015, n))
+        low = np.minimum(open_, close) * (1 - rng.uniform(0, 0.015, n))
+        df = pd.DataFrame({
+            'time': times,
+            'open': open_.round(2) * 1000.0,
+            'high': high.round(2) * 1000.0,
+            'low': low.round(2) * 1000.0,
+            'close': close.round(2) * 1000.0,
+            'volume': rng.integers(20_000, 600_000, n),
+            'ticker': f'S{k:03d}',
+        })
+        frames.append(calculate_indicators(df, config))
+    full_df = pd.concat(frames, ignore_index=True).sort_values(by=['time', 'ticker']).reset_index(drop=True)
+    return full_df.set_index(['time', 'ticker'])
+
+
+def random_config(rng):
+    config = StrategyConfig()
+    config.ATR_MULTIPLIER = float(rng.choice([3, 5, 8, 10, 15]))
+    config.TARGET_VOLATILITY = float(rng.uniform(0.1, 0.6))
+    config.MIN_ASSUMED_HOLDINGS = int(rng.integers(3, 40))
+    config.REBALANCE_THRESHOLD = float(rng.uniform(0, 0.01))
+    config.MAX_LEVERAGE = float(rng.choice([0.5, 1.0, 1.5, 2.0]))
+    config.MIN_AVG_VOLUME = float(rng.choice([50_000, 100_000, 200_000]))
+    config.MIN_PRICE_THRESHOLD = float(rng.choice([5_000, 10_000, 20_000]))
+    config.USE_TURNOVER_CONTROL = bool(rng.random() < 0.8)
+    return config
+
+
+def reference_backtest(data, config, from_date=None, end_date=None, on_day=None):
+    """Vòng lặp run_backtest gốc, giữ nguyên để làm chuẩn so sánh. Trả về lịch sử NAV."""
+    portfolio = Portfolio(config)
+    all_dates = data.index.get_level_values('time').unique().sort_values()
+    if from_date:
+        all_dates = all_dates[all_dates >= pd.to_datetime(from_date)]
+        if end_date:
+            all_dates = all_dates[all_dates <= pd.to_datetime(end_date)]
+
+    trade_list = {}
+    sl_data_list = {}
+    for i in range(len(all_dates)):
+        today = all_dates[i]
+        portfolio.current_date = today
+        daily_open_prices = data.loc[today, 'open'].to_dict()
+
+        sorted_trades = sorted(trade_list.items(), key=lambda item: item[1])
+        for ticker, quantity_delta in sorted_trades:
+            if ticker in daily_open_prices:
+                price = daily_open_prices[ticker]
+                if quantity_delta < 0:
+                    portfolio.execute_sell(ticker, price, abs(quantity_delta))
+                elif quantity_delta > 0:
+                    portfolio.execute_buy(ticker, price, quantity_delta, sl_data=sl_data_list.get(ticker))
+
+        daily_close_prices = data.loc[today, 'close'].to_dict()
+        portfolio.record_nav(today, daily_close_prices)
+        nav_eod = portfolio.get_total_value(daily_close_prices)
+        if nav_eod <= 0:
+            break
+
+        trade_list.clear()
+        sl_data_list.clear()
+        daily_data_today = data.loc[today]
+
+        sell_due_to_sl = set()
+        for ticker in list(portfolio.holdings.keys()):
+            if ticker in daily_data_today.index:
+                if daily_data_today.loc[ticker, 'close'] < portfolio.stop_losses.get(ticker, float('inf')):
+                    sell_due_to_sl.add(ticker)
+
+        eligible = daily_data_today[
+            (daily_data_today['close'] > config.MIN_PRICE_THRESHOLD) &
+            (daily_data_today['avg_volume'] > config.MIN_AVG_VOLUME) &
+            (daily_data_today['volatility'] > 0)
+        ]
+        new_signals = eligible[
+            (eligible['close'] >= eligible['ath']) &
+            (~eligible.index.isin(portfolio.holdings.keys()))
+        ].index.tolist()
+
+        current_holdings_to_keep = [t for t in portfolio.holdings.keys() if t not in sell_due_to_sl]
+        target_portfolio_tickers = sorted(list(set(current_holdings_to_keep + new_signals)))
+
+        if not target_portfolio_tickers:
+            for ticker, pos in portfolio.holdings.items():
+                trade_list[ticker] = -pos['quantity']
+            if on_day is not None:
+                on_day(today, portfolio, trade_list)
+            continue
+
+        n_holdings = len(target_portfolio_tickers)
+        target_weights = {}
+        total_weight = 0
+        for ticker in target_portfolio_tickers:
+            if ticker in daily_data_today.index:
+                vol = daily_data_today.loc[ticker, 'volatility']
+                if pd.notna(vol) and vol > 0:
+                    weight = (config.TARGET_VOLATILITY / vol) * (1 / max(config.MIN_ASSUMED_HOLDINGS, n_holdings))
+                    target_weights[ticker] = weight
+                    total_weight += weight
+
+        if total_weight > config.MAX_LEVERAGE:
+            correction_factor = config.MAX_LEVERAGE / total_weight
+            target_weights = {t: w * correction_factor for t, w in target_weights.items()}
+
+        for ticker in set(list(portfolio.holdings.keys()) + target_portfolio_tickers):
+            current_quantity = portfolio.holdings.get(ticker, {}).get('quantity', 0)
+            target_weight = target_weights.get(ticker, 0)
+            estimated_price = daily_data_today.loc[ticker, 'close'] if ticker in daily_data_today.index else 0
+
+            target_quantity = 0
+            if estimated_price > 0:
+                target_quantity = int((target_weight * nav_eod) / estimated_price)
+            quantity_delta = target_quantity - current_quantity
+
+            if config.USE_TURNOVER_CONTROL:
+                trade_value = abs(quantity_delta) * estimated_price if estimated_price > 0 else 0
+                if ticker in portfolio.holdings:
+                    if trade_value < config.REBALANCE_THRESHOLD * nav_eod:
+                        continue
+
+            if quantity_delta != 0:
+                trade_list[ticker] = quantity_delta
+                if ticker in new_signals and quantity_delta > 0:
+                    sl_data_list[ticker] = daily_data_today.loc[ticker, ['ath', 'atr', 'close']].to_dict()
+
+        for ticker in current_holdings_to_keep:
+            if ticker not in daily_data_today.index:
+                continue
+            data_row = daily_data_today.loc[ticker]
+            if data_row['close'] > 0 and pd.notna(data_row['atr']):
+                new_sl_candidate = data_row['ath'] * ((1 - data_row['atr'] / data_row['close']) ** config.ATR_MULTIPLIER)
+                if new_sl_candidate > portfolio.stop_losses.get(ticker, 0):
+                    portfolio.stop_losses[ticker] = new_sl_candidate
+
+        if on_day is not None:
+            on_day(today, portfolio, trade_list)
+
+    return pd.DataFrame(portfolio.history).set_index('date')
+
+
+# --- Các engine cần kiểm tra: engine(data, config, from_date, end_date, on_day) ---
+def _engine_in_memory(data, config, from_date, end_date, on_day):
+    return bs.run_backtest(data, config, from_date, end_date, log_file=os.devnull, on_day=on_day)
+
+
+def _engine_streaming(data, config, from_date, end_date, on_day):
+    from data_store import write_store
+    with tempfile.TemporaryDirectory() as folder:
+        store = write_store(data, folder, columns=bs.ENGINE_COLUMNS)
+        return bs.run_backtest_streaming(store, config, from_date, end_date, log_file=os.devnull,
+                                         chunk_days=17, on_day=on_day)
+
+
+def _engine_universe(data, config, from_date, end_date, on_day):
+    from universe import Universe
+    universe = Universe.from_filters(data, config)
+    return bs.run_backtest(data, config, from_date, end_date, log_file=os.devnull, universe=universe, on_day=on_day)
+
+
+def _engine_events(data, config, from_date, end_date, on_day):
+    from events import BreakoutEvents
+    return bs.run_backtest(data, config, from_date, end_date, log_file=os.devnull,
+                           events=BreakoutEvents.from_frame(data), on_day=on_day)
+
+
+def _engine_replay(data, config, from_date, end_date, on_day):
+    # Ghi lần chạy tham chiếu với REBALANCE_THRESHOLD lệch đi rồi replay đúng `config`: các ngày trước ngày khác
+    # biệt đầu tiên lấy từ ảnh chụp (trạng thái đầu ngày kế tiếp = trạng thái cuối ngày), phần sau mô phỏng lại
+    from replay import ReferenceRun
+    base = bs.load_config(overrides=dict(bs.config_to_dict(config), REBALANCE_THRESHOLD=config.REBALANCE_THRESHOLD * 1.5))
+    ref = ReferenceRun.record(data, base, from_date, end_date, log_file=os.devnull)
+    first = min(ref.divergence(config, data), len(ref.margins))
+    for i in range(first):
+        state = ref._restore(i + 1, config)
+        on_day(ref.dates[i], state['portfolio'], state['trade_list'])
+    return ref.replay(data, config, log_file=os.devnull, on_day=on_day)
+
+
+def _engine_sleeve(data, config, from_date, end_date, on_day):
+    from sleeves import Sleeve, run_sleeves
+    _, per_sleeve = run_sleeves(data, [Sleeve('only', config, 1.0)], from_date, end_date, log_file=os.devnull,
+                                on_day=lambda name, *args: on_day(*args))
+    return per_sleeve['only']
+
+
+ENGINES = {
+    'in_memory': _engine_in_memory,
+    'streaming': _engine_streaming,
+    'universe': _engine_universe,
+    'events': _engine_events,
+    'replay': _engine_replay,
+    'sleeve': _engine_sleeve,
+}
+
+
+class StateRecorder:
+    """Ghi trạng thái cuối ngày (gọi qua on_day)."""
+
+    def __init__(self):
+        self.states = []
+
+    def __call__(self, today, portfolio, trade_list):
+        self.states.append({
+            'date': today,
+            'cash': portfolio.cash,
+            'holdings': {t: p['quantity'] for t, p in portfolio.holdings.items()},
+            'stops': dict(portfolio.stop_losses),
+            'trades': dict(trade_list),
+        })
+
+
+def _run_quiet(engine, data, config, from_date, end_date):
+    # Portfolio in từng lệnh ra stdout và tqdm ra stderr → tắt khi so sánh
+    recorder = StateRecorder()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        results = engine(data, config, from_date, end_date, recorder)
+    return results, recorder.states
+
+
+def _close(a, b, rtol):
+    return abs(a - b) <= rtol * max(abs(a), abs(b), 1.0)
+
+
+def _state_divergence(ref, st, rtol):
+    if ref['holdings'] != st['holdings']:
+        return f"holdings: {ref['holdings']} ≠ {st['holdings']}"
+    if ref['trades'] != st['trades']:
+        return f"trade_list: {ref['trades']} ≠ {st['trades']}"
+    if ref['stops'].keys() != st['stops'].keys():
+        return f"mã có stop-loss khác nhau: {sorted(ref['stops'])} ≠ {sorted(st['stops'])}"
+    for t, stop in ref['stops'].items():
+        if not _close(stop, st['stops'][t], rtol):
+            return f"stop-loss {t}: {stop:,.4f} ≠ {st['stops'][t]:,.4f}"
+    return None
+
+
+def first_divergence(ref_results, ref_states, results, states, rtol=1e-9):
+    """Trả về None nếu khớp, ngược lại (ngày, mô tả) của điểm lệch đầu tiên."""
+    ref_by_date = {st['date']: st for st in ref_states}
+    by_date = {st['date']: st for st in states}
+    for (date, ref_row), (date2, row) in zip(ref_results.iterrows(), results.iterrows()):
+        if date != date2:
+            return date, f"lịch ngày khác nhau: {date} ≠ {date2}"
+        for col in ['nav', 'cash']:
+            if not _close(ref_row[col], row[col], rtol):
+                return date, f"{col}: {ref_row[col]:,.4f} ≠ {row[col]:,.4f}"
+        if ref_row['holdings_count'] != row['holdings_count']:
+            return date, f"holdings_count: {ref_row['holdings_count']} ≠ {row['holdings_count']}"
+        # Trạng thái cuối ngày (sau khi ra quyết định cho ngày mai)
+        if (date in ref_by_date) != (date in by_date):
+            return date, "chỉ một engine ghi trạng thái cuối ngày"
+        if date in ref_by_date:
+            diff = _state_divergence(ref_by_date[date], by_date[date], rtol)
+            if diff is not None:
+                return date, diff
+    if len(ref_results) != len(results):
+        return None, f"số ngày khác nhau: {len(ref_results)} ≠ {len(results)}"
+    return None
+
+
+def check_equivalence(engines=None, cases=5, n_tickers=30, n_days=400, seed=0, rtol=1e-9, verbose=True):
+    """
+    Chạy reference_backtest và từng engine trên `cases` cặp (vũ trụ tổng hợp, config ngẫu nhiên).
+
+    Returns:
+        danh sách lỗi [(tên engine, case, ngày, mô tả)]; rỗng nghĩa là tương đương.
+    """
+    engines = engines or ENGINES
+    rng = np.random.default_rng(seed)
+    failures = []
+    for case in range(cases):
+        data = make_synthetic_universe(n_tickers, n_days, seed=int(rng.integers(1 << 31)))
+        config = random_config(rng)
+        all_dates = data.index.get_level_values('time').unique()
+        from_date = all_dates[int(rng.integers(0, len(all_dates) // 3))] if rng.random() < 0.5 else None
+        end_date = all_dates[int(rng.integers(len(all_dates) * 2 // 3, len(all_dates)))] if from_date is not None else None
+
+        ref_results, ref_states = _run_quiet(reference_backtest, data, config, from_date, end_date)
+        for name, engine in engines.items():
+            results, states = _run_quiet(engine, data, config, from_date, end_date)
+            diff = first_divergence(ref_results, ref_states, results, states, rtol=rtol)
+            if diff is None:
+                if verbose:
+                    print(f"[OK]   case {case} | {name} | {len(ref_results)} ngày, {len(ref_states[-1]['holdings']) if ref_states else 0} mã cuối kỳ")
+            else:
+                failures.append((name, case, diff[0], diff[1]))
+                if verbose:
+                    print(f"[LỆCH] case {case} | {name} | ngày {diff[0]}: {diff[1]}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="So sánh các engine backtest với engine tham chiếu.")
+    parser.add_argument('--fast', action='store_true', help="chế độ nhanh: 3 case nhỏ")
+    parser.add_argument('--cases', type=int, default=10)
+    parser.add_argument('--tickers', type=int, default=40)
+    parser.add_argument('--days', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rtol', type=float, default=1e-9)
+    parser.add_argument('--engines', nargs='*', choices=sorted(ENGINES), help="mặc định: tất cả")
+    args = parser.parse_args(argv)
+
+    if args.fast:
+        args.cases, args.tickers, args.days = 3, 15, 250
+    engines = {name: ENGINES[name] for name in args.engines} if args.engines else ENGINES
+    failures = check_equivalence(engines, args.cases, args.tickers, args.days, args.seed, args.rtol)
+    print(f"\n{'KHỚP' if not failures else 'LỆCH'}: {len(failures)} lỗi / {args.cases * len(engines)} lần chạy.")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# CHỈ MỤC THƯA CÁC SỰ KIỆN BREAKOUT (close >= ath)
+# ==============================================================================
+# Mỗi ngày chỉ vài mã lập đỉnh mới, nhưng bước lọc tín hiệu của decide_trades quét cả
+# DataFrame của ngày. Chỉ mục này tính sẵn một lần (vector hóa) các cặp (ngày, mã) có
+# close >= ath và volatility > 0, lưu dạng CSR: mã của ngày thứ i nằm ở
+# tickers[offsets[i]:offsets[i + 1]]. Bộ lọc giá / thanh khoản của config (hoặc Universe)
+# được áp dụng trong engine trên các dòng sự kiện, nên một chỉ mục dùng được cho mọi config.
+# Khi có chỉ mục, engine chỉ đọc mỗi ngày dòng của mã có sự kiện + mã nắm giữ / lệnh chờ
+# (backtest_script.sparse_days, PanelStore.day_rows / FrameIndex.day_rows) thay vì cả ngày.
+
+EVENTS_FILE = 'events.npz'
+
+
+def breakout_mask(close, ath, volatility):
+    """Điều kiện sự kiện breakout, dùng chung cho DataFrame và mảng của PanelStore."""
+    return (close >= ath) & (volatility > 0)
+
+
+class BreakoutEvents:
+    def __init__(self, dates, tickers, fingerprint=None):
+        """
+        Args:
+            dates, tickers: mảng song song các cặp (ngày, mã) của sự kiện, đã sắp xếp theo ngày
+            fingerprint: dấu vân tay của nguồn dữ liệu đã dùng để tính (để phát hiện chỉ mục cũ)
+        """
+        dates = pd.DatetimeIndex(dates)
+        self.dates, first = np.unique(dates.to_numpy(), return_index=True)
+        self.dates = pd.DatetimeIndex(self.dates, name='time')
+        self.offsets = np.r_[first, len(dates)].astype(np.int64)
+        self.tickers = np.asarray(tickers, dtype=str)
+        self.fingerprint = fingerprint
+        self._index_days()
+
+    def _index_days(self):
+        # Ngày dạng int64 (ns) để tra vị trí bằng searchsorted, không qua get_indexer của pandas mỗi ngày
+        self._day_ns = self.dates.to_numpy().astype('datetime64[ns]').view(np.int64)
+
+    # --- Khởi tạo ---
+    @classmethod
+    def from_frame(cls, data):
+        """Từ DataFrame (time, ticker) của load_and_prepare_data."""
+        mask = breakout_mask(data['close'], data['ath'], data['volatility']).to_numpy()
+        index = data.index[mask]
+        dates = index.get_level_values('time')
+        order = np.argsort(dates.to_numpy(), kind='stable')
+        return cls(dates[order], index.get_level_values('ticker').astype(str)[order])
+
+    @classmethod
+    def from_store(cls, store, chunk_days=250):
+        """Từ PanelStore (xem data_store.py), đọc theo khối ngày."""
+        all_dates, all_tickers = [], []
+        for a, present, values in store.iter_chunks(chunk_days=chunk_days):
+            with np.errstate(invalid='ignore'):
+                mask = present & breakout_mask(values['close'], values['ath'], values['volatility'])
+            rows, cols = np.nonzero(mask)
+            all_dates.append(store.dates[a + rows])
+            all_tickers.append(store.tickers[cols])
+        return cls(np.concatenate(all_dates) if all_dates else [], np.concatenate(all_tickers) if all_tickers else [],
+                   fingerprint=store.fingerprint)
+
+    @classmethod
+    def for_store(cls, store):
+        """Chỉ mục đã lưu trong thư mục kho (prepare_store); tính lại nếu chưa có hoặc đã cũ."""
+        path = os.path.join(store.folder, EVENTS_FILE)
+        if os.path.exists(path):
+            events = cls.load(path)
+            if events.fingerprint == store.fingerprint:
+                return events
+        events = cls.from_store(store)
+        events.save(path)
+        return events
+
+    # --- Tra cứu ---
+    def on(self, today):
+        """Danh sách mã có sự kiện breakout trong ngày `today`."""
+        value = pd.Timestamp(today).value # luôn theo ns
+        i = np.searchsorted(self._day_ns, value)
+        if i == len(self._day_ns) or self._day_ns[i] != value:
+            return []
+        return self.tickers[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def summary(self):
+        per_day = np.diff(self.offsets)
+        return {
+            'events': len(self),
+            'days_with_events': len(self.dates),
+            'avg_per_event_day': float(per_day.mean()) if len(per_day) else 0.0,
+            'max_per_day': int(per_day.max()) if len(per_day) else 0,
+        }
+
+    # --- Lưu / đọc ---
+    def save(self, path):
+        np.savez(path, dates=self.dates.to_numpy().astype('datetime64[ns]').view(np.int64),
+                 offsets=self.offsets, tickers=self.tickers, fingerprint=np.array(self.fingerprint or ''))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            events = cls.__new__(cls)
+            events.dates = pd.DatetimeIndex(f['dates'].view('datetime64[ns]'), name='time')
+            events.offsets = f['offsets']
+            events.tickers = f['tickers']
+            events.fingerprint = str(f['fingerprint']) or None
+        events._index_days()
+        return events
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# NẾN TRONG PHIÊN (1H, 1m...) CHO VIỆC XÉT STOP-LOSS TRONG NGÀY
+# ==============================================================================
+# Chỉ báo và quyết định tái cân bằng vẫn tính trên nến ngày (load_and_prepare_data(interval=...)
+# gộp nến trong phiên thành nến ngày). Nến gốc được lưu riêng ở dạng mảng phẳng memory-mapped:
+#   folder/
+#     time.bin, open.bin, high.bin, low.bin, close.bin   mảng phẳng mọi nến, mã nối tiếp mã,
+#                                                       trong mỗi mã theo thứ tự thời gian
+#     start.npy, stop.npy                               (ngày × mã): nến của mã j trong ngày d
+#                                                       nằm ở [start[d, j], stop[d, j]); rỗng nếu start == stop
+#     meta.json
+# Vòng lặp chỉ đọc nến của các mã đang nắm giữ trong ngày, bằng chỉ số numpy (không cắt DataFrame).
+
+META_FILE = 'meta.json'
+BAR_COLUMNS = ['open', 'high', 'low', 'close']
+
+
+def write_bars(data_path, folder, config, interval='1H', quality_report_path=None):
+    """
+    Đọc thư mục CSV nến trong phiên (mỗi mã một file, như download_all_histories(interval=...)),
+    làm sạch (clean_price_data) và ghi thành kho nến cho IntradayBars.
+    Xử lý từng mã một nên RAM chỉ phụ thuộc kích thước một file.
+    """
+    import backtest_script as bs
+
+    os.makedirs(folder, exist_ok=True)
+    all_files = sorted(f for f in os.listdir(data_path) if f.endswith('.csv'))
+    handles = {col: open(os.path.join(folder, f'{col}.bin'), 'wb') for col in ['time'] + BAR_COLUMNS}
+    tickers, segments = [], []
+    quality_report = []
+    n_bars = 0
+    try:
+        for filename in bs.tqdm(all_files, desc="Đang ghi nến trong phiên"):
+            ticker = filename.split('.')[0]
+            try:
+                bars = bs.read_price_file(os.path.join(data_path, filename), ticker, config, quality_report)
+            except Exception as e:
+                print(f"Lỗi khi xử lý file {filename}: {e}")
+                continue
+            days = bars['time'].dt.normalize().to_numpy()
+            first = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+            last = np.r_[first[1:], len(days)]
+            handles['time'].write(bars['time'].to_numpy(dtype='datetime64[ns]').view(np.int64).tobytes())
+            for col in BAR_COLUMNS:
+                handles[col].write(bars[col].to_numpy(dtype=np.float64).tobytes())
+            tickers.append(ticker)
+            segments.append((days[first], n_bars + first, n_bars + last))
+            n_bars += len(bars)
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    dates = pd.DatetimeIndex(np.unique(np.concatenate([seg[0] for seg in segments]))) if segments else pd.DatetimeIndex([])
+    start = np.zeros((len(dates), len(tickers)), dtype=np.int64)
+    stop = np.zeros((len(dates), len(tickers)), dtype=np.int64)
+    for j, (days, first, last) in enumerate(segments):
+        rows = dates.get_indexer(days)
+        start[rows, j] = first
+        stop[rows, j] = last
+    np.save(os.path.join(folder, 'start.npy'), start)
+    np.save(os.path.join(folder, 'stop.npy'), stop)
+
+    digest = hashlib.sha256(start.tobytes() + stop.tobytes())
+    for col in ['time'] + BAR_COLUMNS:
+        with open(os.path.join(folder, f'{col}.bin'), 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                digest.update(block)
+    meta = {
+        'dates': [d.strftime('%Y-%m-%d') for d in dates],
+        'tickers': tickers,
+        'interval': interval,
+        'n_bars': n_bars,
+        'fingerprint': digest.hexdigest(),
+    }
+    with open(os.path.join(folder, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    bs._write_quality_report(quality_report, quality_report_path)
+    print(f"Đã ghi kho nến {folder}: {n_bars:,} nến {interval}, {len(dates)} ngày × {len(tickers)} mã.")
+    return IntradayBars(folder)
+
+
+class IntradayBars:
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.dates = pd.DatetimeIndex(pd.to_datetime(meta['dates']), name='time')
+        self.tickers = pd.Index(meta['tickers'], name='ticker')
+        self.interval = meta['interval']
+        self.fingerprint = meta['fingerprint']
+        self.n_bars = meta['n_bars']
+        self.time = self._map('time', np.int64)
+        self.arrays = {col: self._map(col, np.float64) for col in BAR_COLUMNS}
+        self.start = np.load(os.path.join(folder, 'start.npy'), mmap_mode='r')
+        self.stop = np.load(os.path.join(folder, 'stop.npy'), mmap_mode='r')
+
+    def _map(self, name, dtype):
+        if self.n_bars == 0: # np.memmap không mở được file rỗng
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.folder, f'{name}.bin'), dtype=dtype, mode='r', shape=(self.n_bars,))
+
+    def __len__(self):
+        return self.n_bars
+
+    def day_bars(self, today, ticker):
+        """Nến trong ngày của một mã dưới dạng DataFrame (để xem / kiểm tra, không dùng trong vòng lặp)."""
+        d, j = self.dates.get_loc(pd.Timestamp(today)), self.tickers.get_loc(ticker)
+        a, b = self.start[d, j], self.stop[d, j]
+        frame = pd.DataFrame({col: np.asarray(arr[a:b]) for col, arr in self.arrays.items()},
+                             index=pd.DatetimeIndex(np.asarray(self.time[a:b]).view('datetime64[ns]'), name='time'))
+        return frame
+
+    def stop_exits(self, today, stop_losses, mode='touch'):
+        """
+        Các mã chạm stop-loss trong phiên `today`, xét vector hóa trên nến của mọi mã trong stop_losses.
+
+        Args:
+            stop_losses: {mã: giá stop} (portfolio.stop_losses)
+            mode: 'touch'     → nến đầu tiên có low <= stop; khớp tại min(open của nến, stop)
+                                (mở cửa dưới stop thì khớp giá mở cửa)
+                  'bar_close' → nến đầu tiên đóng cửa dưới stop; khớp tại giá mở cửa nến kế tiếp.
+                                Nến cuối phiên không xét: quyết định cuối ngày sẽ bán ở phiên sau.
+        Returns:
+            [(mã, giá khớp)]
+        """
+        if mode not in ('touch', 'bar_close'):
+            raise ValueError(f"INTRADAY_STOP_MODE không hợp lệ: {mode}")
+        d = self.dates.get_indexer([pd.Timestamp(today)])[0]
+        if d < 0 or not stop_losses:
+            return []
+        tickers = list(stop_losses)
+        cols = self.tickers.get_indexer(tickers)
+        known = np.flatnonzero(cols >= 0)
+        starts = np.asarray(self.start[d, cols[known]])
+        counts = np.asarray(self.stop[d, cols[known]]) - starts
+        if mode == 'bar_close':
+            counts = np.maximum(counts - 1, 0)
+        known, starts, counts = known[counts > 0], starts[counts > 0], counts[counts > 0]
+        if len(known) == 0:
+            return []
+
+        # Chỉ số phẳng của mọi nến cần xét: đoạn k gồm starts[k] .. starts[k] + counts[k] - 1
+        offsets = np.r_[0, np.cumsum(counts)[:-1]]
+        segment = np.repeat(np.arange(len(known)), counts)
+        positions = np.arange(counts.sum()) - offsets[segment] + starts[segment]
+        levels = np.array([stop_losses[tickers[k]] for k in known], dtype=np.float64)[segment]
+        if mode == 'touch':
+            hit = self.arrays['low'][positions] <= levels
+        else:
+            hit = self.arrays['close'][positions] < levels
+
+        # Nến chạm đầu tiên của mỗi đoạn (không chạm → bằng tổng số nến)
+        first_hit = np.minimum.reduceat(np.where(hit, np.arange(len(positions)), len(positions)), offsets)
+        exited = np.flatnonzero(first_hit < len(positions))
+        bars = positions[first_hit[exited]]
+        if mode == 'touch':
+            prices = np.minimum(self.arrays['open'][bars], levels[first_hit[exited]])
+        else:
+            prices = self.arrays['open'][bars + 1]
+        return [(tickers[known[k]], price) for k, price in zip(exited, prices.tolist())]
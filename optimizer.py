@@ -0,0 +1,281 @@
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+import backtest_script as bs
+
+# ==============================================================================
+# TỐI ƯU THAM SỐ: SUCCESSIVE HALVING / HYPERBAND (+ ĐỀ XUẤT KIỂU TPE)
+# ==============================================================================
+# Thay vì chạy lưới đầy đủ, mỗi cấu hình được chấm điểm trước trên một phần dữ liệu
+# (đoạn lịch sử gần nhất, hoặc một tập con mã), chỉ 1/eta cấu hình tốt nhất được
+# "thăng hạng" lên phần dữ liệu lớn gấp eta lần, cho tới toàn bộ lịch sử.
+# Ngân sách tính bằng số ticker-ngày được mô phỏng (số dòng (time, ticker) đi qua engine).
+#
+# Vd:
+#   opt = Optimizer(full_data, load_config('best_conf.py'), from_date='2010-01-01', budget=5e7)
+#   table = opt.run()
+#   opt.best_params()
+
+# Khoảng tìm kiếm: (min, max, kiểu) với kiểu 'float' | 'int' | 'log', hoặc list giá trị rời rạc
+DEFAULT_SPACE = {
+    'ATR_MULTIPLIER': (3, 15, 'float'),
+    'TARGET_VOLATILITY': (0.10, 0.60, 'float'),
+    'MIN_ASSUMED_HOLDINGS': (5, 50, 'int'),
+    'REBALANCE_THRESHOLD': (0.0005, 0.01, 'log'),
+    'MAX_LEVERAGE': (0.5, 2.0, 'float'),
+    'MIN_AVG_VOLUME': (20_000, 500_000, 'log'),
+}
+
+
+class SearchSpace:
+    def __init__(self, space=None):
+        self.space = dict(space or DEFAULT_SPACE)
+        self.names = list(self.space)
+
+    def from_unit(self, u):
+        """Vector trong [0, 1]^d → dict tham số."""
+        params = {}
+        for x, name in zip(u, self.names):
+            spec = self.space[name]
+            x = float(np.clip(x, 0, 1))
+            if isinstance(spec, (list, tuple)) and len(spec) == 3 and spec[2] in ('float', 'int', 'log'):
+                low, high, kind = spec
+                if kind == 'log':
+                    params[name] = float(math.exp(math.log(low) + x * (math.log(high) - math.log(low))))
+                elif kind == 'int':
+                    params[name] = int(round(low + x * (high - low)))
+                else:
+                    params[name] = float(low + x * (high - low))
+            else: # rời rạc
+                params[name] = spec[min(int(x * len(spec)), len(spec) - 1)]
+        return params
+
+    def to_unit(self, params):
+        u = []
+        for name in self.names:
+            spec = self.space[name]
+            value = params[name]
+            if isinstance(spec, (list, tuple)) and len(spec) == 3 and spec[2] in ('float', 'int', 'log'):
+                low, high, kind = spec
+                if kind == 'log':
+                    u.append((math.log(value) - math.log(low)) / (math.log(high) - math.log(low)))
+                else:
+                    u.append((value - low) / (high - low))
+            else:
+                u.append((list(spec).index(value) + 0.5) / len(spec))
+        return np.array(u)
+
+    def sample(self, rng):
+        return self.from_unit(rng.random(len(self.names)))
+
+
+def score_results(results, initial_capital, objective='calmar'):
+    """Điểm càng cao càng tốt: 'calmar' (CAGR / Max DD), 'cagr' hoặc 'sharpe' (theo ngày, năm hóa)."""
+    if results.empty or len(results) < 2:
+        return -np.inf
+    metrics = bs.compute_metrics(results, initial_capital)
+    if objective == 'cagr':
+        return metrics['cagr']
+    if objective == 'sharpe':
+        returns = results['nav'].pct_change().dropna()
+        return returns.mean() / returns.std() * np.sqrt(252) if returns.std() > 0 else -np.inf
+    return metrics['cagr'] / max(metrics['max_drawdown'], 1e-9)
+
+
+class _EarlyStop(Exception):
+    pass
+
+
+class _DrawdownGuard:
+    # Dừng sớm một lần chạy khi drawdown vượt ngưỡng (cấu hình rõ ràng là tệ)
+    def __init__(self, max_drawdown):
+        self.max_drawdown = max_drawdown
+        self.peak = 0
+        self.days = 0
+
+    def __call__(self, today, portfolio, trade_list):
+        self.days += 1
+        nav = portfolio.history[-1]['nav']
+        self.peak = max(self.peak, nav)
+        if self.peak > 0 and 1 - nav / self.peak > self.max_drawdown:
+            raise _EarlyStop()
+
+
+class Optimizer:
+    def __init__(self, data, base_config=None, space=None, from_date=None, end_date=None,
+                 objective='calmar', eta=3, min_fraction=1 / 9, fidelity='dates', budget=None,
+                 proposer='tpe', seed=0, cache=None, drawdown_stop=None, log_file=os.devnull):
+        """
+        Args:
+            data: DataFrame (time, ticker) từ load_and_prepare_data
+            base_config: StrategyConfig gốc; các tham số trong space được ghi đè
+            fidelity: 'dates' (đoạn lịch sử gần nhất) hoặc 'tickers' (tập con mã ngẫu nhiên, đủ lịch sử)
+            min_fraction: tỉ lệ dữ liệu nhỏ nhất ở vòng đầu
+            budget: tổng số ticker-ngày được phép mô phỏng (None → không giới hạn)
+            proposer: 'random' hoặc 'tpe' (đề xuất dựa trên mô hình từ các kết quả đã có)
+            cache: ResultCache (xem result_cache.py) để không chạy lại cấu hình đã có
+            drawdown_stop: dừng sớm một lần chạy khi drawdown vượt ngưỡng này (vd 0.6)
+        """
+        self.data = data
+        self.base_config = base_config or bs.StrategyConfig()
+        self.space = SearchSpace(space)
+        self.objective = objective
+        self.eta = eta
+        self.min_fraction = min_fraction
+        self.fidelity = fidelity
+        self.budget = budget
+        self.proposer = proposer
+        self.rng = np.random.default_rng(seed)
+        self.cache = cache
+        self.drawdown_stop = drawdown_stop
+        self.log_file = log_file
+        self.spent = 0
+        self.records = []
+        self._subsets = {}
+
+        # Số dòng theo ngày → chi phí (ticker-ngày) của một đoạn bất kỳ tính trong O(1)
+        all_dates = data.index.get_level_values('time')
+        counts = pd.Series(1, index=all_dates).groupby(level=0).sum().sort_index()
+        if from_date is not None:
+            counts = counts[counts.index >= pd.Timestamp(from_date)]
+        if end_date is not None:
+            counts = counts[counts.index <= pd.Timestamp(end_date)]
+        self.dates = counts.index
+        self.cum_rows = np.concatenate([[0], np.cumsum(counts.to_numpy())])
+        self.tickers = data.index.get_level_values('ticker').unique().sort_values()
+
+    # --- Chi phí & dữ liệu theo fidelity ---
+    def _plan(self, fraction):
+        """(data, from_date, end_date, chi phí ticker-ngày, số ngày) cho một mức fidelity."""
+        if self.fidelity == 'tickers' and fraction < 1:
+            if fraction not in self._subsets:
+                n = max(1, int(round(len(self.tickers) * fraction)))
+                subset = self.rng.choice(self.tickers, size=n, replace=False)
+                sub = self.data[self.data.index.get_level_values('ticker').isin(subset)]
+                self._subsets[fraction] = sub
+            sub = self._subsets[fraction]
+            sub_dates = sub.index.get_level_values('time')
+            cost = int(((sub_dates >= self.dates[0]) & (sub_dates <= self.dates[-1])).sum())
+            return sub, self.dates[0], self.dates[-1], cost, len(self.dates)
+        start = max(len(self.dates) - max(2, int(math.ceil(len(self.dates) * fraction))), 0)
+        cost = int(self.cum_rows[-1] - self.cum_rows[start])
+        return self.data, self.dates[start], self.dates[-1], cost, len(self.dates) - start
+
+    def _config(self, params):
+        config = bs.StrategyConfig()
+        for key, value in bs.config_to_dict(self.base_config).items():
+            setattr(config, key, value)
+        for key, value in params.items():
+            setattr(config, key, value)
+        return config
+
+    def evaluate(self, params, fraction=1.0):
+        """Chạy (hoặc lấy từ cache) một cấu hình ở mức fidelity `fraction`. None nếu hết ngân sách."""
+        data, from_date, end_date, cost, n_days = self._plan(fraction)
+        if self.budget is not None and self.spent + cost > self.budget:
+            return None
+        config = self._config(params)
+        early_stopped = False
+        if self.cache is not None and self.drawdown_stop is None:
+            results = self.cache.run_backtest(data, config, from_date, end_date, log_file=self.log_file)['nav']
+        else:
+            guard = _DrawdownGuard(self.drawdown_stop) if self.drawdown_stop else None
+            try:
+                results = bs.run_backtest(data, config, from_date, end_date, log_file=self.log_file, on_day=guard)
+            except _EarlyStop:
+                results = pd.DataFrame()
+                early_stopped = True
+                cost = int(cost * guard.days / n_days) # chỉ tính phần ngày đã thực sự mô phỏng
+        self.spent += cost
+        score = -np.inf if early_stopped else score_results(results, config.INITIAL_CAPITAL, self.objective)
+        record = dict(params, fraction=fraction, score=score, cost=cost, early_stopped=early_stopped)
+        self.records.append(record)
+        return record
+
+    # --- Đề xuất cấu hình mới ---
+    def _propose(self, n):
+        table = pd.DataFrame(self.records)
+        n_dims = len(self.space.names)
+        if self.proposer != 'tpe' or table.empty:
+            return [self.space.sample(self.rng) for _ in range(n)]
+
+        # Dùng mức fidelity cao nhất có đủ quan sát (giống BOHB)
+        usable = table[np.isfinite(table['score'])]
+        usable = usable.groupby('fraction').filter(lambda g: len(g) >= n_dims + 2)
+        if usable.empty:
+            return [self.space.sample(self.rng) for _ in range(n)]
+        level = usable[usable['fraction'] == usable['fraction'].max()].sort_values('score', ascending=False)
+        points = np.array([self.space.to_unit(row) for row in level[self.space.names].to_dict('records')])
+        n_good = max(2, int(math.ceil(0.15 * len(points))))
+        good, bad = points[:n_good], points[n_good:]
+        bw_good = np.clip(good.std(axis=0) * len(good) ** -0.2, 0.05, 0.5)
+        bw_bad = np.clip(bad.std(axis=0) * max(len(bad), 1) ** -0.2, 0.05, 0.5) if len(bad) else np.full(n_dims, 0.5)
+
+        def log_density(x, centers, bw):
+            if len(centers) == 0:
+                return np.zeros(len(x))
+            z = (x[:, None, :] - centers[None, :, :]) / bw
+            return np.log(np.exp(-0.5 * (z ** 2).sum(axis=2)).mean(axis=1) + 1e-300)
+
+        proposals = []
+        for _ in range(n):
+            if self.rng.random() < 1 / 3: # giữ một phần khám phá ngẫu nhiên
+                proposals.append(self.space.sample(self.rng))
+                continue
+            centers = good[self.rng.integers(len(good), size=64)]
+            candidates = np.clip(centers + self.rng.normal(0, 1, centers.shape) * bw_good, 0, 1)
+            gain = log_density(candidates, good, bw_good) - log_density(candidates, bad, bw_bad)
+            proposals.append(self.space.from_unit(candidates[np.argmax(gain)]))
+        return proposals
+
+    # --- Successive halving / Hyperband ---
+    def successive_halving(self, candidates, min_fraction):
+        """Chấm điểm ở min_fraction, giữ 1/eta tốt nhất, tăng dữ liệu eta lần, tới 1.0."""
+        fraction = min_fraction
+        while candidates:
+            scored = []
+            for params in candidates:
+                record = self.evaluate(params, fraction)
+                if record is None: # hết ngân sách
+                    return False
+                scored.append((record['score'], params))
+            if fraction >= 1:
+                return True
+            scored.sort(key=lambda item: item[0], reverse=True)
+            keep = max(1, len(scored) // self.eta)
+            candidates = [params for score, params in scored[:keep] if np.isfinite(score)]
+            fraction = min(1.0, fraction * self.eta)
+        return True
+
+    def run(self, n_brackets=None):
+        """
+        Chạy Hyperband: lặp các bracket từ nhiều cấu hình / ít dữ liệu tới ít cấu hình / đủ dữ liệu,
+        cho tới khi hết ngân sách hoặc đủ n_brackets. Trả về bảng mọi lần đánh giá.
+        """
+        s_max = int(round(math.log(1 / self.min_fraction, self.eta)))
+        done = 0
+        while n_brackets is None or done < n_brackets:
+            s = s_max - done % (s_max + 1)
+            n = int(math.ceil((s_max + 1) / (s + 1) * self.eta ** s))
+            if not self.successive_halving(self._propose(n), self.eta ** -s):
+                break
+            done += 1
+            if self.budget is None and n_brackets is None and done > s_max:
+                break
+        print(f"Đã dùng {self.spent:,.0f} ticker-ngày cho {len(self.records)} lần chạy "
+              f"({sum(r['fraction'] >= 1 for r in self.records)} lần đủ lịch sử).")
+        return self.results()
+
+    def results(self):
+        return pd.DataFrame(self.records)
+
+    def best_params(self):
+        """Cấu hình tốt nhất ở mức fidelity cao nhất đã đánh giá (1.0 nếu có)."""
+        table = self.results()
+        if table.empty:
+            return None
+        top = table[table['fraction'] == table['fraction'].max()]
+        return top.sort_values('score', ascending=False).iloc[0][self.space.names].to_dict()
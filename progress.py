@@ -0,0 +1,212 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+# ==============================================================================
+# TIẾN ĐỘ & CHỈ SỐ CHO BACKTEST / SWEEP CHẠY DÀI
+# ==============================================================================
+# ProgressReporter đếm ngày đã mô phỏng, số cấu hình xong, số lệnh khớp, cache hit/miss,
+# RAM và ước lượng thời gian còn lại (ETA). Ảnh chụp được ghi định kỳ (ghi đè nguyên tử)
+# ra file JSON và/hoặc file text định dạng Prometheus (dùng với node_exporter textfile
+# collector), hoặc phục vụ qua HTTP cục bộ: /progress (JSON), /metrics (Prometheus).
+#
+# Vd:
+#   with ProgressReporter(json_path='progress.json', total_configs=len(combos)) as progress:
+#       for config in configs:
+#           progress.begin_run(n_days)
+#           run_backtest(data, config, on_day=progress.on_day)
+#           progress.config_done()
+
+METRICS = [
+    # (khóa trong ảnh chụp, tên Prometheus, kiểu, mô tả)
+    ('days', 'backtest_days_total', 'counter', 'Số ngày đã mô phỏng'),
+    ('days_per_sec', 'backtest_days_per_second', 'gauge', 'Tốc độ mô phỏng gần nhất (ngày/giây)'),
+    ('configs_done', 'backtest_configs_completed_total', 'counter', 'Số cấu hình đã chạy xong'),
+    ('configs_total', 'backtest_configs', 'gauge', 'Tổng số cấu hình của job'),
+    ('fills', 'backtest_fills_total', 'counter', 'Số lệnh đã khớp'),
+    ('cache_hits', 'backtest_cache_hits_total', 'counter', 'Số lần trúng cache kết quả'),
+    ('cache_misses', 'backtest_cache_misses_total', 'counter', 'Số lần trượt cache kết quả'),
+    ('rss_mb', 'backtest_rss_megabytes', 'gauge', 'RAM tiến trình (MB)'),
+    ('elapsed_sec', 'backtest_elapsed_seconds', 'gauge', 'Thời gian đã chạy (giây)'),
+    ('eta_sec', 'backtest_eta_seconds', 'gauge', 'Ước lượng thời gian còn lại (giây)'),
+]
+
+
+def _rss_mb():
+    # RAM hiện tại (Linux: /proc); nơi khác dùng RAM đỉnh
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        from backtest_script import _peak_rss_mb
+        return _peak_rss_mb()
+
+
+def _write_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class ProgressReporter:
+    def __init__(self, json_path=None, prom_path=None, port=None, interval=5.0, total_configs=None,
+                 cache=None, job='backtest'):
+        """
+        Args:
+            json_path / prom_path: file ghi đè định kỳ (None = không ghi)
+            port: cổng HTTP trên 127.0.0.1 (None = không mở)
+            interval: số giây tối thiểu giữa hai lần ghi file
+            total_configs: tổng số cấu hình (sweep) để tính ETA
+            cache: ResultCache để đọc số hit/miss
+            job: nhãn `job` của các chỉ số Prometheus
+        """
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self.total_configs = total_configs
+        self.cache = cache
+        self.job = job
+        self.days = 0
+        self.fills = 0
+        self.configs_done = 0
+        self.run_days = None # số ngày của lần chạy hiện tại (nếu biết)
+        self.run_days_done = 0
+        self._portfolio = None
+        self._trades_seen = 0
+        self._started = time.monotonic()
+        self._last_flush = self._started
+        self._rate = (self._started, 0) # (thời điểm, số ngày) lần đo tốc độ trước
+        self._days_per_sec = 0.0
+        self._lock = threading.Lock()
+        self._server = None
+        if port is not None:
+            self._serve(port)
+
+    # --- Cập nhật ---
+    def begin_run(self, n_days=None):
+        """Bắt đầu một lần backtest (n_days: số ngày sẽ mô phỏng, để tính ETA)."""
+        with self._lock:
+            self.run_days = n_days
+            self.run_days_done = 0
+
+    def on_day(self, today, portfolio, trade_list):
+        """Hook on_day của simulate_days / run_backtest."""
+        with self._lock:
+            if portfolio is not self._portfolio: # lần chạy mới
+                self._portfolio, self._trades_seen = portfolio, 0
+            self.fills += len(portfolio.trades) - self._trades_seen
+            self._trades_seen = len(portfolio.trades)
+            self.days += 1
+            self.run_days_done += 1
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def config_done(self):
+        with self._lock:
+            self.configs_done += 1
+        self.flush()
+
+    # --- Ảnh chụp ---
+    def _eta(self, days_per_sec):
+        if days_per_sec <= 0:
+            return None
+        run_left = max((self.run_days or 0) - self.run_days_done, 0)
+        if self.total_configs is None:
+            return run_left / days_per_sec if self.run_days else None
+        # Cấu hình còn lại ước lượng theo số ngày trung bình mỗi cấu hình đã chạy
+        configs_left = max(self.total_configs - self.configs_done - (1 if self.run_days_done else 0), 0)
+        days_per_config = self.days / self.configs_done if self.configs_done else (self.run_days or 0)
+        return (run_left + configs_left * days_per_config) / days_per_sec
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_days = self._rate
+            if now - last_time >= 1.0:
+                self._days_per_sec = (self.days - last_days) / (now - last_time)
+                self._rate = (now, self.days)
+            elapsed = now - self._started
+            days_per_sec = self._days_per_sec or (self.days / elapsed if elapsed > 0 else 0.0)
+            snap = {
+                'job': self.job,
+                'days': self.days,
+                'days_per_sec': days_per_sec,
+                'avg_days_per_sec': self.days / elapsed if elapsed > 0 else 0.0,
+                'configs_done': self.configs_done,
+                'configs_total': self.total_configs,
+                'run_days_done': self.run_days_done,
+                'run_days': self.run_days,
+                'fills': self.fills,
+                'cache_hits': getattr(self.cache, 'hits', None),
+                'cache_misses': getattr(self.cache, 'misses', None),
+                'rss_mb': _rss_mb(),
+                'elapsed_sec': elapsed,
+                'eta_sec': self._eta(days_per_sec),
+                'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+        return snap
+
+    def prometheus_text(self, snap=None):
+        snap = snap or self.snapshot()
+        lines = []
+        for key, name, kind, help_text in METRICS:
+            if snap.get(key) is None:
+                continue
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name}{{job="{self.job}"}} {snap[key]:g}']
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """Ghi ảnh chụp ra file (nếu có cấu hình)."""
+        self._last_flush = time.monotonic()
+        if not (self.json_path or self.prom_path):
+            return
+        snap = self.snapshot()
+        if self.json_path:
+            _write_atomic(self.json_path, json.dumps(snap, ensure_ascii=False, indent=1))
+        if self.prom_path:
+            _write_atomic(self.prom_path, self.prometheus_text(snap))
+
+    # --- HTTP ---
+    def _serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        reporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics'):
+                    body, content_type = reporter.prometheus_text(), 'text/plain; version=0.0.4'
+                elif self.path.startswith('/progress') or self.path == '/':
+                    body, content_type = json.dumps(reporter.snapshot(), ensure_ascii=False), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args): # không in mỗi request ra stderr
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Tiến độ: http://127.0.0.1:{self._server.server_address[1]}/progress | /metrics")
+
+    def close(self):
+        self.flush()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
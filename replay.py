@@ -0,0 +1,236 @@
+import contextlib
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# CHẠY LẠI TỪ TIỀN TỐ CHUNG CHO CẤU HÌNH LÂN CẬN (PHÂN TÍCH ĐỘ NHẠY)
+# ==============================================================================
+# Đổi nhẹ một tham số (vd REBALANCE_THRESHOLD 0.003 → 0.0035) thường cho ra đúng các lệnh cũ trong
+# nhiều năm trước quyết định khác đầu tiên. ReferenceRun ghi lại một lần chạy tham chiếu kèm:
+#   - ảnh chụp trạng thái đầu mỗi ngày (danh mục, lệnh chờ, hiệp phương sai EWMA; lịch sử NAV /
+#     sổ lệnh chỉ lưu độ dài vì luôn là tiền tố của lần chạy tham chiếu),
+#   - các đại lượng quyết định của decide_trades so với ngưỡng (margins).
+# Với cấu hình mới, divergence() tìm ngày đầu tiên quyết định khác, replay() khôi phục trạng thái
+# đầu ngày đó và chỉ mô phỏng từ đó. Kết quả giống hệt run_backtest với cấu hình mới.
+#
+# Tìm ngày khác biệt:
+#   - MARGIN_KEYS: chỉ so margins đã ghi với ngưỡng cũ / mới, không đọc lại dữ liệu
+#       REBALANCE_THRESHOLD: giá trị lệnh tái cân bằng nằm giữa hai ngưỡng
+#       MAX_LEVERAGE: tổng trọng số vượt một trong hai mức chặn
+#       MIN_ASSUMED_HOLDINGS: số mã mục tiêu nhỏ hơn một trong hai giá trị
+#   - INIT_KEYS: tham số chỉ dùng lúc khởi tạo trạng thái → chạy lại từ đầu
+#   - còn lại (vd ATR_MULTIPLIER, TARGET_VOLATILITY): chạy một ngày với cấu hình mới từ ảnh chụp tham chiếu
+#     và so trạng thái cuối ngày, dừng ở ngày đầu tiên khác. Chính xác nhưng mỗi ngày tốn như mô phỏng, và các
+#     tham số này thường đổi quyết định rất sớm → tổng chi phí gần bằng một lần chạy đầy đủ.
+# Nên replay chỉ thực sự rẻ khi sweep MARGIN_KEYS.
+#
+# Vd:
+#   ref = ReferenceRun.record(full_data, base_config)
+#   for value in [0.0030, 0.0035, 0.0040]:
+#       config.REBALANCE_THRESHOLD = value
+#       results = ref.replay(full_data, config)
+
+MARGIN_KEYS = ['REBALANCE_THRESHOLD', 'MAX_LEVERAGE', 'MIN_ASSUMED_HOLDINGS']
+INIT_KEYS = ['INITIAL_CAPITAL', 'SIZING_MODE', 'COVARIANCE_DECAY', 'RISK_PRIOR_CORRELATION']
+DATA_KEYS = ['AVG_VOLUME_WINDOW', 'ATR_WINDOW', 'VOLATILITY_WINDOW', 'SPLIT_JUMP_THRESHOLD', 'ADJUST_SUSPECTED_SPLITS',
+             'SPLIT_RATIO_TOLERANCE', 'SPLIT_VOLUME_WINDOW', 'SPLIT_VOLUME_TOLERANCE']
+
+
+def _iter_days(source, dates, events=None):
+    """
+    (today, daily_data_today) của các ngày `dates` từ DataFrame (time, ticker) hoặc PanelStore.
+    Có events: chỉ đọc dòng của các mã hoạt động mỗi ngày (xem backtest_script.sparse_days).
+    """
+    if len(dates) == 0:
+        return iter(())
+    if events is not None:
+        from backtest_script import sparse_days
+        return sparse_days(source, dates)
+    if isinstance(source, pd.DataFrame):
+        return ((today, source.loc[today]) for today in dates)
+    return source.iter_days(dates[0], dates[-1])
+
+
+def _snapshot(state):
+    # Trạng thái đầu ngày; các dict lồng trong holdings bị sửa tại chỗ nên phải copy sâu
+    portfolio = state['portfolio']
+    return {
+        'cash': portfolio.cash,
+        'holdings': {t: dict(p) for t, p in portfolio.holdings.items()},
+        'stop_losses': dict(portfolio.stop_losses),
+        'n_history': len(portfolio.history),
+        'n_trades': len(portfolio.trades),
+        'trade_list': dict(state['trade_list']),
+        'sl_data_list': dict(state['sl_data_list']),
+        'risk': copy.deepcopy(state['risk']),
+    }
+
+
+def _same_snapshot(a, b):
+    if (a['cash'], a['holdings'], a['stop_losses'], a['trade_list'], a['sl_data_list']) != \
+            (b['cash'], b['holdings'], b['stop_losses'], b['trade_list'], b['sl_data_list']):
+        return False
+    if a['risk'] is None or b['risk'] is None:
+        return a['risk'] is b['risk']
+    return a['risk'].tickers == b['risk'].tickers and np.array_equal(a['risk'].cov, b['risk'].cov)
+
+
+class ReferenceRun:
+    def __init__(self, config, dates, snapshots, margins, portfolio, universe=None, intraday=None, events=None):
+        """
+        Args:
+            config: cấu hình của lần chạy tham chiếu
+            dates: các ngày của khoảng backtest
+            snapshots: snapshots[i] = trạng thái đầu ngày dates[i], snapshots[-1]: sau ngày cuối có quyết định
+            margins: margins[i] = đại lượng quyết định của ngày dates[i] (xem decide_trades); ngắn hơn dates
+                     nếu lần chạy dừng sớm do NAV <= 0
+            portfolio: Portfolio cuối lần chạy (lịch sử NAV, sổ lệnh đầy đủ)
+            universe, intraday, events: dùng lại khi chạy cấu hình mới
+        """
+        from backtest_script import config_to_dict
+
+        self.params = config_to_dict(config)
+        self.dates = dates
+        self.snapshots = snapshots
+        self.margins = margins
+        self.portfolio = portfolio
+        self.universe = universe
+        self.intraday = intraday
+        self.events = events
+
+    @classmethod
+    def record(cls, source, config, from_date=None, end_date=None, log_file="backtest_log.txt", universe=None,
+               intraday=None, events=None, on_day=None):
+        """Chạy tham chiếu trên `source` (DataFrame của load_and_prepare_data hoặc PanelStore) và ghi ảnh chụp."""
+        import backtest_script as bs
+
+        all_dates = source.index.get_level_values('time').unique().sort_values() if isinstance(source, pd.DataFrame) else source.dates
+        state = bs.initial_state(config)
+        snapshots, margins = [_snapshot(state)], []
+
+        def on_state(today, state, day_margins):
+            snapshots.append(_snapshot(state))
+            margins.append(day_margins)
+
+        with open(log_file, "w", encoding="utf-8") as log:
+            all_dates = bs._select_dates(all_dates, from_date, end_date, log)
+            if all_dates is None:
+                all_dates = pd.DatetimeIndex([], name='time')
+            portfolio = bs.simulate_days(_iter_days(source, all_dates, events), len(all_dates), config, log, universe=universe,
+                                         on_day=on_day, intraday=intraday, events=events, state=state, on_state=on_state)
+        return cls(config, all_dates, snapshots, margins, portfolio, universe=universe, intraday=intraday, events=events)
+
+    def results(self):
+        """Lịch sử NAV của lần chạy tham chiếu (như run_backtest)."""
+        return pd.DataFrame(self.portfolio.history).set_index('date')
+
+    # --- Tìm ngày khác biệt ---
+    def changed_keys(self, config):
+        from backtest_script import config_to_dict
+
+        params = config_to_dict(config)
+        return sorted(k for k in set(params) | set(self.params) if params.get(k) != self.params.get(k))
+
+    def _margin_divergence(self, config, keys):
+        # Ngày đầu tiên một tham số trong MARGIN_KEYS làm đổi quyết định (len(margins) nếu không có)
+        old = self.params
+        first = len(self.margins)
+        if 'REBALANCE_THRESHOLD' in keys:
+            lo, hi = sorted([old['REBALANCE_THRESHOLD'], config.REBALANCE_THRESHOLD])
+            for i, m in enumerate(self.margins[:first]):
+                if m.get('rebalance'):
+                    values = np.asarray(m['rebalance'])
+                    # Bỏ qua khi trade_value < ngưỡng * nav → khác nhau khi nằm giữa hai ngưỡng
+                    if ((values < hi * m['nav_eod']) & ~(values < lo * m['nav_eod'])).any():
+                        first = i
+                        break
+        if 'MAX_LEVERAGE' in keys:
+            cap = min(old['MAX_LEVERAGE'], config.MAX_LEVERAGE)
+            for i, m in enumerate(self.margins[:first]):
+                if m.get('total_weight', 0) > cap:
+                    first = i
+                    break
+        if 'MIN_ASSUMED_HOLDINGS' in keys:
+            for i, m in enumerate(self.margins[:first]):
+                n = m.get('n_holdings')
+                if n is not None and max(old['MIN_ASSUMED_HOLDINGS'], n) != max(config.MIN_ASSUMED_HOLDINGS, n):
+                    first = i
+                    break
+        return first
+
+    def _restore(self, i, config):
+        # Trạng thái đầu ngày dates[i] với cấu hình mới (mọi đối tượng là bản copy, ảnh chụp không bị sửa)
+        import backtest_script as bs
+
+        if i == 0: # INIT_KEYS (vốn, hiệp phương sai...) lấy theo cấu hình mới
+            return bs.initial_state(config)
+        snap = self.snapshots[i]
+        portfolio = bs.Portfolio(config)
+        portfolio.cash = snap['cash']
+        portfolio.holdings = {t: dict(p) for t, p in snap['holdings'].items()}
+        portfolio.stop_losses = dict(snap['stop_losses'])
+        portfolio.history = self.portfolio.history[:snap['n_history']]
+        portfolio.trades = self.portfolio.trades[:snap['n_trades']]
+        return {'portfolio': portfolio, 'trade_list': dict(snap['trade_list']), 'sl_data_list': dict(snap['sl_data_list']),
+                'risk': copy.deepcopy(snap['risk'])}
+
+    def divergence(self, config, source=None):
+        """
+        Vị trí (trong self.dates) của ngày đầu tiên cấu hình `config` ra quyết định khác lần chạy tham chiếu;
+        len(self.margins) nếu không có ngày nào. `source` chỉ cần khi có tham số ngoài MARGIN_KEYS thay đổi.
+        """
+        import backtest_script as bs
+
+        keys = self.changed_keys(config)
+        if set(keys) & set(DATA_KEYS):
+            raise ValueError(f"Tham số {sorted(set(keys) & set(DATA_KEYS))} thay đổi chỉ báo: cần nạp lại dữ liệu.")
+        if set(keys) & set(INIT_KEYS):
+            return 0
+        first = self._margin_divergence(config, keys)
+        if set(keys) <= set(MARGIN_KEYS):
+            return first
+
+        # Các tham số còn lại: chạy từng ngày từ ảnh chụp và so với trạng thái đầu ngày kế tiếp
+        if source is None:
+            raise ValueError("Cần `source` để so quyết định với các tham số ngoài MARGIN_KEYS.")
+        with open(os.devnull, 'w', encoding='utf-8') as log:
+            for i, (today, daily_data_today) in enumerate(_iter_days(source, self.dates[:first], self.events)):
+                state = self._restore(i, config)
+                with contextlib.redirect_stdout(log):
+                    alive = bs.simulate_day(i, today, daily_data_today, state, config, log, universe=self.universe,
+                                            intraday=self.intraday, events=self.events)
+                if not alive or not _same_snapshot(_snapshot(state), self.snapshots[i + 1]):
+                    return i
+        return first
+
+    # --- Chạy lại ---
+    def replay(self, source, config, log_file="backtest_log.txt", return_portfolio=False, on_day=None):
+        """
+        Kết quả của `config` trên cùng khoảng ngày với lần chạy tham chiếu (giống run_backtest),
+        chỉ mô phỏng từ ngày khác biệt đầu tiên. Chỉ rẻ khi các tham số thay đổi nằm trong MARGIN_KEYS:
+        INIT_KEYS chạy lại từ đầu, các tham số khác tìm ngày khác biệt bằng cách mô phỏng lại từng ngày
+        (chi phí gần như một lần chạy đầy đủ).
+        """
+        import backtest_script as bs
+
+        first = self.divergence(config, source)
+        with open(log_file, "w", encoding="utf-8") as log:
+            if first >= len(self.margins):
+                # Kể cả khi tham chiếu dừng do NAV <= 0: cùng trạng thái → cấu hình mới cũng dừng ở ngày đó
+                log.write(f"Quyết định trùng lần chạy tham chiếu trên toàn bộ {len(self.margins)} ngày.\n")
+                portfolio = self._restore(len(self.snapshots) - 1, config)['portfolio']
+                portfolio.history = list(self.portfolio.history)
+                portfolio.trades = list(self.portfolio.trades)
+            else:
+                log.write(f"Quyết định khác từ ngày {self.dates[first].date()} (ngày thứ {first + 1}/{len(self.dates)}): "
+                          f"chạy lại từ đó.\n")
+                state = self._restore(first, config)
+                days = _iter_days(source, self.dates[first:], self.events)
+                portfolio = bs.simulate_days(days, len(self.dates) - first, config, log, universe=self.universe,
+                                             on_day=on_day, intraday=self.intraday, events=self.events,
+                                             state=state, start=first)
+        results = pd.DataFrame(portfolio.history).set_index('date') if portfolio.history else pd.DataFrame()
+        return (results, portfolio) if return_portfolio else results
@@ -0,0 +1,196 @@
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import weakref
+
+import pandas as pd
+
+import backtest_script as bs
+
+# ==============================================================================
+# CACHE KẾT QUẢ BACKTEST THEO NỘI DUNG (CONTENT-ADDRESSED)
+# ==============================================================================
+# Khóa = sha256(toàn bộ tham số StrategyConfig, khoảng ngày, dấu vân tay dữ liệu,
+# universe, ENGINE_VERSION). Mỗi kết quả là một file pickle {nav, ledger, metrics}.
+#   - Ghi nguyên tử (file tạm + os.replace) → an toàn khi nhiều worker sweep cùng ghi.
+#   - LRU theo mtime: lần đọc trúng sẽ "chạm" file; khi vượt max_bytes thì xóa file cũ nhất.
+#   - Tổng dung lượng được giữ trong file đếm SIZE_FILE (cộng dồn mỗi lần ghi, dưới khóa): chỉ khi
+#     bộ đếm vượt max_bytes mới quét cả thư mục, xóa tới EVICT_TO * max_bytes và đặt lại bộ đếm.
+
+try:
+    import fcntl
+except ImportError: # Windows: bỏ khóa, eviction vẫn chịu được lỗi file đã bị xóa
+    fcntl = None
+
+LOCK_FILE = '.lock'
+SIZE_FILE = '.size'
+EVICT_TO = 0.9 # xóa tới dưới ngưỡng này để các lần ghi kế tiếp không phải quét lại ngay
+
+
+def data_fingerprint(data):
+    """Dấu vân tay của nguồn dữ liệu: PanelStore có sẵn; DataFrame thì băm toàn bộ nội dung."""
+    if hasattr(data, 'fingerprint'):
+        return data.fingerprint
+    digest = hashlib.sha256(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    digest.update(json.dumps([str(c) for c in data.columns]).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, folder, max_bytes=2 * 2**30):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._fingerprints = {} # id(data) → (weakref, fingerprint): chỉ băm DataFrame một lần
+
+    # --- Khóa ---
+    def _fingerprint(self, data):
+        cached = self._fingerprints.get(id(data))
+        if cached is not None and cached[0]() is data:
+            return cached[1]
+        fp = data_fingerprint(data)
+        try:
+            self._fingerprints[id(data)] = (weakref.ref(data), fp)
+        except TypeError:
+            pass
+        return fp
+
+    def make_key(self, config, from_date, end_date, fingerprint, universe=None, intraday=None):
+        payload = {
+            'config': bs.config_to_dict(config),
+            'from_date': str(pd.Timestamp(from_date)) if from_date else None,
+            'end_date': str(pd.Timestamp(end_date)) if end_date else None,
+            'data': fingerprint,
+            'universe': universe.fingerprint() if universe is not None else None,
+            'intraday': intraday.fingerprint if intraday is not None else None,
+            'engine': bs.ENGINE_VERSION,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], f'{key}.pkl')
+
+    # --- Đọc / ghi ---
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path) # LRU: đánh dấu vừa dùng
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp_path)
+            # Đọc kích thước cũ, thay file và cập nhật bộ đếm trong cùng một khóa: hai worker ghi cùng khóa
+            # thì worker sau thấy file của worker trước và chỉ cộng phần chênh lệch
+            with self._locked():
+                try:
+                    old_size = os.path.getsize(path)
+                except FileNotFoundError:
+                    old_size = 0
+                os.replace(tmp_path, path)
+                total = self._read_size()
+                # Chưa có bộ đếm (cache cũ / bị xóa): quét một lần, kết quả quét đã gồm file vừa ghi
+                total = self._scan_total() if total is None else total + size - old_size
+                if total > self.max_bytes:
+                    total = self._evict_locked(EVICT_TO * self.max_bytes)
+                self._write_size(total)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def evict(self):
+        """Xóa các kết quả ít dùng nhất cho tới khi tổng dung lượng <= max_bytes."""
+        with self._locked():
+            self._write_size(self._evict_locked(self.max_bytes))
+
+    # --- Bộ đếm dung lượng (chỉ đọc / ghi khi đang giữ khóa) ---
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(os.path.join(self.folder, LOCK_FILE), 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read_size(self):
+        try:
+            with open(os.path.join(self.folder, SIZE_FILE), encoding='utf-8') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_size(self, total):
+        with open(os.path.join(self.folder, SIZE_FILE), 'w', encoding='utf-8') as f:
+            f.write(str(max(int(total), 0)))
+
+    def _scan(self):
+        # [(mtime, kích thước, đường dẫn)] của mọi kết quả trong cache
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if not name.endswith('.pkl'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+        return entries
+
+    def _scan_total(self):
+        return sum(size for _, size, _ in self._scan())
+
+    def _evict_locked(self, limit):
+        # Xóa file cũ nhất tới khi tổng <= limit; trả về tổng dung lượng thực tế còn lại
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    # --- Chạy có cache ---
+    def run_backtest(self, data, config, from_date=None, end_date=None, log_file="backtest_log.txt", universe=None, intraday=None, events=None, on_day=None):
+        """
+        Như run_backtest / run_backtest_streaming (tự chọn theo kiểu `data`) nhưng trả về
+        dict {'nav', 'ledger', 'metrics'} và lấy từ cache nếu đã từng chạy.
+        events chỉ tăng tốc, không đổi kết quả → không nằm trong khóa.
+        on_day chỉ được gọi khi phải chạy thật (cache miss).
+        """
+        key = self.make_key(config, from_date, end_date, self._fingerprint(data), universe, intraday)
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+
+        runner = bs.run_backtest_streaming if hasattr(data, 'iter_days') else bs.run_backtest
+        results, portfolio = runner(data, config, from_date=from_date, end_date=end_date,
+                                    log_file=log_file, universe=universe, return_portfolio=True, intraday=intraday, events=events, on_day=on_day)
+        entry = {
+            'nav': results,
+            'ledger': pd.DataFrame(portfolio.trades if portfolio is not None else [],
+                                   columns=['date', 'ticker', 'quantity', 'price', 'fee']),
+            'metrics': bs.compute_metrics(results, config.INITIAL_CAPITAL) if not results.empty else {},
+        }
+        self.put(key, entry)
+        return entry
@@ -0,0 +1,80 @@
+import numpy as np
+
+# ==============================================================================
+# HIỆP PHƯƠNG SAI EWMA CẬP NHẬT TĂNG DẦN CHO SIZING THEO VOLATILITY DANH MỤC
+# ==============================================================================
+# Chỉ theo dõi tập mã đang hoạt động (mã nắm giữ + mã mục tiêu của ngày). Mỗi ngày:
+#   Σ ← λ Σ + (1 - λ) r rᵀ     (r: log return trong ngày của các mã đang theo dõi, trung bình 0)
+# nên chi phí mỗi ngày là O(n²) với n = số mã hoạt động, không phụ thuộc độ dài lịch sử.
+# Mã mới được khởi tạo từ cột volatility (phương sai ngày = volatility² / 252) và
+# tương quan tiên nghiệm RISK_PRIOR_CORRELATION với các mã đã có.
+
+
+class EwmaCovariance:
+    def __init__(self, config, periods_per_year=252):
+        self.decay = config.COVARIANCE_DECAY
+        self.prior_correlation = config.RISK_PRIOR_CORRELATION
+        self.periods_per_year = periods_per_year
+        self.tickers = []
+        self.index = {}
+        self.cov = np.zeros((0, 0)) # đơn vị: theo ngày
+        self.last_close = np.zeros(0)
+
+    def update(self, close):
+        """(Cuối ngày) Cập nhật Σ bằng return hôm nay. close: {mã: giá đóng cửa} (mã không giao dịch hôm nay thì thiếu)."""
+        if not self.tickers:
+            return
+        today = np.array([close.get(t, np.nan) for t in self.tickers], dtype=np.float64)
+        traded = ~np.isnan(today)
+        returns = np.zeros(len(self.tickers))
+        returns[traded] = np.log(today[traded] / self.last_close[traded]) # không giao dịch → return 0
+        self.last_close[traded] = today[traded]
+        self.cov *= self.decay
+        self.cov += (1 - self.decay) * np.outer(returns, returns)
+
+    def sync(self, tickers, volatility, close):
+        """
+        Giữ đúng tập mã `tickers`: bỏ mã không còn hoạt động, thêm mã mới với phương sai khởi tạo
+        từ volatility (năm hóa) và tương quan tiên nghiệm.
+        """
+        keep = [t for t in self.tickers if t in set(tickers)]
+        rows = [self.index[t] for t in keep]
+        cov = self.cov[np.ix_(rows, rows)]
+        last_close = self.last_close[rows]
+
+        new = [t for t in tickers if t not in self.index]
+        if new:
+            sigma_old = np.sqrt(np.diag(cov))
+            sigma_new = np.array([volatility[t] for t in new]) / np.sqrt(self.periods_per_year)
+            n_old, n_new = len(keep), len(new)
+            grown = np.empty((n_old + n_new, n_old + n_new))
+            grown[:n_old, :n_old] = cov
+            grown[n_old:, :n_old] = self.prior_correlation * np.outer(sigma_new, sigma_old)
+            grown[:n_old, n_old:] = grown[n_old:, :n_old].T
+            grown[n_old:, n_old:] = self.prior_correlation * np.outer(sigma_new, sigma_new)
+            np.fill_diagonal(grown[n_old:, n_old:], sigma_new ** 2)
+            cov = grown
+            last_close = np.r_[last_close, [close[t] for t in new]]
+
+        self.tickers = keep + new
+        self.index = {t: k for k, t in enumerate(self.tickers)}
+        self.cov = cov
+        self.last_close = last_close
+
+    def portfolio_volatility(self, weights):
+        """Volatility năm hóa của danh mục {mã: trọng số} (mọi mã phải đang được theo dõi)."""
+        w = np.zeros(len(self.tickers))
+        for ticker, weight in weights.items():
+            w[self.index[ticker]] = weight
+        return float(np.sqrt(max(w @ self.cov @ w, 0.0) * self.periods_per_year))
+
+    def scale_weights(self, target_weights, volatility, close, target_volatility):
+        """
+        Cập nhật tập mã theo target_weights rồi trả về hệ số thu nhỏ (<= 1) để volatility
+        danh mục không vượt target_volatility.
+        """
+        self.sync(list(target_weights), volatility, close)
+        portfolio_vol = self.portfolio_volatility(target_weights)
+        if portfolio_vol <= target_volatility:
+            return 1.0
+        return target_volatility / portfolio_vol
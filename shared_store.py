@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# ==============================================================================
+# MÁY CHỦ DỮ LIỆU DÙNG CHUNG QUA BỘ NHỚ CHIA SẺ (/dev/shm)
+# ==============================================================================
+# Một tiến trình chạy lâu (serve) đọc CSV và tính chỉ báo một lần, ghi kết quả thành kho panel
+# (data_store.PanelStore) trên tmpfs /dev/shm. Mọi notebook / sweep / script khác attach bằng tên:
+# các file .npy được memory-map trực tiếp từ tmpfs nên không copy, tổng RAM chỉ một bản và
+# attach chỉ tốn vài mili giây (đọc meta.json).
+#
+#   root/name/
+#     current.json            manifest: phiên bản đang phát hành + fingerprint (ghi đè nguyên tử)
+#     v<thời điểm>/           một PanelStore đầy đủ (kèm events.npz), không bao giờ bị sửa sau khi phát hành
+#
+# Làm mới dữ liệu = ghi phiên bản mới rồi đổi manifest; client đang dùng phiên bản cũ không bị
+# ảnh hưởng (file đã map vẫn còn dù bị xóa) và thấy bản mới qua changed() / refresh().
+#
+# Vd:
+#   python cli.py serve --data processed_stock_history --name vn
+#   shared = SharedStore('vn')
+#   run_backtest_streaming(shared.store, config, events=shared.events)
+
+MANIFEST_FILE = 'current.json'
+DEFAULT_ROOT = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'tf_algo')
+
+
+def source_signature(data_path):
+    """Dấu vân tay rẻ của thư mục CSV (tên, kích thước, mtime) để phát hiện dữ liệu nguồn thay đổi."""
+    digest = hashlib.sha256()
+    for filename in sorted(f for f in os.listdir(data_path) if f.endswith('.csv')):
+        st = os.stat(os.path.join(data_path, filename))
+        digest.update(f'{filename}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+
+def read_manifest(name='default', root=None):
+    with open(os.path.join(root or DEFAULT_ROOT, name, MANIFEST_FILE), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def publish(data_path, config, name='default', root=None, interval='1D', dtype=None, keep=2):
+    """
+    Chuẩn bị dữ liệu (prepare_store) thành một phiên bản mới và phát hành bằng cách đổi manifest.
+    keep: số phiên bản giữ lại (phiên bản cũ bị xóa; client đang map chúng vẫn đọc được tới khi đóng).
+    Trả về manifest đã phát hành.
+    """
+    import numpy as np
+    from backtest_script import prepare_store
+
+    base = os.path.join(root or DEFAULT_ROOT, name)
+    os.makedirs(base, exist_ok=True)
+    signature = source_signature(data_path)
+    version = f'v{time.time_ns()}'
+    store = prepare_store(data_path, os.path.join(base, version), config, dtype=dtype or np.float64, interval=interval)
+    manifest = {
+        'version': version,
+        'fingerprint': store.fingerprint,
+        'source': os.path.abspath(data_path),
+        'source_signature': signature,
+        'published_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'server_pid': os.getpid(),
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=base, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(base, MANIFEST_FILE))
+
+    versions = sorted(d for d in os.listdir(base) if d.startswith('v') and os.path.isdir(os.path.join(base, d)))
+    for old in versions[:-keep] if keep > 0 else []:
+        if old != version:
+            shutil.rmtree(os.path.join(base, old), ignore_errors=True)
+    print(f"Đã phát hành {name}/{version} ({len(store)} ngày × {len(store.tickers)} mã) tại {base}")
+    return manifest
+
+
+def serve(data_path, config, name='default', root=None, interval='1D', dtype=None, poll=60.0, once=False):
+    """
+    Phát hành dữ liệu rồi (once=False) theo dõi thư mục CSV mỗi `poll` giây, phát hành lại khi
+    dữ liệu nguồn thay đổi. Dừng bằng Ctrl+C; các phiên bản đã phát hành được giữ lại cho client.
+    """
+    try:
+        current = read_manifest(name, root).get('source_signature')
+    except (OSError, ValueError):
+        current = None
+    try:
+        while True:
+            signature = source_signature(data_path)
+            if signature != current:
+                current = publish(data_path, config, name, root, interval=interval, dtype=dtype)['source_signature']
+            if once:
+                return
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        print("Dừng máy chủ dữ liệu.")
+
+
+class SharedStore:
+    def __init__(self, name='default', root=None, retries=3):
+        """
+        Attach phiên bản đang phát hành của `name`. Kiểm tra fingerprint của kho với manifest
+        (ValueError nếu không khớp). retries: số lần đọc lại manifest nếu phiên bản vừa bị thay thế.
+        """
+        self.name = name
+        self.root = root or DEFAULT_ROOT
+        self.retries = retries
+        self._attach()
+
+    def _attach(self):
+        from data_store import PanelStore
+        from events import BreakoutEvents
+
+        for attempt in range(self.retries + 1):
+            manifest = read_manifest(self.name, self.root)
+            try:
+                store = PanelStore(os.path.join(self.root, self.name, manifest['version']))
+                break
+            except FileNotFoundError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(0.1)
+        if store.fingerprint != manifest['fingerprint']:
+            raise ValueError(f"Kho {self.name}/{manifest['version']} không khớp fingerprint của manifest.")
+        self.manifest = manifest
+        self.store = store
+        # Đọc ngay chỉ mục breakout: phiên bản có thể bị máy chủ xóa sau này (mảng đã map vẫn dùng được)
+        self.events = BreakoutEvents.for_store(store) if {'close', 'ath', 'volatility'} <= set(store.columns) else None
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    @property
+    def fingerprint(self):
+        return self.manifest['fingerprint']
+
+    def changed(self):
+        """Máy chủ đã phát hành phiên bản khác phiên bản đang dùng chưa."""
+        try:
+            return read_manifest(self.name, self.root)['version'] != self.version
+        except (OSError, ValueError):
+            return False
+
+    def refresh(self):
+        """Chuyển sang phiên bản mới nhất nếu có; trả về True nếu đã đổi."""
+        if not self.changed():
+            return False
+        self._attach()
+        return True
@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# NHIỀU SLEEVE CHIẾN LƯỢC TRÊN MỘT TÀI KHOẢN, MỘT LƯỢT ĐỌC DỮ LIỆU
+# ==============================================================================
+# Mỗi sleeve là một bộ tham số (vd ATR_MULTIPLIER / TARGET_VOLATILITY khác nhau, hoặc Universe riêng)
+# với một phần vốn. Mỗi ngày, dữ liệu của ngày được đọc một lần và mọi sleeve ra quyết định trên đó
+# (decide_trades). Lệnh của các sleeve được bù trừ theo mã trước khi ra thị trường:
+#   - phần mua / bán đối ứng giữa các sleeve khớp nội bộ tại cùng giá, không mất phí;
+#   - chỉ phần ròng đi qua fill_orders (giới hạn thanh khoản, tác động giá) và chịu phí giao dịch;
+#   - phí của phần ròng được phân bổ cho các sleeve theo tỷ lệ số lượng khớp (gross) của từng sleeve.
+# Định kỳ `rebalance_days` phiên, tiền mặt được chuyển giữa các sleeve để vốn về đúng tỷ trọng;
+# sleeve nhận ít vốn hơn giá trị cổ phiếu đang giữ tạm có tiền mặt âm và tự bán bớt ở quyết định cùng ngày.
+#
+# Vd:
+#   sleeves = [Sleeve('fast', fast_config, 0.5), Sleeve('slow', slow_config, 0.5)]
+#   combined, per_sleeve = run_sleeves(full_data, sleeves, rebalance_days=63)
+
+# Tham số khớp lệnh / phí phải giống nhau giữa các sleeve (cùng một tài khoản)
+ACCOUNT_KEYS = ['COMMISSION_RATE', 'SELL_TAX_RATE', 'SLIPPAGE_RATE', 'MAX_PARTICIPATION_RATE', 'PRICE_IMPACT_COEF']
+
+
+class Sleeve:
+    def __init__(self, name, config, weight, universe=None):
+        """
+        Args:
+            name: tên sleeve (cột kết quả)
+            config: StrategyConfig của sleeve
+            weight: tỷ trọng vốn (được chuẩn hóa theo tổng tỷ trọng các sleeve)
+            universe: Universe riêng của sleeve (xem universe.py), None = lọc theo config
+        """
+        self.name = name
+        self.config = config
+        self.weight = weight
+        self.universe = universe
+
+
+def _fee_rate(config, quantity):
+    if quantity > 0:
+        return config.COMMISSION_RATE + config.SLIPPAGE_RATE
+    return config.COMMISSION_RATE + config.SELL_TAX_RATE + config.SLIPPAGE_RATE
+
+
+def net_fills(trade_lists, daily_data_today, config):
+    """
+    Bù trừ lệnh chờ của các sleeve theo mã rồi khớp phần ròng bằng fill_orders.
+
+    Args:
+        trade_lists: [{mã: số lượng +mua/-bán}] theo thứ tự sleeve
+        config: cấu hình tài khoản (tham số ACCOUNT_KEYS)
+    Returns:
+        (fills, remainders, fees, missing, fee_paid, fee_unnetted):
+            fills[k]: [(mã, số lượng khớp, giá)] của sleeve k theo thứ tự bán trước mua sau (như fill_orders)
+            remainders[k]: {mã: số lượng chưa khớp} của sleeve k
+            fees[k]: {mã: phí phân bổ} của sleeve k (chỉ mã có từ hai sleeve cùng đặt lệnh)
+            missing: mã không có giá hôm nay
+            fee_paid / fee_unnetted: tổng phí sau bù trừ / nếu từng sleeve tự khớp lệnh của mình
+    """
+    from backtest_script import fill_orders, lookup_rows
+
+    orders = {}
+    for k, trade_list in enumerate(trade_lists):
+        for ticker, quantity in trade_list.items():
+            orders.setdefault(ticker, []).append((k, quantity))
+    net = {ticker: sum(q for _, q in legs) for ticker, legs in orders.items()}
+    market, _, missing = fill_orders({t: q for t, q in net.items() if q != 0}, daily_data_today, config)
+    market = {ticker: (quantity, price) for ticker, quantity, price in market}
+    _, values = lookup_rows(daily_data_today, list(orders), ('open',))
+    opens = dict(zip(orders, values['open'].tolist()))
+    missing = set(missing) | {t for t in orders if net[t] == 0 and np.isnan(opens[t])}
+
+    filled = [{} for _ in trade_lists]
+    fees = [{} for _ in trade_lists]
+    fee_paid = fee_unnetted = 0.0
+    for ticker, legs in orders.items():
+        if ticker in missing:
+            continue
+        market_quantity, price = market.get(ticker, (0, opens[ticker]))
+        buys = sum(q for _, q in legs if q > 0)
+        sells = -sum(q for _, q in legs if q < 0)
+        # Bên dư (cùng chiều lệnh ròng) khớp phần đối ứng + phần thị trường đã khớp, chia theo tỷ lệ lệnh;
+        # bên còn lại khớp toàn bộ
+        excess_sign = 1 if buys >= sells else -1
+        excess_total = max(buys, sells)
+        excess_filled = min(buys, sells) + abs(market_quantity)
+        excess = [(k, abs(q)) for k, q in legs if np.sign(q) == excess_sign]
+        shares = {k: abs(q) * excess_filled // excess_total for k, q in excess}
+        leftover = excess_filled - sum(shares.values())
+        for k, _ in sorted(excess, key=lambda leg: -(leg[1] * excess_filled % excess_total))[:leftover]:
+            shares[k] += 1
+        for k, q in legs:
+            filled[k][ticker] = excess_sign * shares[k] if k in shares else q
+
+        fee = abs(market_quantity) * price * _fee_rate(config, market_quantity)
+        fee_paid += fee
+        gross = sum(abs(filled[k][ticker]) for k, _ in legs)
+        fee_unnetted += sum(abs(filled[k][ticker]) * price * _fee_rate(config, filled[k][ticker]) for k, _ in legs)
+        if len(legs) > 1 and gross > 0:
+            for k, _ in legs:
+                fees[k][ticker] = fee * abs(filled[k][ticker]) / gross
+
+    fills, remainders = [], []
+    for k, trade_list in enumerate(trade_lists):
+        prices = {ticker: market.get(ticker, (0, opens[ticker]))[1] for ticker in filled[k]}
+        # Cùng thứ tự với fill_orders: theo số lượng đặt, bán trước mua sau
+        ordered = sorted(trade_list.items(), key=lambda item: item[1])
+        fills.append([(t, filled[k][t], prices[t]) for t, _ in ordered if filled[k].get(t, 0) != 0])
+        remainders.append({t: q - filled[k][t] for t, q in ordered if t in filled[k] and filled[k][t] != q})
+    return fills, remainders, fees, sorted(missing), fee_paid, fee_unnetted
+
+
+def _unaffordable(portfolio, fills, fees):
+    # Chạy thử fills trên tiền mặt của sleeve (cùng phép tính với Portfolio.execute_buy / execute_sell):
+    # các lệnh mua sẽ bị từ chối vì không đủ tiền mặt
+    config = portfolio.config
+    cash = portfolio.cash
+    failed = []
+    for ticker, quantity, price in fills:
+        fee = fees.get(ticker)
+        if quantity < 0:
+            if fee is None:
+                cash += price * -quantity * (1 - config.COMMISSION_RATE - config.SELL_TAX_RATE - config.SLIPPAGE_RATE)
+            else:
+                cash += price * -quantity - fee
+            continue
+        if fee is None:
+            cost = price * quantity * (1 + config.COMMISSION_RATE + config.SLIPPAGE_RATE)
+        else:
+            cost = price * quantity + fee
+        if cash < cost:
+            failed.append((ticker, quantity))
+        else:
+            cash -= cost
+    return failed
+
+
+def run_sleeves(data, sleeves, from_date=None, end_date=None, log_file="backtest_log.txt", rebalance_days=None,
+                events=None, return_portfolios=False, on_day=None):
+    """
+    Chạy nhiều sleeve trên cùng một tài khoản (xem đầu file).
+
+    Args:
+        data: DataFrame (time, ticker) của load_and_prepare_data hoặc PanelStore (xem data_store.py)
+        sleeves: [Sleeve]; vốn ban đầu = INITIAL_CAPITAL của sleeve đầu tiên, chia theo weight
+        rebalance_days: số phiên giữa hai lần đưa vốn các sleeve về đúng tỷ trọng (None = không)
+        events: BreakoutEvents (xem events.py) dùng chung cho mọi sleeve
+        on_day: hàm on_day(tên sleeve, today, portfolio, trade_list) gọi sau khi mỗi sleeve ra quyết định trong ngày
+    Returns:
+        (combined, per_sleeve): lịch sử NAV gộp (nav, cash, exposure, holdings_count, fees, fees_unnetted)
+        và {tên sleeve: lịch sử NAV như run_backtest}; thêm {tên: Portfolio} nếu return_portfolios=True
+    """
+    import backtest_script as bs
+
+    if not sleeves:
+        raise ValueError("Cần ít nhất một sleeve.")
+    if len({s.name for s in sleeves}) != len(sleeves):
+        raise ValueError("Tên sleeve bị trùng.")
+    account = sleeves[0].config
+    for sleeve in sleeves[1:]:
+        different = [k for k in ACCOUNT_KEYS if getattr(sleeve.config, k) != getattr(account, k)]
+        if different:
+            raise ValueError(f"Sleeve {sleeve.name}: tham số tài khoản {different} phải giống sleeve {sleeves[0].name}.")
+    total_weight = sum(s.weight for s in sleeves)
+    weights = [s.weight / total_weight for s in sleeves]
+
+    states = []
+    for sleeve, weight in zip(sleeves, weights):
+        state = bs.initial_state(sleeve.config)
+        state['portfolio'].cash = account.INITIAL_CAPITAL * weight
+        states.append(state)
+    alive = [True] * len(sleeves)
+    combined = []
+
+    with open(log_file, "w", encoding="utf-8") as log:
+        if isinstance(data, pd.DataFrame):
+            all_dates = bs._select_dates(data.index.get_level_values('time').unique().sort_values(), from_date, end_date, log)
+            days = ((today, data.loc[today]) for today in all_dates) if all_dates is not None else None
+        else:
+            all_dates = bs._select_dates(data.dates, from_date, end_date, log)
+            days = data.iter_days(all_dates[0], all_dates[-1]) if all_dates is not None else None
+        if events is not None and all_dates is not None:
+            days = bs.sparse_days(data, all_dates)
+        if all_dates is None:
+            empty = pd.DataFrame()
+            per_sleeve = {s.name: empty for s in sleeves}
+            return (empty, per_sleeve, {}) if return_portfolios else (empty, per_sleeve)
+
+        log.write(f"\nBắt đầu backtest {len(sleeves)} sleeve: "
+                  + ", ".join(f"{s.name} ({w:.0%})" for s, w in zip(sleeves, weights)) + "\n")
+        for i, (today, daily_data_today) in enumerate(bs.tqdm(days, total=len(all_dates), desc="Đang mô phỏng các sleeve")):
+            if callable(daily_data_today): # chế độ events: chỉ đọc dòng của các mã mà mọi sleeve cần hôm nay
+                daily_data_today = daily_data_today(bs.day_tickers(states, events, today))
+            # 1. Khớp lệnh chờ của mọi sleeve sau khi bù trừ. Lệnh mua không đủ tiền bị hủy trước khi bù trừ lại
+            #    (nếu không, phần đối ứng nội bộ của sleeve khác sẽ khớp với một lệnh không thực hiện)
+            trade_lists = [dict(state['trade_list']) for state in states]
+            while True:
+                fills, remainders, fees, missing, fee_paid, fee_unnetted = net_fills(trade_lists, daily_data_today, account)
+                failed = [(k, ticker, quantity) for k, state in enumerate(states)
+                          for ticker, quantity in _unaffordable(state['portfolio'], fills[k], fees[k])]
+                if not failed:
+                    break
+                for k, ticker, quantity in failed:
+                    print(f"  > [WARNING] Không đủ tiền mặt để mua {quantity} {ticker}.")
+                    del trade_lists[k][ticker]
+            for ticker in missing:
+                log.write(f"[WARNING] Mã {ticker} (quyết định mua | bán): không tìm thấy trong thông tin giá của ngày hiện tại.\n")
+            for k, state in enumerate(states):
+                state['portfolio'].current_date = today
+                bs.apply_fills(state['portfolio'], fills[k], state['sl_data_list'], fees=fees[k])
+
+            # 2. Đưa vốn các sleeve về tỷ trọng mục tiêu (chuyển tiền mặt, tổng NAV không đổi)
+            daily_close_prices = bs.held_prices(daily_data_today, set().union(*(state['portfolio'].holdings for state in states)))
+            if rebalance_days and i > 0 and i % rebalance_days == 0:
+                navs = [state['portfolio'].get_total_value(daily_close_prices) for state in states]
+                total_nav = sum(navs)
+                for state, weight, nav in zip(states, weights, navs):
+                    state['portfolio'].cash += weight * total_nav - nav
+                log.write(f"[INFO] {today.date()}: cân bằng vốn giữa các sleeve, NAV {total_nav:,.0f} VND.\n")
+
+            # 3. Mỗi sleeve ghi NAV và ra quyết định trên cùng dữ liệu của ngày
+            for k, (sleeve, state) in enumerate(zip(sleeves, states)):
+                if not alive[k]:
+                    state['portfolio'].record_nav(today, daily_close_prices)
+                    continue
+                alive[k] = bs.end_of_day(i, today, daily_data_today, state, remainders[k], sleeve.config, log,
+                                         universe=sleeve.universe, events=events)
+                if not alive[k]:
+                    state['trade_list'], state['sl_data_list'] = {}, {}
+                elif on_day is not None:
+                    on_day(sleeve.name, today, state['portfolio'], state['trade_list'])
+
+            stock_value = sum(state['portfolio'].get_stock_value(daily_close_prices) for state in states)
+            cash = sum(state['portfolio'].cash for state in states)
+            nav = cash + stock_value
+            combined.append({'date': today, 'nav': nav, 'cash': cash, 'exposure': stock_value / nav if nav > 0 else 0,
+                             'holdings_count': len(set().union(*(state['portfolio'].holdings for state in states))),
+                             'fees': fee_paid, 'fees_unnetted': fee_unnetted})
+            if nav <= 0:
+                log.write("NAV gộp âm! Dừng backtest.\n")
+                break
+
+    combined = pd.DataFrame(combined).set_index('date')
+    per_sleeve = {s.name: pd.DataFrame(state['portfolio'].history).set_index('date') for s, state in zip(sleeves, states)}
+    if return_portfolios:
+        return combined, per_sleeve, {s.name: state['portfolio'] for s, state in zip(sleeves, states)}
+    return combined, per_sleeve
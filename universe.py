@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# VŨ TRỤ CỔ PHIẾU THEO THỜI GIAN (POINT-IN-TIME)
+# ==============================================================================
+# Mỗi vũ trụ là một bitmap boolean (ngày × mã) được tính sẵn một lần, lưu dạng
+# packbits (8 mã / byte) và có thể memory-map khi đọc lại. Engine chỉ cần tra
+# một dòng mỗi ngày thay vì lọc lại giá / thanh khoản trên cả DataFrame.
+
+
+def load_membership(path, column=None, values=None):
+    """
+    Đọc file thành phần (chỉ số, sàn, ngành...) thành bảng khoảng thời gian.
+
+    Hỗ trợ 2 định dạng CSV:
+        - Khoảng: cột `ticker`, `start_date`, `end_date` (end_date trống → vẫn còn là thành viên).
+        - Snapshot: cột `date`, `ticker` (danh sách thành phần công bố tại mỗi kỳ);
+          mỗi mã là thành viên từ kỳ công bố đến trước kỳ kế tiếp.
+
+    Args:
+        path: đường dẫn file CSV
+        column: cột thuộc tính dùng để lọc (vd "exchange", "sector"). None → lấy tất cả.
+        values: giá trị hợp lệ của `column` (vd ["HOSE"])
+
+    Returns:
+        DataFrame với các cột ticker, start_date, end_date (end_date có thể NaT).
+    """
+    df = pd.read_csv(path)
+    df.columns = df.columns.str.lower()
+    df['ticker'] = df['ticker'].astype(str).str.upper()
+
+    if column is not None:
+        if values is None:
+            raise ValueError(f"Cần chỉ định values khi lọc theo cột '{column}'.")
+        df = df[df[column.lower()].isin(list(values))]
+
+    if 'start_date' in df.columns:
+        intervals = df[['ticker', 'start_date']].copy()
+        intervals['start_date'] = pd.to_datetime(df['start_date'])
+        intervals['end_date'] = pd.to_datetime(df['end_date']) if 'end_date' in df.columns else pd.NaT
+        return intervals.reset_index(drop=True)
+
+    if 'date' not in df.columns:
+        raise ValueError(f"File {path} cần có cột start_date/end_date hoặc date.")
+
+    # Snapshot → khoảng: thành viên từ kỳ công bố đến ngay trước kỳ kế tiếp
+    df['date'] = pd.to_datetime(df['date'])
+    snapshot_dates = np.sort(df['date'].unique())
+    next_date = dict(zip(snapshot_dates[:-1], snapshot_dates[1:]))
+    intervals = pd.DataFrame({
+        'ticker': df['ticker'].values,
+        'start_date': df['date'].values,
+        'end_date': df['date'].map(next_date).values,
+    })
+    intervals['end_date'] = pd.to_datetime(intervals['end_date']) - pd.Timedelta(days=1)
+    return intervals.reset_index(drop=True)
+
+
+class Universe:
+    def __init__(self, dates, tickers, bits, name=None):
+        """
+        Args:
+            dates: DatetimeIndex các ngày (đã sắp xếp)
+            tickers: danh sách mã (thứ tự cột của bitmap)
+            bits: mảng bool (ngày × mã) hoặc mảng uint8 đã packbits theo trục mã
+        """
+        self.name = name
+        self.dates = pd.DatetimeIndex(dates)
+        self.tickers = pd.Index(tickers)
+        if bits.dtype == bool:
+            bits = np.packbits(bits, axis=1)
+        self.packed = bits
+
+    # --- Khởi tạo ---
+    @classmethod
+    def from_filters(cls, data, config, name='liquidity'):
+        """Bitmap giá / thanh khoản / volatility giống bước B của run_backtest."""
+        mask = (
+            (data['close'] > config.MIN_PRICE_THRESHOLD) &
+            (data['avg_volume'] > config.MIN_AVG_VOLUME) &
+            (data['volatility'] > 0)
+        ).to_numpy()
+        dates = data.index.get_level_values('time').unique().sort_values()
+        tickers = data.index.get_level_values('ticker').unique().sort_values()
+        rows = dates.get_indexer(data.index.get_level_values('time'))
+        cols = tickers.get_indexer(data.index.get_level_values('ticker'))
+        bits = np.zeros((len(dates), len(tickers)), dtype=bool)
+        bits[rows[mask], cols[mask]] = True
+        return cls(dates, tickers, bits, name=name)
+
+    @classmethod
+    def from_membership(cls, intervals, dates, tickers, name=None):
+        """Bitmap từ bảng khoảng thành viên (kết quả của load_membership)."""
+        dates = pd.DatetimeIndex(dates)
+        tickers = pd.Index(tickers)
+        cols = tickers.get_indexer(intervals['ticker'])
+        keep = cols >= 0
+        starts = dates.searchsorted(intervals['start_date'].values[keep], side='left')
+        end_values = intervals['end_date'].fillna(dates.max()).values[keep]
+        ends = dates.searchsorted(end_values, side='right')
+        cols = cols[keep]
+
+        # Mảng hiệu: +1 tại ngày vào, -1 tại ngày ra, cộng dồn theo trục ngày
+        diff = np.zeros((len(dates) + 1, len(tickers)), dtype=np.int32)
+        np.add.at(diff, (starts, cols), 1)
+        np.add.at(diff, (ends, cols), -1)
+        bits = np.cumsum(diff[:-1], axis=0) > 0
+        return cls(dates, tickers, bits, name=name)
+
+    # --- Truy vấn ---
+    @property
+    def bits(self):
+        return np.unpackbits(self.packed, axis=1, count=len(self.tickers)).astype(bool)
+
+    def row(self, date):
+        """Dòng bitmap (bool theo thứ tự self.tickers) của một ngày; ngày không có → toàn False."""
+        try:
+            i = self.dates.get_loc(pd.Timestamp(date))
+        except KeyError:
+            return np.zeros(len(self.tickers), dtype=bool)
+        return np.unpackbits(self.packed[i], count=len(self.tickers)).astype(bool)
+
+    def members(self, date):
+        return self.tickers[self.row(date)]
+
+    def mask(self, date, tickers):
+        """Mask bool cho danh sách `tickers` (vd daily_data_today.index) tại ngày `date`."""
+        row = self.row(date)
+        cols = self.tickers.get_indexer(tickers)
+        return np.where(cols >= 0, row[cols], False)
+
+    def __and__(self, other):
+        if not (self.dates.equals(other.dates) and self.tickers.equals(other.tickers)):
+            other = other.reindex(self.dates, self.tickers)
+        name = f"{self.name}&{other.name}"
+        return Universe(self.dates, self.tickers, self.packed & other.packed, name=name)
+
+    def reindex(self, dates, tickers):
+        rows = self.dates.get_indexer(pd.DatetimeIndex(dates))
+        cols = self.tickers.get_indexer(pd.Index(tickers))
+        src = self.bits
+        bits = np.zeros((len(dates), len(tickers)), dtype=bool)
+        ri = np.nonzero(rows >= 0)[0]
+        ci = np.nonzero(cols >= 0)[0]
+        bits[np.ix_(ri, ci)] = src[np.ix_(rows[ri], cols[ci])]
+        return Universe(dates, tickers, bits, name=self.name)
+
+    def fingerprint(self):
+        digest = hashlib.sha256(np.ascontiguousarray(self.packed).tobytes())
+        digest.update(json.dumps([str(self.dates[0]), str(self.dates[-1]), len(self.dates), [str(t) for t in self.tickers]]).encode())
+        return digest.hexdigest()
+
+    def summary(self):
+        counts = self.bits.sum(axis=1)
+        return pd.Series(counts, index=self.dates, name=self.name or 'universe')
+
+    # --- Lưu / đọc ---
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'bits.npy'), np.ascontiguousarray(self.packed))
+        meta = {
+            'name': self.name,
+            'dates': [d.strftime('%Y-%m-%d %H:%M:%S') for d in self.dates],
+            'tickers': [str(t) for t in self.tickers],
+        }
+        with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        with open(os.path.join(folder, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        packed = np.load(os.path.join(folder, 'bits.npy'), mmap_mode='r' if mmap else None)
+        return cls(pd.to_datetime(meta['dates']), meta['tickers'], packed, name=meta['name'])
+
+
+def build_universe(data, config, membership=(), name=None):
+    """
+    Kết hợp bộ lọc giá / thanh khoản của config với các file thành phần.
+
+    Args:
+        data: DataFrame (time, ticker) từ load_and_prepare_data
+        config: StrategyConfig (dùng MIN_PRICE_THRESHOLD, MIN_AVG_VOLUME)
+        membership: danh sách đường dẫn CSV, hoặc dict {'path', 'column', 'values'}
+
+    Vd: build_universe(full_data, config, ['vn100.csv', {'path': 'listing.csv', 'column': 'exchange', 'values': ['HOSE']}])
+    """
+    universe = Universe.from_filters(data, config)
+    for item in membership:
+        if isinstance(item, str):
+            item = {'path': item}
+        intervals = load_membership(item['path'], item.get('column'), item.get('values'))
+        label = os.path.splitext(os.path.basename(item['path']))[0]
+        universe = universe & Universe.from_membership(intervals, universe.dates, universe.tickers, name=label)
+    if name:
+        universe.name = name
+    return universe
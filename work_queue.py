@@ -0,0 +1,213 @@
+import glob
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+# ==============================================================================
+# HÀNG ĐỢI SWEEP QUA THƯ MỤC DÙNG CHUNG (NHIỀU MÁY, KHÔNG CẦN SCHEDULER)
+# ==============================================================================
+# queue_dir/
+#   pending/<id>.json              task chờ chạy: {id, params, from_date, end_date}
+#   claimed/<id>.<worker>.json     task đang chạy; mtime = nhịp tim (heartbeat) của worker
+#   results/<id>.json, <id>.csv    metrics + lịch sử NAV
+#   failed/<id>.json               task lỗi kèm traceback
+#
+# Nhận task = os.rename(pending → claimed) — nguyên tử trên cùng một filesystem nên chỉ một
+# worker thắng. Worker giữ lease bằng cách chạm file claimed định kỳ; task có file claimed
+# quá lease_timeout giây không được chạm sẽ bị trả về pending (worker đã chết).
+# mtime do máy chủ file đặt, nên thời điểm "bây giờ" để so lease cũng lấy từ mtime của file mốc
+# CLOCK_FILE vừa được chạm trên cùng filesystem, không dùng đồng hồ của máy worker (có thể lệch).
+# id là băm của nội dung task nên nộp lại cùng task không tạo bản sao, kết quả chạy trùng
+# (khi worker "chết giả") ghi đè đúng một file.
+
+SUBDIRS = ('pending', 'claimed', 'results', 'failed')
+CLOCK_FILE = '.clock'
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_json_atomic(path, payload):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, default=str)
+    os.replace(tmp_path, path)
+
+
+def _task_id(task):
+    payload = json.dumps([task['params'], task.get('from_date'), task.get('end_date')], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def init_queue(queue_dir):
+    for sub in SUBDIRS:
+        os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+
+
+def submit_tasks(queue_dir, param_sets, from_date=None, end_date=None):
+    """Ghi mỗi bộ tham số thành một task; bỏ qua task đã chờ / đang chạy / đã xong. Trả về số task mới."""
+    init_queue(queue_dir)
+    submitted = 0
+    for params in param_sets:
+        task = {'params': params, 'from_date': from_date, 'end_date': end_date}
+        task['id'] = _task_id(task)
+        if (os.path.exists(os.path.join(queue_dir, 'pending', f"{task['id']}.json"))
+                or os.path.exists(os.path.join(queue_dir, 'results', f"{task['id']}.json"))
+                or glob.glob(os.path.join(queue_dir, 'claimed', f"{task['id']}.*.json"))):
+            continue
+        _write_json_atomic(os.path.join(queue_dir, 'pending', f"{task['id']}.json"), task)
+        submitted += 1
+    return submitted
+
+
+def filesystem_now(queue_dir):
+    """Thời điểm hiện tại theo đồng hồ của filesystem chứa hàng đợi (mtime của CLOCK_FILE vừa chạm)."""
+    path = os.path.join(queue_dir, CLOCK_FILE)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        open(path, 'a').close()
+        os.utime(path)
+    return os.path.getmtime(path)
+
+
+def reclaim_expired(queue_dir, lease_timeout):
+    """Trả các task có lease hết hạn về pending. Trả về số task được trả lại."""
+    reclaimed = 0
+    now = filesystem_now(queue_dir)
+    for path in glob.glob(os.path.join(queue_dir, 'claimed', '*.json')):
+        try:
+            if now - os.path.getmtime(path) < lease_timeout:
+                continue
+            task_id = os.path.basename(path).split('.')[0]
+            os.rename(path, os.path.join(queue_dir, 'pending', f'{task_id}.json'))
+            reclaimed += 1
+        except FileNotFoundError: # worker khác vừa xử lý xong / vừa trả lại
+            continue
+    return reclaimed
+
+
+def claim_task(queue_dir, worker=None):
+    """Nhận một task đang chờ. Trả về (task, đường dẫn file claimed) hoặc None."""
+    worker = worker or worker_name()
+    for path in sorted(glob.glob(os.path.join(queue_dir, 'pending', '*.json'))):
+        task_id = os.path.basename(path)[:-len('.json')]
+        claimed_path = os.path.join(queue_dir, 'claimed', f'{task_id}.{worker}.json')
+        try:
+            # rename giữ mtime cũ → chạm trước để task chờ lâu không bị reclaim_expired coi là hết lease
+            # ngay sau khi vừa nhận
+            os.utime(path)
+            os.rename(path, claimed_path)
+            os.utime(claimed_path)
+            with open(claimed_path, encoding='utf-8') as f:
+                return json.load(f), claimed_path
+        except FileNotFoundError: # worker khác đã nhận trước / vừa trả task về pending
+            continue
+    return None
+
+
+class _Heartbeat(threading.Thread):
+    # Chạm file claimed định kỳ trong khi luồng chính đang chạy backtest
+    def __init__(self, path, interval):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError: # đã bị trả lại do quá hạn
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_worker(queue_dir, source, base_config, lease_timeout=600, poll_interval=5.0,
+               exit_when_empty=True, cache=None, log_file=os.devnull):
+    """
+    Vòng lặp worker: trả lại task quá hạn, nhận task, chạy backtest, ghi kết quả.
+
+    Args:
+        source: PanelStore (khuyến nghị: memory-map, nhiều worker dùng chung page cache) hoặc DataFrame
+        base_config: StrategyConfig gốc; params của task được ghi đè lên
+        exit_when_empty: thoát khi không còn task chờ và không còn task đang chạy
+        cache: ResultCache tùy chọn (xem result_cache.py)
+    Returns:
+        số task đã chạy xong
+    """
+    import backtest_script as bs
+
+    worker = worker_name()
+    run_backtest = bs.run_backtest_streaming if hasattr(source, 'iter_days') else bs.run_backtest
+    done = 0
+    while True:
+        reclaim_expired(queue_dir, lease_timeout)
+        claimed = claim_task(queue_dir, worker)
+        if claimed is None:
+            if exit_when_empty and not glob.glob(os.path.join(queue_dir, 'claimed', '*.json')):
+                return done
+            time.sleep(poll_interval)
+            continue
+
+        task, claimed_path = claimed
+        result_path = os.path.join(queue_dir, 'results', f"{task['id']}.json")
+        if os.path.exists(result_path): # đã có worker khác chạy xong
+            _remove(claimed_path)
+            continue
+
+        heartbeat = _Heartbeat(claimed_path, max(lease_timeout / 4, 0.1))
+        heartbeat.start()
+        started = time.time()
+        try:
+            config = bs.load_config(overrides=bs.config_to_dict(base_config))
+            for key, value in task['params'].items():
+                setattr(config, key, value)
+            if cache is not None:
+                results = cache.run_backtest(source, config, task['from_date'], task['end_date'], log_file=log_file)['nav']
+            else:
+                results = run_backtest(source, config, task['from_date'], task['end_date'], log_file=log_file)
+            metrics = bs.compute_metrics(results, config.INITIAL_CAPITAL) if not results.empty else {}
+            results.to_csv(os.path.join(queue_dir, 'results', f"{task['id']}.csv"))
+            _write_json_atomic(result_path, dict(task, metrics=metrics, worker=worker, elapsed=time.time() - started))
+            done += 1
+        except Exception:
+            _write_json_atomic(os.path.join(queue_dir, 'failed', f"{task['id']}.json"),
+                               dict(task, worker=worker, error=traceback.format_exc()))
+        finally:
+            heartbeat.stop()
+            _remove(claimed_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def queue_status(queue_dir):
+    return {sub: len(glob.glob(os.path.join(queue_dir, sub, '*.json'))) for sub in SUBDIRS}
+
+
+def collect_results(queue_dir):
+    """Gộp mọi kết quả thành một bảng: tham số + khoảng ngày + metrics + worker."""
+    import pandas as pd
+
+    rows = []
+    for path in sorted(glob.glob(os.path.join(queue_dir, 'results', '*.json'))):
+        with open(path, encoding='utf-8') as f:
+            result = json.load(f)
+        row = {'id': result['id'], **result['params'], 'from_date': result['from_date'], 'end_date': result['end_date']}
+        row.update(result['metrics'])
+        row.update({'worker': result['worker'], 'elapsed': result['elapsed']})
+        rows.append(row)
+    return pd.DataFrame(rows)